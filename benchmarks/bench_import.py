@@ -0,0 +1,90 @@
+"""
+Startup cost of the xray CLI: wall time of short invocations that send no
+requests, and which heavy modules each of them imports.
+
+    $ python benchmarks/bench_import.py --runs 20
+    $ python benchmarks/bench_import.py --budget-ms 150
+
+Every run is a fresh interpreter, as when xray is called from cron or a
+wrapper script. With --budget-ms, exits 1 if any scenario's median is over
+budget, so startup regressions can fail a build.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCENARIOS = [
+    ('--help', ['--help']),
+    ('usage error', ['databases']),
+    ('databases --help', ['--url', 'http://localhost', 'databases', '--help']),
+    ('indexes --help', ['--url', 'http://localhost', 'indexes', '--help']),
+    ('trend --help', ['trend', '--help']),
+]
+
+# modules only scans and table output need
+HEAVY = ['requests', 'urllib3', 'tabulate', 'gevent', 'grequests', 'sqlite3', 'multiprocessing']
+
+RUN = 'from xray.cli import main; main()'
+
+# runs the CLI, then reports the heavy modules it imported
+PROBE = '''
+import json, sys
+try:
+    from xray.cli import main
+    main()
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps(sorted(set(m.split('.')[0] for m in sys.modules) & set({0!r}))))
+'''.format(HEAVY)
+
+
+def run_once(python, code, args):
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        subprocess.call([python, '-c', code] + args, cwd=REPO, stdout=devnull, stderr=devnull)
+        return time.time() - started
+
+
+def heavy_modules(python, args):
+    child = subprocess.Popen([python, '-c', PROBE] + args, cwd=REPO,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    _, err = child.communicate()
+    # the probe's line comes last, after any usage error
+    return json.loads(err.decode('utf-8').strip().split('\n')[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10, help='Runs per scenario.')
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to run xray with.')
+    parser.add_argument('--budget-ms', type=float, default=None, help='Fail if a median is over this many milliseconds.')
+    args = parser.parse_args()
+
+    # python itself, for reference
+    baseline = sorted(run_once(args.python, 'pass', []) for _ in range(args.runs))[args.runs // 2]
+    row = '{0:<20}{1:>10}{2:>10}  {3}'
+    print(row.format('scenario', 'median ms', 'min ms', 'heavy modules'))
+    print(row.format('python -c pass', '{0:.0f}'.format(baseline * 1000), '', ''))
+
+    over = []
+    for name, command in SCENARIOS:
+        times = sorted(run_once(args.python, RUN, command) for _ in range(args.runs))
+        median = times[args.runs // 2] * 1000
+        print(row.format(name, '{0:.0f}'.format(median), '{0:.0f}'.format(times[0] * 1000),
+                         ', '.join(heavy_modules(args.python, command)) or '-'))
+        sys.stdout.flush()
+        if args.budget_ms is not None and median > args.budget_ms:
+            over.append(name)
+
+    if over:
+        print('Over the {0:.0f}ms budget: {1}'.format(args.budget_ms, ', '.join(over)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
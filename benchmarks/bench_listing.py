@@ -0,0 +1,117 @@
+"""
+Parse time and peak memory of a design doc listing: parsed whole with
+response.json(), as xray used to, against streamed row by row with
+iter_design_docs.
+
+    $ python benchmarks/bench_listing.py --ddocs 200 --ddoc-bytes 100000
+
+The listing is laid out as CouchDB streams one and generated as it is
+read, so neither way holds it in memory up front. Each way runs in its own
+process, and reports the growth in peak RSS while parsing.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xray'))
+
+import requests
+
+from command_databases import process_index_data
+from listings import iter_design_docs, read_design_docs
+from records import DbRecord
+
+
+class GeneratedListing(object):
+    """File-like body of an _all_docs listing of design docs, generated a
+    line at a time as it is read."""
+
+    def __init__(self, ddocs, ddoc_bytes):
+        self.lines = self.generate(ddocs, ddoc_bytes)
+        self.buffered = b''
+
+    def generate(self, ddocs, ddoc_bytes):
+        yield '{{"total_rows":{0},"offset":0,"rows":[\r\n'.format(ddocs).encode('utf-8')
+        for d in range(ddocs):
+            doc = {'_id': '_design/ddoc{0}'.format(d), '_rev': '1-{0:032x}'.format(d),
+                   'views': {'by_id': {'map': 'function(doc) { /* ' + 'x' * ddoc_bytes + ' */ emit(doc._id); }',
+                                       'reduce': '_count'}},
+                   'indexes': {'search': {'index': 'function(doc) { index("default", doc._id); }'}}}
+            row = {'id': doc['_id'], 'key': doc['_id'], 'value': {'rev': doc['_rev']}, 'doc': doc}
+            yield (('' if d == 0 else ',') + json.dumps(row) + '\r\n').encode('utf-8')
+        yield b']}\n'
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffered) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffered += line
+        if size < 0:
+            size = len(self.buffered)
+        data, self.buffered = self.buffered[:size], self.buffered[size:]
+        return data
+
+
+def whole(response):
+    return len(response.json()['rows'])
+
+
+def streamed(response):
+    return sum(1 for _ in iter_design_docs(response))
+
+
+WAYS = {'whole': whole, 'streamed': streamed}
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(way, ddocs, ddoc_bytes):
+    response = requests.Response()
+    response.status_code = 200
+    response.raw = GeneratedListing(ddocs, ddoc_bytes)
+    before = peak_rss_kb()
+    started = time.time()
+    rows = WAYS[way](response)
+    return {'way': way, 'rows': rows, 'seconds': time.time() - started,
+            'rss_kb': peak_rss_kb() - before}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--ddocs', type=int, default=200, help='Design docs in the listing.')
+    parser.add_argument('--ddoc-bytes', type=int, default=100000, help='Bytes of map function per design doc.')
+    parser.add_argument('--way', choices=sorted(WAYS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.way:
+        print(json.dumps(measure(args.way, args.ddocs, args.ddoc_bytes)))
+        return
+
+    # a real handler on the streamed listing, as a check that it parses
+    response = requests.Response()
+    response.raw = GeneratedListing(3, 10)
+    response.parsed = read_design_docs(response)
+    db = DbRecord('localhost', None, 'db')
+    process_index_data(db, response)
+    assert db.indexes['views'] == 3 and db.indexes['search'] == 3, db.indexes
+
+    print('{0:<10}{1:>8}{2:>12}{3:>18}'.format('', 'rows', 'seconds', 'peak RSS growth'))
+    for way in ['whole', 'streamed']:
+        out = subprocess.check_output([sys.executable, __file__, '--ddocs', str(args.ddocs),
+                                       '--ddoc-bytes', str(args.ddoc_bytes), '--way', way])
+        result = json.loads(out.decode('utf-8'))
+        print('{0:<10}{1:>8}{2:>12.3f}{3:>15.1f} MB'.format(way, result['rows'], result['seconds'],
+                                                              result['rss_kb'] / 1024.0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Memory held per database and per index while a scan is running: the plain
+dicts xray used to keep against the compact records it keeps now.
+
+    $ python benchmarks/bench_memory.py --count 100000
+
+Each representation is built in its own process and measured twice: as
+the deep size of one object (sys.getsizeof over everything it refers to)
+and as the growth in peak RSS from holding --count of them.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'xray'))
+
+from records import DbRecord, IndexRecord
+
+ROOT_URL = 'https://account.cloudant.com'
+HOST = 'account.cloudant.com'
+
+# shaped like a Cloudant db info response
+DB_INFO = {
+    'update_seq': '1234-g1AAAAFTeJzLYWBgYMlgTmFQSElKzi9KdUhJMtJLykxPyilN1UvOyS9NScwr0ctLLckBKmRKZEiy____f1YGkwMDwxmQAKtBlEfIR4hgOQkFSxsD0TnuX9iALgz8xwVsDA1w',
+    'db_name': 'db000000',
+    'purge_seq': '0-g1AAAAFTeJzLYWBgYMlgTmFQSElKzi9KdUhJMtJLykxPyilN1UvOyS9NScwr0ctLLckBKmRKZEiy',
+    'sizes': {'file': 1327342, 'external': 482117, 'active': 932114},
+    'other': {'data_size': 482117},
+    'doc_del_count': 128,
+    'doc_count': 4096,
+    'disk_size': 1327342,
+    'disk_format_version': 8,
+    'data_size': 932114,
+    'compact_running': False,
+    'cluster': {'q': 16, 'n': 3, 'w': 2, 'r': 2},
+    'instance_start_time': '0',
+    'props': {},
+}
+
+INDEX_ROW = {
+    'db_name': 'db000000',
+    'ddoc': '_design/reports',
+    'type': 'view',
+    'name': 'by_customer_and_date',
+    'size_bytes': 88123456,
+    'dbcopy': '',
+    'reduce': True,
+    'custom_reduce': False,
+}
+
+
+def deep_size(obj, seen=None):
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(x, seen) for x in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_size(getattr(obj, k), seen) for k in obj.__slots__)
+    return size
+
+
+def make_db_dict(i):
+    # the page entry, updated with the whole info response, as before
+    name = 'db{0:06d}'.format(i)
+    db = {'url': ROOT_URL + '/' + name, 'root_url': ROOT_URL, 'name': name, 'host': HOST}
+    db.update(json.loads(json.dumps(DB_INFO)))
+    db['backend'] = 'bm-cc-uk-04'
+    return db
+
+
+def make_db_record(i):
+    db = DbRecord(HOST, ROOT_URL, 'db{0:06d}'.format(i))
+    db.add_info(json.loads(json.dumps(DB_INFO)), 'bm-cc-uk-04')
+    return db
+
+
+def make_index_dict(i):
+    row = dict(INDEX_ROW)
+    row['db_name'] = 'db{0:06d}'.format(i)
+    row['host'] = HOST
+    return row
+
+
+def make_index_record(i):
+    row = IndexRecord.from_dict(INDEX_ROW)
+    row.db_name = 'db{0:06d}'.format(i)
+    row.host = HOST
+    return row
+
+
+MAKERS = {
+    'db dict': make_db_dict,
+    'db record': make_db_record,
+    'index dict': make_index_dict,
+    'index record': make_index_record,
+}
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KB elsewhere
+    return rss / 1024 if sys.platform == 'darwin' else rss
+
+
+def measure(kind, count):
+    make = MAKERS[kind]
+    before = peak_rss_kb()
+    held = [make(i) for i in range(count)]
+    after = peak_rss_kb()
+    return {'kind': kind, 'deep_bytes': deep_size(held[0]),
+            'rss_bytes_per_item': (after - before) * 1024.0 / count}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--count', type=int, default=100000, help='Items to hold per measurement.')
+    parser.add_argument('--kind', choices=sorted(MAKERS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.kind:
+        print(json.dumps(measure(args.kind, args.count)))
+        return
+
+    print('{0:<14}{1:>14}{2:>18}'.format('', 'deep bytes', 'RSS bytes/item'))
+    for kind in ['db dict', 'db record', 'index dict', 'index record']:
+        out = subprocess.check_output([sys.executable, __file__, '--count', str(args.count), '--kind', kind])
+        result = json.loads(out.decode('utf-8'))
+        print('{0:<14}{1:>14}{2:>18.0f}'.format(kind, result['deep_bytes'], result['rss_bytes_per_item']))
+
+
+if __name__ == '__main__':
+    main()
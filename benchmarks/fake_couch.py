@@ -0,0 +1,458 @@
+"""
+A fake CouchDB/Cloudant server for benchmarking xray offline.
+
+Serves generated databases with deterministic doc counts, sizes, shard maps
+and design docs:
+
+    GET  /                                   welcome
+    GET  /_all_dbs                           with startkey/skip/limit paging
+    POST /_dbs_info                          unless --legacy
+    GET  /{db}                               db info, with cluster q/n unless --legacy
+    GET  /{db}/_shards
+    GET  /{db}/_all_docs                     design docs, with include_docs, one row per
+                                             line and chunked, as CouchDB sends them
+    GET  /{db}/_design/{ddoc}/_info
+    GET  /{db}/_design/{ddoc}/_search_info/{index}
+    GET  /{db}/_design/{ddoc}/_geo_info/{index}
+    GET  /_db_updates                        feed=normal, since a seq or now
+    GET  /_active_tasks                      indexer, compaction and replication tasks
+    GET  /_scheduler/jobs                    replications
+
+With --churn, that many writes a second land on random dbs, adding to
+their doc counts and showing up in _db_updates. Latency, 429s (with
+Retry-After) and 500s can be injected. Run it on its
+own to point xray at it:
+
+    $ python benchmarks/fake_couch.py --port 5984 --dbs 10000 --latency 0.005
+    $ xray --url http://localhost:5984 databases -s -dd
+"""
+import argparse
+import bisect
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, unquote, urlparse
+
+BACKEND = 'bm-cc-bench-01'
+
+
+class Config(object):
+    """Shape of the generated account and the faults to inject."""
+
+    def __init__(self, dbs=1000, ddocs=2, views=3, search=1, geo=0, ddoc_every=1, ddoc_bytes=0,
+                 nodes=6, q=16, n=3, legacy=False, churn=0.0,
+                 latency=0.0, throttle=0.0, errors=0.0, retry_after=1, seed=0):
+        self.dbs = dbs
+        self.ddocs = ddocs
+        self.ddoc_bytes = ddoc_bytes
+        self.views = views
+        self.search = search
+        self.geo = geo
+        self.ddoc_every = ddoc_every
+        self.nodes = nodes
+        self.q = q
+        self.n = n
+        self.legacy = legacy
+        self.churn = churn
+        self.latency = latency
+        self.throttle = throttle
+        self.errors = errors
+        self.retry_after = retry_after
+        self.seed = seed
+
+
+class Account(object):
+    """The generated databases. Everything about db i is derived from i."""
+
+    def __init__(self, config):
+        self.config = config
+        self.names = ['db{0:07d}'.format(i) for i in range(config.dbs)]
+        self.nodes = ['dbcore@db{0}.bench.cloudant.net'.format(i + 1) for i in range(config.nodes)]
+        self.started = time.time()
+        self.rng = random.Random(config.seed + 1)
+        # db index -> docs written since the server started
+        self.writes = defaultdict(int)
+        # db index of every write, in update seq order
+        self.updates = []
+
+    def index_of(self, name):
+        i = bisect.bisect_left(self.names, name)
+        if i < len(self.names) and self.names[i] == name:
+            return i
+        return None
+
+    def all_dbs(self, startkey=None, skip=0, limit=None):
+        start = 0 if startkey is None else bisect.bisect_left(self.names, startkey)
+        start = start + skip
+        end = len(self.names) if limit is None else start + limit
+        return self.names[start:end]
+
+    def advance(self, now):
+        """Apply the writes due by now."""
+        due = int((now - self.started) * self.config.churn)
+        while len(self.updates) < due:
+            i = self.rng.randrange(len(self.names))
+            self.writes[i] += 1000
+            self.updates.append(i)
+
+    def db_updates(self, since):
+        start = len(self.updates) if since == 'now' else int(since)
+        results = [{'db_name': self.names[i], 'type': 'updated', 'seq': str(seq + 1)}
+                   for seq, i in enumerate(self.updates[start:], start)]
+        return {'results': results, 'last_seq': str(len(self.updates))}
+
+    def shard_path(self, i, r):
+        width = 2 ** 32 // self.config.q
+        return 'shards/{0:08x}-{1:08x}/{2}.1510253312'.format(r * width, (r + 1) * width - 1, self.names[i])
+
+    def active_tasks(self):
+        """Every 13th db reindexing a design doc on each shard, every 17th
+        compacting, every 19th building a search index, and every 23rd
+        replicating to another host."""
+        now = int(time.time())
+        tasks = []
+        for i in range(len(self.names)):
+            total = self.info(i)['update_seq'].split('-')[0]
+            total = max(1, int(total) // self.config.q)
+            for r in range(self.config.q):
+                base = {'node': self.nodes[(i + r) % len(self.nodes)], 'pid': '<0.{0}.{1}>'.format(i, r),
+                        'database': self.shard_path(i, r), 'started_on': now - 60 - i % 600, 'updated_on': now,
+                        'total_changes': total, 'changes_done': total * ((i + r) % 100) // 100}
+                if i % 13 == 0:
+                    tasks.append(dict(base, type='indexer', design_document='_design/ddoc0',
+                                      progress=(i + r) % 100))
+                if i % 17 == 0 and r % 4 == 0:
+                    tasks.append(dict(base, type='database_compaction', progress=(i + r) % 100))
+                if i % 19 == 0 and self.config.search:
+                    tasks.append(dict(base, type='search_indexer', design_document='_design/ddoc0', index='search0'))
+        for i in range(0, len(self.names), 23):
+            tasks.append({'type': 'replication', 'node': self.nodes[i % len(self.nodes)],
+                          'replication_id': self.replication_id(i), 'doc_id': 'rep-' + self.names[i],
+                          'source': 'http://127.0.0.1/{0}/'.format(self.names[i]),
+                          'target': 'https://backup.example.com/{0}/'.format(self.names[i]),
+                          'continuous': True, 'changes_pending': (i * 37) % 5000, 'revisions_checked': i * 10,
+                          'docs_written': i * 10, 'started_on': now - 3600, 'updated_on': now})
+        return tasks
+
+    def replication_id(self, i):
+        return '{0:032x}+continuous'.format(i)
+
+    def scheduler_jobs(self):
+        jobs = [{'database': '_replicator', 'id': self.replication_id(i), 'doc_id': 'rep-' + self.names[i],
+                 'source': 'http://127.0.0.1/{0}/'.format(self.names[i]),
+                 'target': 'https://backup.example.com/{0}/'.format(self.names[i]),
+                 'node': self.nodes[i % len(self.nodes)], 'history': []}
+                for i in range(0, len(self.names), 23)]
+        return {'total_rows': len(jobs), 'offset': 0, 'jobs': jobs}
+
+    def info(self, i):
+        # a long-tailed spread of doc counts, so top-N has something to do
+        doc_count = (i * 7919) % 1000 * ((i % 97) + 1) * 10 + self.writes.get(i, 0)
+        doc_del_count = doc_count // 10
+        external = doc_count * 800
+        active = external + external // 4
+        info = {
+            'db_name': self.names[i],
+            'update_seq': '{0}-g1AAAAFTeJzLYWBgYMlgTmFQSElKzi9KdUhJMtJLykxPyilN1UvOyS9NScwr0'.format(doc_count + doc_del_count),
+            'purge_seq': 0,
+            'sizes': {'file': active * 2, 'external': external, 'active': active},
+            'other': {'data_size': external},
+            'doc_count': doc_count,
+            'doc_del_count': doc_del_count,
+            'disk_size': active * 2,
+            'data_size': active,
+            'disk_format_version': 8,
+            'compact_running': False,
+            'instance_start_time': '0',
+            'props': {},
+        }
+        if not self.config.legacy:
+            info['cluster'] = {'q': self.config.q, 'n': self.config.n, 'w': 2, 'r': 2}
+        return info
+
+    def shards(self, i):
+        width = 2 ** 32 // self.config.q
+        shards = {}
+        for r in range(self.config.q):
+            key = '{0:08x}-{1:08x}'.format(r * width, (r + 1) * width - 1)
+            shards[key] = [self.nodes[(i + r + c) % len(self.nodes)] for c in range(self.config.n)]
+        return {'shards': shards}
+
+    def design_docs(self, i):
+        c = self.config
+        if i % c.ddoc_every != 0:
+            return []
+
+        # map functions padded out to make design docs of about ddoc_bytes
+        padding = '/* {0} */ '.format('x' * (c.ddoc_bytes // max(1, c.views))) if c.ddoc_bytes else ''
+        docs = []
+        for d in range(c.ddocs):
+            doc = {'_id': '_design/ddoc{0}'.format(d), '_rev': '1-{0:032x}'.format(i * 31 + d)}
+            if c.views:
+                doc['views'] = dict(('view{0}'.format(v), {'map': padding + 'function(doc) { emit(doc._id, null); }',
+                                                           'reduce': '_count' if v % 2 == 0 else 'function(k, v) { return sum(v); }'})
+                                    for v in range(c.views))
+            if c.search:
+                doc['indexes'] = dict(('search{0}'.format(s), {'index': 'function(doc) { index("default", doc._id); }'})
+                                      for s in range(c.search))
+            if c.geo:
+                doc['st_indexes'] = dict(('geo{0}'.format(g), {'index': 'function(doc) { st_index(doc.geometry); }'})
+                                         for g in range(c.geo))
+            docs.append(doc)
+        return docs
+
+    def view_info(self, i, ddoc):
+        size = (i % 1000 + 1) * 4096 * (len(ddoc) % 7 + 1)
+        db_seq = int(self.info(i)['update_seq'].split('-')[0])
+        # every 7th db's views trail it, and every 21st has queries waiting
+        behind = min(db_seq, (i % 50) * 100) if i % 7 == 0 else 0
+        return {'name': ddoc.split('/', 1)[-1],
+                'view_index': {'signature': '{0:032x}'.format(i), 'language': 'javascript',
+                               'disk_size': size, 'data_size': size // 2,
+                               'sizes': {'file': size, 'active': size // 2, 'external': size // 3},
+                               'update_seq': db_seq - behind, 'purge_seq': 0,
+                               'updater_running': behind > 0 and i % 2 == 0, 'compact_running': i % 11 == 0,
+                               'waiting_clients': 2 if behind > 0 and i % 21 == 0 else 0}}
+
+    def search_info(self, i, ddoc, index):
+        doc_count = self.info(i)['doc_count']
+        size = (doc_count + 1) * (len(index) % 5 + 2) * 300
+        return {'name': '{0}/{1}'.format(ddoc, index),
+                'search_index': {'pending_seq': doc_count, 'doc_del_count': doc_count // 20,
+                                 'doc_count': doc_count, 'disk_size': size, 'committed_seq': doc_count}}
+
+    def geo_info(self, i, ddoc, index):
+        doc_count = self.info(i)['doc_count'] // 2
+        size = (doc_count + 1) * 500
+        return {'name': '{0}/{1}'.format(ddoc, index),
+                'geo_index': {'doc_count': doc_count, 'disk_size': size, 'data_size': size // 2}}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, without waiting on delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body, headers=None):
+        data = json.dumps(body).encode('utf-8')
+        self.server.count(self.endpoint, status, len(data))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-Cloudant-Backend', BACKEND)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def reply_rows(self, rows):
+        """Reply with a listing laid out as CouchDB streams one: chunked, with
+        the header, each row and the footer on lines of their own."""
+        lines = ['{{"total_rows":{0},"offset":0,"rows":[\r\n'.format(len(rows))]
+        lines.extend(('' if k == 0 else ',') + json.dumps(row) + '\r\n' for k, row in enumerate(rows))
+        lines.append(']}\n')
+        self.server.count(self.endpoint, 200, sum(len(line) for line in lines))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('X-Cloudant-Backend', BACKEND)
+        self.end_headers()
+        for line in lines:
+            data = line.encode('utf-8')
+            self.wfile.write('{0:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def injected_fault(self):
+        """Reply with an injected 429 or 500 instead of the real response."""
+        config = self.server.config
+        roll = self.server.random()
+        if roll < config.throttle:
+            self.reply(429, {'error': 'too_many_requests', 'reason': 'You\'ve exceeded your rate limit allowance.'},
+                       {'Retry-After': str(config.retry_after)})
+            return True
+        if roll < config.throttle + config.errors:
+            self.reply(500, {'error': 'unknown_error', 'reason': 'function_clause'})
+            return True
+        return False
+
+    def route(self, method):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.split('/') if p]
+        query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        self.endpoint = endpoint_name(method, parts)
+
+        if self.server.config.latency:
+            time.sleep(self.server.config.latency)
+        if self.endpoint != '_all_dbs' and self.injected_fault():
+            return
+
+        account = self.server.account
+        if self.server.config.churn:
+            with self.server.lock:
+                account.advance(time.time())
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+            if parts == ['_dbs_info'] and not self.server.config.legacy:
+                rows = []
+                for key in body.get('keys', []):
+                    i = account.index_of(key)
+                    rows.append({'key': key, 'info': account.info(i)} if i is not None
+                                else {'key': key, 'error': 'not_found'})
+                return self.reply(200, rows)
+            return self.reply(404, {'error': 'not_found', 'reason': 'missing'})
+
+        if not parts:
+            return self.reply(200, {'couchdb': 'Welcome', 'version': '2.3.1', 'vendor': {'name': 'fake_couch'}})
+        if parts == ['_all_dbs']:
+            startkey = json.loads(query['startkey']) if 'startkey' in query else None
+            limit = int(query['limit']) if 'limit' in query else None
+            return self.reply(200, account.all_dbs(startkey, int(query.get('skip', 0)), limit))
+        if parts == ['_active_tasks']:
+            return self.reply(200, account.active_tasks())
+        if parts == ['_scheduler', 'jobs']:
+            return self.reply(200, account.scheduler_jobs())
+        if parts == ['_db_updates']:
+            with self.server.lock:
+                updates = account.db_updates(query.get('since', '0'))
+            return self.reply(200, updates)
+
+        i = account.index_of(parts[0])
+        if i is None:
+            return self.reply(404, {'error': 'not_found', 'reason': 'Database does not exist.'})
+        if len(parts) == 1:
+            return self.reply(200, account.info(i))
+        if parts[1:] == ['_shards']:
+            return self.reply(200, account.shards(i))
+        if parts[1:] == ['_all_docs']:
+            docs = account.design_docs(i)
+            return self.reply_rows([{'id': d['_id'], 'key': d['_id'], 'value': {'rev': d['_rev']}, 'doc': d}
+                                    for d in docs])
+        if len(parts) == 4 and parts[1] == '_design' and parts[3] == '_info':
+            return self.reply(200, account.view_info(i, '_design/' + parts[2]))
+        if len(parts) == 5 and parts[1] == '_design' and parts[3] in ('_search_info', '_geo_info'):
+            info = account.search_info if parts[3] == '_search_info' else account.geo_info
+            return self.reply(200, info(i, '_design/' + parts[2], parts[4]))
+        return self.reply(404, {'error': 'not_found', 'reason': 'missing'})
+
+    def do_GET(self):
+        self.route('GET')
+
+    def do_POST(self):
+        self.route('POST')
+
+
+def endpoint_name(method, parts):
+    """Endpoint a request is counted under, e.g. '{db}/_shards'."""
+    if not parts:
+        return '/'
+    if parts[0].startswith('_'):
+        return parts[0]
+    if len(parts) == 1:
+        return '{db}'
+    if parts[1] == '_design' and len(parts) > 4:
+        return '{db}/_design/{ddoc}/' + parts[3] + '/{index}'
+    if parts[1] == '_design':
+        return '{db}/_design/{ddoc}/' + '/'.join(parts[3:])
+    return '{db}/' + '/'.join(parts[1:])
+
+
+class FakeCouch(ThreadingMixIn, HTTPServer):
+    """The fake server, counting requests by endpoint and status."""
+
+    daemon_threads = True
+    # xray opens up to --connections at once
+    request_queue_size = 1024
+
+    def __init__(self, config, port=0):
+        HTTPServer.__init__(self, ('127.0.0.1', port), Handler)
+        self.config = config
+        self.account = Account(config)
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)
+        self.reset()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server_address[1])
+
+    def random(self):
+        with self.lock:
+            return self.rng.random()
+
+    def count(self, endpoint, status, size):
+        with self.lock:
+            self.requests[endpoint] += 1
+            self.statuses[status] += 1
+            self.bytes_sent += size
+
+    def reset(self):
+        with self.lock:
+            self.requests = defaultdict(int)
+            self.statuses = defaultdict(int)
+            self.bytes_sent = 0
+
+    def start(self):
+        """Serve from a background thread."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--dbs', type=int, default=1000, help='Databases in the account.')
+    parser.add_argument('--ddocs', type=int, default=2, help='Design docs per database that has any.')
+    parser.add_argument('--views', type=int, default=3, help='Views per design doc.')
+    parser.add_argument('--search', type=int, default=1, help='Search indexes per design doc.')
+    parser.add_argument('--geo', type=int, default=0, help='Geo indexes per design doc.')
+    parser.add_argument('--ddoc-every', type=int, default=1, help='Only every nth database has design docs.')
+    parser.add_argument('--ddoc-bytes', type=int, default=0, help='Pad the map functions of each design doc to about this many bytes.')
+    parser.add_argument('--legacy', action='store_true', help='No /_dbs_info and no cluster section in db info.')
+    parser.add_argument('--churn', type=float, default=0.0, help='Writes a second to random dbs, reported in /_db_updates.')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response.')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Fraction of requests answered 429.')
+    parser.add_argument('--errors', type=float, default=0.0, help='Fraction of requests answered 500.')
+    parser.add_argument('--retry-after', type=int, default=1, help='Retry-After seconds sent with 429s.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for fault injection.')
+
+
+def config_from_args(args, **overrides):
+    options = dict(dbs=args.dbs, ddocs=args.ddocs, views=args.views, search=args.search, geo=args.geo,
+                   ddoc_every=args.ddoc_every, ddoc_bytes=args.ddoc_bytes, legacy=args.legacy, churn=args.churn, latency=args.latency,
+                   throttle=args.throttle, errors=args.errors, retry_after=args.retry_after, seed=args.seed)
+    options.update(overrides)
+    return Config(**options)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fake CouchDB/Cloudant server for benchmarking xray.')
+    parser.add_argument('--port', type=int, default=5984)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = FakeCouch(config_from_args(args), args.port)
+    print('Serving {0} databases on {1}'.format(args.dbs, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
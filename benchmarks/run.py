@@ -0,0 +1,88 @@
+"""
+Benchmark xray scans against the fake server in fake_couch.py.
+
+For every scale and scenario, starts a fresh fake account, runs xray in a
+child process and reports wall time, requests sent, requests/sec and peak
+RSS of the xray process, along with the faults injected.
+
+    $ python benchmarks/run.py
+    $ python benchmarks/run.py --scales 1000,10000,100000 --latency 0.005 --throttle 0.01
+
+Scans run with --no-cache and a scratch home directory, so every run does
+the full work and nothing is left behind.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from fake_couch import FakeCouch, add_config_arguments, config_from_args
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+SCENARIOS = [
+    ('databases', ['databases', '--limit', '50']),
+    ('databases -s -dd', ['databases', '--limit', '50', '-s', '-dd']),
+    ('indexes', ['indexes', '--limit', '50']),
+]
+
+
+def run_xray(python, url, global_args, args, home):
+    """Run one scan, returning (wall seconds, peak RSS bytes, exit status)."""
+    env = dict(os.environ, HOME=home, XDG_CONFIG_HOME=os.path.join(home, '.config'))
+    command = [python, '-c', 'from xray.cli import main; main()',
+               '--no-cache', '--url', url] + global_args + args
+
+    with open(os.devnull, 'w') as devnull:
+        started = time.time()
+        child = subprocess.Popen(command, cwd=REPO, env=env, stdout=devnull, stderr=devnull)
+        _, status, usage = os.wait4(child.pid, 0)
+        elapsed = time.time() - started
+    child.returncode = status
+
+    # ru_maxrss is in bytes on macOS, KB elsewhere
+    rss = usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+    return elapsed, rss, os.WEXITSTATUS(status) if os.WIFEXITED(status) else -1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark xray against a fake CouchDB/Cloudant server.')
+    parser.add_argument('--scales', default='1000,10000', help='Comma separated numbers of databases to scan.')
+    parser.add_argument('--scenarios', default=','.join(name for name, _ in SCENARIOS),
+                        help='Comma separated scenarios to run, out of: ' + ', '.join(name for name, _ in SCENARIOS))
+    parser.add_argument('--python', default=sys.executable, help='Interpreter to run xray with.')
+    parser.add_argument('--xray-args', default='', help='Extra global xray options, e.g. "--engine threads".')
+    parser.add_argument('--args', default='', help='Extra command options, e.g. "--connections 50".')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    scenarios = [(name, command) for name, command in SCENARIOS if name in args.scenarios.split(',')]
+    home = tempfile.mkdtemp(prefix='xray-bench-')
+    row = '{0:<20}{1:>9}{2:>9}{3:>10}{4:>10}{5:>10}{6:>7}{7:>7}{8:>6}'
+    print(row.format('scenario', 'dbs', 'wall s', 'requests', 'req/s', 'RSS MB', '429s', '500s', 'exit'))
+
+    try:
+        for scale in [int(s) for s in args.scales.split(',')]:
+            server = FakeCouch(config_from_args(args, dbs=scale)).start()
+            try:
+                for name, command in scenarios:
+                    server.reset()
+                    elapsed, rss, status = run_xray(args.python, server.url, args.xray_args.split(),
+                                                    command + args.args.split(), home)
+                    requests = sum(server.requests.values())
+                    print(row.format(name, scale, '{0:.2f}'.format(elapsed), requests,
+                                     '{0:.0f}'.format(requests / elapsed), '{0:.1f}'.format(rss / 1048576.0),
+                                     server.statuses[429], server.statuses[500], status))
+                    sys.stdout.flush()
+            finally:
+                server.shutdown()
+                server.server_close()
+    finally:
+        shutil.rmtree(home)
+
+
+if __name__ == '__main__':
+    main()
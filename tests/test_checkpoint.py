@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+from xray.checkpoint import Checkpoint, CheckpointBusy, NullCheckpoint, open_checkpoint
+
+ROOT = 'http://localhost:5984'
+
+
+def test_watermark_advances_over_finished_prefix(tmpdir):
+    checkpoint = Checkpoint(str(tmpdir.join('scan.jsonl')))
+    for name in ['a', 'b', 'c', 'd']:
+        checkpoint.list_db(ROOT, name)
+
+    checkpoint.finish(ROOT, 'b')
+    assert checkpoint.start_after(ROOT) == (None, 0)
+
+    checkpoint.finish(ROOT, 'a')
+    assert checkpoint.start_after(ROOT) == ('b', 2)
+
+    checkpoint.finish(ROOT, 'd')
+    assert checkpoint.start_after(ROOT) == ('b', 2)
+    assert checkpoint.is_done(ROOT, 'd')
+    checkpoint.close(completed=False)
+
+
+def test_reload_resumes_from_watermark(tmpdir):
+    path = str(tmpdir.join('scan.jsonl'))
+    checkpoint = Checkpoint(path)
+    for name in ['a', 'b', 'c', 'd']:
+        checkpoint.list_db(ROOT, name)
+    checkpoint.finish(ROOT, 'a', {'name': 'a'})
+    checkpoint.finish(ROOT, 'b', scanned=False)
+    checkpoint.finish(ROOT, 'd', {'name': 'd'})
+    checkpoint.close(completed=False)
+
+    resumed = Checkpoint(path, resume=True)
+    assert resumed.start_after(ROOT) == ('b', 2)
+    assert resumed.records == [{'name': 'a'}, {'name': 'd'}]
+    assert resumed.scanned == 2
+    # dbs below the watermark are not listed again, so only d is remembered
+    assert resumed.done == set([(ROOT, 'd')])
+    resumed.close(completed=False)
+
+
+def test_reload_skips_partial_line(tmpdir):
+    path = tmpdir.join('scan.jsonl')
+    path.write('{"db": ["http://localhost:5984", "a"]}\n{"db": ["http://loc')
+
+    checkpoint = Checkpoint(str(path), resume=True)
+    assert checkpoint.is_done(ROOT, 'a')
+    checkpoint.close(completed=False)
+
+
+def test_close_removes_completed_scan(tmpdir):
+    path = str(tmpdir.join('checkpoints', 'scan.jsonl'))
+    checkpoint = Checkpoint(path)
+    checkpoint.finish(ROOT, 'a')
+    checkpoint.close(completed=True)
+
+    assert not os.path.exists(path)
+
+
+def test_second_scan_is_locked_out(tmpdir, capsys):
+    path = str(tmpdir.join('scan.jsonl'))
+    checkpoint = Checkpoint(path)
+    with pytest.raises(CheckpointBusy):
+        Checkpoint(path)
+
+    assert isinstance(open_checkpoint(path), NullCheckpoint)
+    assert 'cannot be resumed' in capsys.readouterr().err
+    checkpoint.close(completed=False)
+
+
+def test_unresumable_scan_keeps_no_checkpoint(tmpdir):
+    path = str(tmpdir.join('scan.jsonl'))
+
+    assert isinstance(open_checkpoint(path, resumable=False), NullCheckpoint)
+    assert not os.path.exists(path)
@@ -1 +1,237 @@
-# sorry to disappoint...
+import json
+import os
+import sys
+import time
+
+import pytest
+from click.testing import CliRunner
+
+from xray import command_databases, command_watch
+from xray.cli import main
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'benchmarks'))
+from fake_couch import Config, FakeCouch  # noqa: E402
+
+DBS = 40
+
+
+@pytest.fixture(scope='module')
+def server():
+    couch = FakeCouch(Config(dbs=DBS, nodes=3, q=4, seed=1)).start()
+    yield couch
+    couch.shutdown()
+    couch.server_close()
+
+
+@pytest.fixture(autouse=True)
+def app_dir(tmpdir, monkeypatch):
+    """Keeps the scan cache, checkpoints and snapshots of each test apart."""
+    monkeypatch.setenv('HOME', str(tmpdir))
+    monkeypatch.setenv('XDG_CONFIG_HOME', str(tmpdir.join('.config')))
+    return tmpdir.join('.config', 'xray')
+
+
+def xray(server, *args):
+    # threads, since grequests would patch the test process with gevent
+    result = CliRunner().invoke(main, ['--url', server.url, '--engine', 'threads', '--no-cache'] + list(args),
+                                catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return result.output
+
+
+def table_rows(output):
+    """The rows of the table that ends output, as lists of cells."""
+    lines = output.rstrip('\n').split('\n')
+    start = max(i for i, line in enumerate(lines) if line.startswith('---'))
+    return [line.split() for line in lines[start + 1:]]
+
+
+def test_databases(server):
+    output = xray(server, 'databases', '-l', '5')
+
+    assert 'Showing 5 of {0} databases, sorted by document count descending.'.format(DBS) in output
+    rows = table_rows(output)
+    assert len(rows) == 5
+    docs = [int(row[3]) for row in rows]
+    assert docs == sorted(docs, reverse=True)
+
+
+def test_databases_shards_and_ddocs(server):
+    output = xray(server, 'databases', '-s', '-dd', '-l', '0')
+
+    assert 'Showing all {0} databases'.format(DBS) in output
+    rows = table_rows(output)
+    assert len(rows) == DBS
+    # q/n
+    assert all('4/3' in row for row in rows)
+    # v/vg/s/g/qv/qvg/qs for two design docs of 3 views and 1 search index each
+    assert all('6/2/2/0/0/0/0' in row for row in rows)
+
+
+def test_databases_compaction(server):
+    output = xray(server, 'databases', '--compaction', '-l', '5')
+
+    assert 'sorted by bytes reclaimable descending' in output
+    rows = table_rows(output)
+    reclaimable = [int(row[-1]) for row in rows]
+    assert len(rows) == 5
+    assert reclaimable == sorted(reclaimable, reverse=True)
+
+
+def test_databases_tasks(server):
+    output = xray(server, 'databases', '--tasks', '-l', '5')
+
+    assert 'background tasks' in output
+    assert 'sorted by running tasks descending' in output
+    # a db indexing and not compacting
+    assert '% / -' in output
+    assert 'None' not in output
+
+
+def test_databases_stream(server):
+    output = xray(server, 'databases', '-dd', '--stream', '--format', 'ndjson')
+
+    dbs = [json.loads(line) for line in output.split('\n') if line.startswith('{')]
+    assert sorted(db['db'] for db in dbs) == ['db{0:07d}'.format(i) for i in range(DBS)]
+    assert 'Wrote {0} of {0} databases'.format(DBS) in output
+
+
+def test_databases_resume(server, app_dir, monkeypatch):
+    get_backend = command_databases.get_backend
+    calls = []
+
+    def interrupted(response):
+        calls.append(response)
+        if len(calls) == DBS // 2:
+            raise KeyboardInterrupt
+        return get_backend(response)
+
+    # one db per response, interrupted half way through
+    monkeypatch.setattr(command_databases, 'get_backend', interrupted)
+    result = CliRunner().invoke(main, ['--url', server.url, '--engine', 'threads', '--no-cache',
+                                       'databases', '-b', '1', '-l', '0'])
+    assert result.exit_code != 0
+    assert app_dir.join('checkpoints').listdir()
+
+    monkeypatch.setattr(command_databases, 'get_backend', get_backend)
+    server.reset()
+    output = xray(server, 'databases', '-b', '1', '-l', '0', '--resume')
+    assert 'Showing all {0} databases'.format(DBS) in output
+    assert len(table_rows(output)) == DBS
+    # the dbs finished before the interrupt are not fetched again
+    assert server.requests['{db}'] < DBS
+    # a completed scan leaves no checkpoint behind
+    assert not app_dir.join('checkpoints').listdir()
+
+
+def test_indexes_sort_size(server):
+    output = xray(server, 'indexes', '--sort', 'size', '-l', '10')
+
+    assert 'Showing 10 of' in output
+    rows = table_rows(output)
+    sizes = [int(row[4]) for row in rows]
+    assert len(rows) == 10
+    assert sizes == sorted(sizes, reverse=True)
+
+
+def test_indexes_view_fragmentation(server):
+    output = xray(server, 'indexes', '-l', '0', '--format', 'csv')
+
+    rows = [line.split(',') for line in output.strip().split('\n')[1:]]
+    assert len(rows) == DBS * 8
+    # the fake server's view groups are half live data; search indexes have none
+    assert all(row[-1] == ('50%' if row[1] == 'view' else '') for row in rows)
+
+
+def test_indexes_cache(server):
+    args = ['--url', server.url, '--engine', 'threads', 'indexes', '-l', '10']
+    cold = CliRunner().invoke(main, args, catch_exceptions=False)
+    server.reset()
+    warm = CliRunner().invoke(main, args, catch_exceptions=False)
+
+    assert table_rows(warm.output) == table_rows(cold.output)
+    # every db is unchanged, by its version from a single /_dbs_info
+    # request, after the one checking the server supports it
+    assert set(server.requests) == set(['/', '_all_dbs', '_dbs_info'])
+    assert server.requests['_dbs_info'] == 2
+
+
+def test_indexes_sample_outliers():
+    couch = FakeCouch(Config(dbs=300, nodes=3, q=4, seed=1)).start()
+    try:
+        # every db is at the threshold, so every one is scanned with certainty, drawn or not
+        output = xray(couch, 'indexes', '--sample', '0.1', '--outlier-docs', '0', '-l', '1')
+    finally:
+        couch.shutdown()
+        couch.server_close()
+
+    assert 'Sampled 300 of 300 listed databases' in output
+    rows = table_rows(output)
+    assert rows[0] == ['databases', '300', '0', '300']
+    assert rows[1] == ['indexes', '2400', '0', '2400']
+
+
+def test_indexes_lag(server):
+    output = xray(server, 'indexes', '--lag', '-l', '10')
+
+    assert 'waiting clients' in output
+    assert len(table_rows(output)) == 10
+
+
+def test_nodes(server):
+    output = xray(server, 'nodes')
+
+    assert '{0} databases on 3 nodes'.format(DBS) in output
+    assert len(table_rows(output)) == 3
+
+
+def test_nodes_placement_not_cached(server):
+    args = ['--url', server.url, '--engine', 'threads', 'nodes']
+    CliRunner().invoke(main, args, catch_exceptions=False)
+    server.reset()
+    result = CliRunner().invoke(main, args, catch_exceptions=False)
+
+    assert len(table_rows(result.output)) == 3
+    # a rebalance moves shards without changing the db, so placement is read again
+    assert server.requests['{db}/_shards'] == DBS
+
+
+def test_trend(server):
+    xray(server, 'databases', '--snapshot')
+    time.sleep(0.01)
+    xray(server, 'databases', '--snapshot')
+
+    output = xray(server, 'trend', '-l', '5')
+    assert 'Comparing databases snapshot 1' in output
+    assert len(table_rows(output)) == 5
+
+
+def test_trend_indexes(server):
+    # sizes are recorded for every index, not only those shown
+    xray(server, 'indexes', '--snapshot', '-l', '10')
+    time.sleep(0.01)
+    xray(server, 'indexes', '--snapshot', '-l', '10')
+
+    output = xray(server, 'trend', '--kind', 'indexes', '-l', '0')
+    assert 'Comparing indexes snapshot 1' in output
+    rows = table_rows(output)
+    # two design docs of 3 views and 1 search index in every db
+    assert len(rows) == DBS * 8
+    # host, db, ddoc, index name, type, size and size/day
+    assert all(len(row) == 7 for row in rows)
+
+
+def test_watch(server, monkeypatch):
+    sleeps = []
+
+    def sleep(seconds):
+        # one refresh, then Ctrl-C
+        sleeps.append(seconds)
+        if len(sleeps) > 1:
+            raise KeyboardInterrupt
+
+    monkeypatch.setattr(command_watch.time, 'sleep', sleep)
+    output = xray(server, 'watch', '-l', '5', '--interval', '0')
+
+    assert 'Stopped watching' in output
+    assert len(sleeps) == 2
@@ -0,0 +1,79 @@
+import io
+import json
+
+import requests
+
+from xray.listings import iter_design_docs, read_design_docs, slim_design_doc
+
+DDOC = {
+    '_id': '_design/app',
+    'language': 'javascript',
+    'views': {'by_name': {'map': 'function (doc) { emit(doc.name) }', 'reduce': '_count'},
+              'all': {'map': 'function (doc) { emit(doc._id) }'}},
+    'indexes': {'search': {'index': 'function (doc) { index("default", doc.name) }'}},
+    'validate_doc_update': 'function () {}',
+    '_attachments': {'big.bin': {'data': 'x' * 1000}},
+}
+QUERY_DDOC = {'_id': '_design/query', 'language': 'query', 'views': {'by_age': {'map': {'fields': {'age': 'asc'}}}}}
+
+
+def response(body):
+    r = requests.Response()
+    r.status_code = 200
+    r.raw = io.BytesIO(body.encode('utf-8'))
+    return r
+
+
+def line_layout(docs):
+    """A listing laid out as CouchDB streams one: a row per line."""
+    rows = ',\r\n'.join(json.dumps({'id': d['_id'], 'key': d['_id'], 'doc': d}) for d in docs)
+    return '{"total_rows":10,"offset":3,"rows":[\r\n' + rows + '\r\n]}\n'
+
+
+def test_slim_design_doc_keeps_what_reports_use():
+    assert slim_design_doc(DDOC) == {
+        '_id': '_design/app',
+        'language': 'javascript',
+        'views': {'by_name': {'reduce': '_count'}, 'all': {}},
+        'indexes': {'search': None},
+        'validate_doc_update': True,
+    }
+    assert slim_design_doc(None) is None
+
+
+def test_line_layout():
+    rows = list(iter_design_docs(response(line_layout([DDOC, QUERY_DDOC]))))
+
+    assert [row['id'] for row in rows] == ['_design/app', '_design/query']
+    assert rows[0]['doc'] == slim_design_doc(DDOC)
+    assert rows[1]['doc']['language'] == 'query'
+
+
+def test_line_layout_with_row_split_over_lines():
+    body = line_layout([DDOC, QUERY_DDOC]).replace('"language": "query", ', '"language":\n"query", ')
+
+    assert [row['id'] for row in iter_design_docs(response(body))] == ['_design/app', '_design/query']
+
+
+def test_compact_layout():
+    body = json.dumps({'total_rows': 2, 'offset': 0,
+                       'rows': [{'id': d['_id'], 'key': d['_id'], 'doc': d} for d in [DDOC, QUERY_DDOC]]})
+
+    rows = read_design_docs(response(body))
+    assert [row['id'] for row in rows] == ['_design/app', '_design/query']
+    assert rows[0]['doc'] == slim_design_doc(DDOC)
+
+
+def test_empty_listing():
+    assert read_design_docs(response('{"total_rows":0,"offset":0,"rows":[\r\n\r\n]}\n')) == []
+    assert read_design_docs(response('{"total_rows":0,"offset":0,"rows":[]}')) == []
+
+
+def test_reports_bytes_read():
+    body = line_layout([DDOC]).replace('\r\n', '\n')
+    r = response(body)
+    sizes = []
+    r.report_size = sizes.append
+
+    read_design_docs(r)
+    assert sizes == [len(body)]
@@ -0,0 +1,76 @@
+import click
+import pytest
+
+from xray.sampling import MIN_FAMILY_SAMPLE, Estimate, Sample, name_family, start_sample
+
+ROOT = 'http://localhost:5984'
+
+
+def test_name_family_drops_trailing_ids():
+    assert name_family('userdb-6a6f686e') == 'userdb-'
+    assert name_family('db00042') == 'db'
+    assert name_family('6a6f686e6a6f686e6a6f686e') == ''
+    assert name_family('settings') == 'settings'
+
+
+def test_rare_families_are_certain():
+    sample = Sample(0.1)
+    names = ['db{0:05d}'.format(i) for i in range(MIN_FAMILY_SAMPLE * 20)]
+    sample.count(ROOT, names + ['settings'])
+
+    assert sample.is_certain(ROOT, 'settings')
+    assert not sample.is_certain(ROOT, 'db00001')
+    assert sample.probability(ROOT, 'settings') == 1.0
+    assert sample.probability(ROOT, 'db00001') == 0.1
+
+
+def test_include_draws_by_name():
+    sample = Sample(0.1)
+    names = ['db{0:05d}'.format(i) for i in range(2000)]
+    sample.count(ROOT, names)
+    included = [name for name in names if sample.include(ROOT, name)]
+
+    assert sample.listed == 2000
+    assert sample.selected == len(included)
+    assert sample.certain == 0
+    assert 100 < len(included) < 300
+    # the same dbs on a rerun
+    assert all(sample.drawn(name) for name in included)
+
+
+def test_outliers_are_certain():
+    sample = Sample(0.1)
+    sample.count(ROOT, ['db{0:05d}'.format(i) for i in range(2000)])
+    name = next(n for n in ('db{0:05d}'.format(i) for i in range(2000)) if not sample.drawn(n))
+    assert not sample.include(ROOT, name)
+
+    sample.add_outlier(ROOT, name)
+    assert sample.is_certain(ROOT, name)
+    assert (sample.certain, sample.selected) == (1, 1)
+
+    # a drawn db over the threshold is certain too, but already selected
+    drawn = next(n for n in ('db{0:05d}'.format(i) for i in range(2000)) if sample.drawn(n))
+    assert sample.include(ROOT, drawn)
+    sample.add_outlier(ROOT, drawn, included=True)
+    assert sample.probability(ROOT, drawn) == 1.0
+    assert (sample.certain, sample.selected) == (2, 2)
+
+
+def test_estimate_weights_by_probability():
+    estimate = Estimate(['docs'])
+    estimate.add(1.0, {'docs': 100})
+    estimate.add(0.1, {'docs': 10})
+    estimate.add(0.1, {})
+
+    [[field, total, interval, sampled]] = estimate.rows()
+    assert (field, total, sampled) == ('docs', 200, 110)
+    # only the db sampled at 0.1 adds variance: 0.9 / 0.01 * 100
+    assert interval == int(round(1.96 * 9000 ** 0.5))
+
+
+def test_start_sample_checks_options():
+    assert start_sample(0, False, 1) is None
+    assert start_sample(0.5, False, 1).rate == 0.5
+    for rate, resume, processes in [(1.5, False, 1), (0.5, True, 1), (0.5, False, 4)]:
+        with pytest.raises(click.UsageError):
+            start_sample(rate, resume, processes)
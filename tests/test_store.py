@@ -0,0 +1,84 @@
+from xray.records import DbRecord
+from xray.store import DbStore, Passthrough, TopN, db_key, keyed_hooks
+
+
+def record(name, host='localhost:5984'):
+    return DbRecord(host, 'http://' + host, name)
+
+
+def test_db_store_keys_by_host_and_name():
+    a = record('a')
+    other_a = record('a', host='localhost:5985')
+    store = DbStore([a, other_a])
+
+    assert len(store) == 2
+    assert store[('localhost:5984', 'a')] is a
+    assert store.get(db_key(other_a)) is other_a
+    assert ('localhost:5986', 'a') not in store
+
+
+def test_db_store_keeps_order_and_discards():
+    store = DbStore()
+    dbs = [store.add(record(name)) for name in ['c', 'a', 'b']]
+
+    store.discard(db_key(dbs[1]))
+    store.discard(('localhost:5984', 'missing'))
+
+    assert [db.name for db in store] == ['c', 'b']
+    assert store.get(db_key(dbs[1])) is None
+
+
+def test_keyed_hooks_stamp_responses():
+    class Response(object):
+        pass
+
+    response = keyed_hooks(('localhost:5984', 'a'))['response'](Response())
+    assert response.result_key == ('localhost:5984', 'a')
+
+
+def test_top_n_keeps_highest_scores():
+    top = TopN(3)
+    for score in [5, 1, 9, 3, 7, 2]:
+        top.push(score, 'item{0}'.format(score))
+
+    assert len(top) == 3
+    assert top.sorted() == ['item9', 'item7', 'item5']
+
+
+def test_top_n_push_returns_dropped_item():
+    top = TopN(2)
+    assert top.push(2, 'b') is None
+    assert top.push(3, 'c') is None
+    # too low to make the cut
+    assert top.push(1, 'a') == 'a'
+    # evicts the lowest
+    assert top.push(4, 'd') == 'b'
+    assert top.sorted() == ['d', 'c']
+
+
+def test_top_n_earlier_item_wins_ties():
+    top = TopN(2)
+    top.push(1, 'first')
+    top.push(1, 'second')
+
+    assert top.push(1, 'third') == 'third'
+    assert not top.admits(1)
+    assert top.admits(2)
+    assert top.sorted() == ['first', 'second']
+
+
+def test_top_n_limit_zero_keeps_everything():
+    top = TopN(0)
+    for score in range(100):
+        assert top.push(score, score) is None
+
+    assert top.admits(-1)
+    assert top.sorted() == list(reversed(range(100)))
+
+
+def test_passthrough_keeps_nothing():
+    top = Passthrough()
+    assert top.admits(0)
+    assert top.push(1, 'a') is None
+    assert len(top) == 0
+    assert top.sorted() == []
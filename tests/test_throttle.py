@@ -0,0 +1,91 @@
+import time
+from email.utils import formatdate
+
+from xray import throttle
+from xray.throttle import INITIAL_LIMIT, ConcurrencyLimit, RateLimit, parse_retry_after, retry_delay
+
+
+class Response(object):
+
+    def __init__(self, headers):
+        self.headers = headers
+
+
+def test_slow_start_then_additive_increase():
+    limit = ConcurrencyLimit(100)
+    assert int(limit) == INITIAL_LIMIT
+
+    for _ in range(5):
+        limit.success(time.time())
+    assert int(limit) == INITIAL_LIMIT + 5
+
+    limit.decrease(time.time())
+    assert int(limit) == (INITIAL_LIMIT + 5) // 2
+
+    # past the threshold, a whole round trip of successes adds one
+    before = limit.limit
+    for _ in range(int(before)):
+        limit.success(time.time())
+    assert before + 0.8 < limit.limit <= before + 1
+
+
+def test_limit_stays_within_bounds():
+    limit = ConcurrencyLimit(12)
+    for _ in range(10):
+        limit.success(time.time())
+    assert int(limit) == 12
+
+    for _ in range(10):
+        limit.last_decrease = 0
+        limit.decrease(time.time())
+    assert int(limit) == 1
+
+
+def test_decrease_once_per_round_trip():
+    limit = ConcurrencyLimit(100)
+    sent_at = time.time() - 1
+    limit.decrease(sent_at)
+    # a request sent before that cut saw the old limit
+    limit.decrease(sent_at)
+
+    assert int(limit) == INITIAL_LIMIT // 2
+
+
+def test_latency_compared_per_endpoint():
+    limit = ConcurrencyLimit(100)
+    limit.success(0, 0.01, '/{db}')
+    # a slow endpoint is not congestion on a fast one
+    for _ in range(20):
+        limit.success(0, 1.0, '/{db}/_all_docs')
+    assert int(limit) == INITIAL_LIMIT + 21
+
+    # congestion on the fast one cuts the limit, once for the requests in flight
+    for _ in range(20):
+        limit.success(0, 0.5, '/{db}')
+    assert int(limit) == (INITIAL_LIMIT + 21) // 2
+
+
+def test_rate_limit_spaces_requests():
+    rate = RateLimit(10)
+    assert rate.wait() == 0
+    rate.take()
+    assert 0 < rate.wait() <= 0.1
+
+    unlimited = RateLimit(0)
+    unlimited.take()
+    assert unlimited.wait() == 0
+
+
+def test_parse_retry_after_seconds_and_date():
+    assert parse_retry_after(Response({'Retry-After': '3'})) == 3.0
+    assert parse_retry_after(Response({'Retry-After': '-1'})) == 0.0
+    assert 8 < parse_retry_after(Response({'Retry-After': formatdate(time.time() + 10)})) <= 10
+    assert parse_retry_after(Response({'Retry-After': 'soon'})) is None
+    assert parse_retry_after(Response({})) is None
+    assert parse_retry_after(None) is None
+
+
+def test_retry_delay_is_capped():
+    assert 0 <= retry_delay(1) <= 2 * throttle.BACKOFF_BASE
+    assert retry_delay(50) <= throttle.BACKOFF_CAP
+    assert 5 <= retry_delay(1, retry_after=5) <= 5 + throttle.BACKOFF_BASE
@@ -0,0 +1,88 @@
+from collections import OrderedDict
+from urlparse import urlparse
+
+import click
+
+# seconds between checks for Ctrl-C while waiting on worker processes
+POLL_INTERVAL = 1
+
+
+def host_of(url):
+    """host[:port] of url, without any credentials."""
+    parsed = urlparse(url)
+    if parsed.port is None:
+        return parsed.hostname
+    return '{0}:{1}'.format(parsed.hostname, parsed.port)
+
+
+def group_by_host(urls):
+    """URLs grouped by host, in order of first appearance. Each group is
+    scanned by one process, so a host gets one connection budget however
+    many of its accounts are listed."""
+    groups = OrderedDict()
+    for url in urls:
+        groups.setdefault(host_of(url), []).append(url)
+    return groups.values()
+
+
+def redact(message, urls):
+    """message with the passwords in urls blanked out."""
+    for url in urls:
+        password = urlparse(url).password
+        if password:
+            message = message.replace(':{0}@'.format(password), ':***@')
+    return message
+
+
+def run_scan(task):
+    index, scan, ctx, urls = task
+    # worker progress bars would draw over each other
+    ctx['progress'] = False
+    try:
+        return index, scan(ctx, urls), None, ctx['metrics']
+    except Exception as e:
+        return index, None, redact('{0}: {1}'.format(type(e).__name__, e), urls), ctx['metrics']
+
+
+def scan_accounts(ctx, scan, processes):
+    """Run scan(ctx, urls) for each host's URLs in ctx['URLs'] on a pool of
+    processes, returning the results in host order.
+
+    A host whose scan fails is reported and left out of the results; the
+    other hosts are still scanned. multiprocessing is only imported once
+    --processes asks for a pool.
+    """
+    import multiprocessing
+
+    groups = group_by_host(ctx['URLs'])
+    tasks = [(i, scan, dict(ctx), urls) for i, urls in enumerate(groups)]
+    results = [None] * len(groups)
+
+    click.echo('Scanning {0} hosts on {1} processes...'.format(len(groups), min(processes, len(groups))),
+               err=ctx['status_err'])
+    pool = multiprocessing.Pool(min(processes, len(groups)))
+    try:
+        completed = pool.imap_unordered(run_scan, tasks)
+        for _ in tasks:
+            while True:
+                try:
+                    index, result, error, metrics = completed.next(POLL_INTERVAL)
+                    break
+                except multiprocessing.TimeoutError:
+                    continue
+
+            host = host_of(groups[index][0])
+            if metrics is not None:
+                ctx['metrics'].merge(metrics, index + 1)
+            if error is None:
+                results[index] = result
+                click.echo('Finished scanning {0}'.format(host), err=ctx['status_err'])
+            else:
+                click.echo('Failed to scan {0}: {1}. Continuing...'.format(host, error), err=True)
+    except BaseException:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+
+    return [scanned for scanned in results if scanned is not None]
@@ -0,0 +1,36 @@
+import json
+
+# databases listed per _all_dbs request
+PAGE_SIZE = 10000
+
+
+def iter_all_dbs(session, root_url, start_after=None, page_size=PAGE_SIZE):
+    """Yield pages of db names from root_url/_all_dbs, in order, starting
+    after the db named start_after.
+
+    Pages are requested with startkey/limit as they are consumed, so a scan
+    can start on the first page while later ones are still unread.
+    """
+    startkey = start_after
+    while True:
+        params = {'limit': page_size}
+        if startkey is not None:
+            params['startkey'] = json.dumps(startkey)
+            params['skip'] = 1
+
+        r = session.get(root_url + '/_all_dbs', params=params)
+        r.raise_for_status()
+        page = r.json()
+
+        # servers that ignore startkey/limit return every db every time
+        if startkey is not None and page and page[0] <= startkey:
+            page = [name for name in page if name > startkey]
+            if page:
+                yield page
+            return
+
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        startkey = page[-1]
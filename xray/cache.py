@@ -0,0 +1,82 @@
+import json
+import os
+import time
+
+import click
+
+# seconds between commits, so scans in other processes can write in between
+COMMIT_INTERVAL = 2
+# seconds to wait for another process to finish writing
+LOCK_TIMEOUT = 60
+
+
+def default_cache_path():
+    return os.path.join(click.get_app_dir('xray'), 'scan_cache.sqlite')
+
+
+def db_version(db):
+    """Identifies the state of a db from its info: while update_seq and sizes
+    are unchanged, so are its design docs, shards and indexes."""
+    return json.dumps([db.get('update_seq'), db.get('sizes'), db.get('other')], sort_keys=True)
+
+
+class ScanCache(object):
+    """Results of earlier scans, stored per (kind, host, db).
+
+    An entry is only returned while the db's version (see db_version) is the
+    one it was stored under. Entries older than ttl seconds are evicted when
+    the cache is opened, and the oldest entries beyond max_entries when it
+    is closed.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        # only runs that read or fill the cache load sqlite
+        import sqlite3
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.max_entries = max_entries
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS scans ('
+                          'kind TEXT, host TEXT, db TEXT, version TEXT, data TEXT, stored_at REAL, '
+                          'PRIMARY KEY (kind, host, db))')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS scans_stored_at ON scans (stored_at)')
+        self.conn.execute('DELETE FROM scans WHERE stored_at < ?', (time.time() - ttl,))
+        self.conn.commit()
+        self.last_commit = time.time()
+
+    def get(self, kind, host, db, version):
+        row = self.conn.execute('SELECT version, data FROM scans WHERE kind = ? AND host = ? AND db = ?',
+                                (kind, host, db)).fetchone()
+        if row is None or row[0] != version:
+            return None
+        return json.loads(row[1])
+
+    def put(self, kind, host, db, version, data):
+        """Store data for db, merged into any entry of the same version."""
+        cached = self.get(kind, host, db, version)
+        if cached is not None:
+            cached.update(data)
+            data = cached
+
+        self.conn.execute('INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?)',
+                          (kind, host, db, version, json.dumps(data), time.time()))
+        if time.time() - self.last_commit > COMMIT_INTERVAL:
+            self.conn.commit()
+            self.last_commit = time.time()
+
+    def close(self):
+        self.conn.execute('DELETE FROM scans WHERE rowid IN '
+                          '(SELECT rowid FROM scans ORDER BY stored_at DESC LIMIT -1 OFFSET ?)',
+                          (self.max_entries,))
+        self.conn.commit()
+        self.conn.close()
+
+
+def open_cache(ctx):
+    """The scan cache configured on the command line, or None if disabled."""
+    if ctx['no_cache']:
+        return None
+    return ScanCache(default_cache_path(), ctx['cache_ttl'] * 3600, ctx['cache_entries'])
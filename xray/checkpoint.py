@@ -0,0 +1,199 @@
+import errno
+import hashlib
+import json
+import os
+import time
+from collections import deque
+
+import click
+
+try:
+    import fcntl
+except ImportError:
+    # no file locking on Windows
+    fcntl = None
+
+# seconds between flushes of the checkpoint file
+FLUSH_INTERVAL = 2
+
+
+def default_checkpoint_path(command, urls, options):
+    """Checkpoints are per command, source URLs and result-shaping options,
+    so --resume only ever picks up a scan of the same thing."""
+    digest = hashlib.sha1(json.dumps([command, urls, options], sort_keys=True)).hexdigest()
+    return os.path.join(click.get_app_dir('xray'), 'checkpoints', '{0}-{1}.jsonl'.format(command, digest))
+
+
+class CheckpointBusy(Exception):
+    """Another scan holds the checkpoint."""
+
+
+def lock_file(path):
+    """path opened for appending and locked, or None if another scan holds
+    its lock."""
+    while True:
+        f = open(path, 'a')
+        if fcntl is None:
+            return f
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        # a scan finishing in between may have removed the file we locked
+        try:
+            if os.path.samestat(os.fstat(f.fileno()), os.stat(path)):
+                return f
+        except OSError:
+            pass
+        f.close()
+
+
+class Checkpoint(object):
+    """Append-only log of the dbs a scan has finished with.
+
+    Each finished db is logged with its result record, if it has one. dbs
+    are listed per root URL in _all_dbs order, and the watermark of a root
+    is the last db before which every listed db is finished: a resumed scan
+    lists from the watermark, skips dbs already logged as done and replays
+    the logged records.
+
+    The log is locked while the scan runs, so a second scan of the same
+    thing cannot write to it; CheckpointBusy is raised instead.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.done = set()
+        self.records = []
+        # dbs whose info was read before resuming
+        self.scanned = 0
+        # root URL -> (name, number of dbs listed up to and including it)
+        self.watermarks = {}
+        self.listed = {}
+        self.last_flush = time.time()
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = lock_file(path)
+        if self.file is None:
+            raise CheckpointBusy(path)
+
+        if resume:
+            self.load()
+        else:
+            self.file.truncate(0)
+
+    def load(self):
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # partially written line from an interrupted scan
+                    continue
+                if 'watermark' in entry:
+                    root_url, name, count = entry['watermark']
+                    self.watermarks[root_url] = (name, count)
+                else:
+                    self.done.add(tuple(entry['db']))
+                    if entry.get('scanned', True):
+                        self.scanned += 1
+                    if 'record' in entry:
+                        self.records.append(entry['record'])
+
+        # dbs up to a watermark are never listed again
+        self.done = set((root_url, name) for root_url, name in self.done
+                        if root_url not in self.watermarks or name > self.watermarks[root_url][0])
+
+    def start_after(self, root_url):
+        """The db to list root_url from, and how many dbs precede it."""
+        return self.watermarks.get(root_url, (None, 0))
+
+    def is_done(self, root_url, name):
+        return (root_url, name) in self.done
+
+    def list_db(self, root_url, name):
+        self.listed.setdefault(root_url, deque()).append(name)
+
+    def finish(self, root_url, name, record=None, scanned=True):
+        entry = {'db': [root_url, name]}
+        if record is not None:
+            entry['record'] = record
+        if not scanned:
+            entry['scanned'] = False
+        self.file.write(json.dumps(entry) + '\n')
+        self.done.add((root_url, name))
+
+        listed = self.listed.get(root_url)
+        advanced = False
+        while listed and (root_url, listed[0]) in self.done:
+            count = self.start_after(root_url)[1]
+            name = listed.popleft()
+            self.done.discard((root_url, name))
+            self.watermarks[root_url] = (name, count + 1)
+            advanced = True
+
+        if advanced and time.time() - self.last_flush > FLUSH_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        for root_url, (name, count) in self.watermarks.items():
+            self.file.write(json.dumps({'watermark': [root_url, name, count]}) + '\n')
+        self.file.flush()
+        self.last_flush = time.time()
+
+    def close(self, completed):
+        """Close the log, removing it once the scan has completed."""
+        self.flush()
+        if completed:
+            # removed while still locked, so no other scan picks it up
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+        self.file.close()
+
+
+class NullCheckpoint(object):
+    """Stands in for Checkpoint where a scan is never resumed: logs nothing
+    and has nothing to replay."""
+
+    records = []
+    scanned = 0
+
+    def start_after(self, root_url):
+        return None, 0
+
+    def is_done(self, root_url, name):
+        return False
+
+    def list_db(self, root_url, name):
+        pass
+
+    def finish(self, root_url, name, record=None, scanned=True):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self, completed):
+        pass
+
+
+def open_checkpoint(path, resume=False, resumable=True):
+    """The Checkpoint at path, or a NullCheckpoint for a scan that cannot be
+    resumed, or that runs alongside an identical scan holding the
+    checkpoint."""
+    if not resumable:
+        return NullCheckpoint()
+    try:
+        return Checkpoint(path, resume)
+    except CheckpointBusy:
+        if resume:
+            raise click.UsageError('The scan to resume is still running')
+        click.echo('An identical scan is running and holds the checkpoint, so this one cannot be resumed',
+                   err=True)
+        return NullCheckpoint()
@@ -1,11 +1,21 @@
 import click
-import requests
-import grequests
 import math
-from urlparse import urlparse
 from functools import partial
-from tabulate import tabulate
-import csv
+from itertools import chain
+from store import DbStore, Passthrough, TopN, db_key, keyed_hooks
+from scheduler import Scheduler, on_failure, read_with
+from cache import open_cache
+from all_dbs import iter_all_dbs
+from checkpoint import default_checkpoint_path, open_checkpoint
+from engines import create_engine
+from accounts import host_of, scan_accounts
+from output import FORMATS, RowWriter, format_table
+from records import DbRecord
+from metrics import close_metrics, open_metrics
+from snapshots import begin_snapshot, open_snapshots
+from sampling import Estimate, report_sample, start_sample
+from listings import read_design_docs
+from tasks import activity_score, open_activity
 
 
 @click.command()
@@ -14,34 +24,124 @@ import csv
 @click.option('--pretty-print', '-pp', is_flag=True, default=False)
 @click.option('--ddocs', '-dd', is_flag=True, default=False, help='Show ddoc stats / index counts per db. Results are listed as views, view_groups, search, geo, query views, query view groups, query search, validate_doc_update, update handlers')
 @click.option('--shards', '-s', is_flag=True, default=False, help='Show shard counts per db.')
+@click.option('--compaction', '-c', is_flag=True, default=False, help='Show file, active and view group sizes per db, with the share of the file that is fragmentation and of the docs that are deleted. Ranks dbs by the bytes compaction and purging could reclaim instead of by doc count. With --limit, dbs are cut by what their db info alone shows can be reclaimed, and the dbs kept are then re-ranked with their view groups included.')
+@click.option('--tasks', is_flag=True, default=False, help='Join the background work running on each db from /_active_tasks and /_scheduler/jobs: indexer and compaction progress, replications, changes pending and changes per second. Ranks dbs by their running tasks instead of by doc count.')
 @click.option('--shard-docs', '-qd', default=10000000, type=float, help='Recommended docs per shard.')
 @click.option('--shard-size', '-qs', default=10, type=float, help='Recommended GB per shard.')
-@click.option('--connections', '-con', default=100, help='Number of parallel connections to make to the server.')
-@click.option('--output', '-o', type=click.Path(), default=None, help='Output to the specified csv')
-def databases(obj, limit, pretty_print, ddocs, shards, shard_docs, shard_size, connections, output):
+@click.option('--connections', '-con', default=100, help='Maximum number of parallel connections to make to the server. The number in use adapts to how the server copes.')
+@click.option('--max-rps', default=0, type=float, help='Maximum requests per second to send. Set to 0 for no limit.')
+@click.option('--retries', default=5, help='Attempts to retry throttled or failed requests before giving up on them.')
+@click.option('--batch-size', '-b', default=100, help='Databases per /_dbs_info request, where the server supports it. Set to 1 to fetch db info one database at a time.')
+@click.option('--resume', is_flag=True, default=False, help='Resume an interrupted scan of the same URLs and options from its checkpoint.')
+@click.option('--processes', '-p', default=1, help='Scan the hosts of multiple source URLs in parallel on this many processes, each host with its own --connections budget. A host that fails is reported and skipped.')
+@click.option('--snapshot', is_flag=True, default=False, help='Record the doc counts, size and shard count of every database scanned in the local snapshot store, for the trend command.')
+@click.option('--sample', default=0, type=float, help='Fetch only this fraction of the databases, e.g. 0.01, and estimate the account totals from them. Databases whose name family is rare in _all_dbs are always fetched.')
+@click.option('--format', type=click.Choice(['table'] + FORMATS), default='table', help='Output format. Accepted values are table, csv and ndjson')
+@click.option('--stream', is_flag=True, default=False, help='Write each database as soon as its stats are complete, in csv or ndjson, rather than a sorted report at the end. --limit does not apply.')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Output to the specified file, as csv unless --format is given.')
+def databases(obj, limit, pretty_print, ddocs, shards, compaction, tasks, shard_docs, shard_size, connections, max_rps,
+              retries, batch_size, resume, processes, snapshot, sample, format, stream, output):
     ctx = obj
+    ctx['limit'] = limit
     ctx['shards'] = shards
+    ctx['ddocs'] = ddocs
+    ctx['compaction'] = compaction
+    ctx['tasks'] = tasks
+    ctx['sample'] = start_sample(sample, resume, processes)
+    ctx['placement'] = False
     ctx['pretty_print'] = pretty_print
     ctx['connections'] = connections
-
-    all_dbs = []
-    for root_url in obj['URLs']:
-        all_dbs = all_dbs + get_database_list(root_url)
+    ctx['max_rps'] = max_rps
+    ctx['retries'] = retries
+    ctx['batch_size'] = batch_size
+    ctx['resume'] = resume
+    # sampled scans cannot be resumed
+    ctx['resumable'] = ctx['sample'] is None
+    ctx['snapshot'] = snapshot
+    ctx['metrics'] = open_metrics(ctx)
+    ctx['emit'] = None
+
+    if output is not None and format == 'table':
+        format = 'csv'
+    if stream and format == 'table':
+        raise click.UsageError('--stream needs --format csv or ndjson, or --output')
+    if stream and processes > 1:
+        raise click.UsageError('--stream cannot be combined with --processes')
+    ctx['status_err'] = output is None and format != 'table'
+    ctx['snapshot_id'] = begin_snapshot(ctx, 'databases')
 
     ctx['shard_docs'] = float(shard_docs)
     ctx['shard_bytes'] = float(shard_size * 1073741824)
 
-    db_stats = []
-    ctx['session'] = requests.session()
+    if shards:
+        click.echo('Recommended docs/shard: {0}'.format(millify(shard_docs)), err=ctx['status_err'])
+        click.echo('Recommended shard size: {0}GB'.format(shard_size), err=ctx['status_err'])
+
+    short_headers, expanded_headers = get_headers(ctx)
+    estimate = Estimate(DB_ESTIMATES + (INDEX_ESTIMATES if ddocs else [])) if ctx['sample'] else None
+
+    if stream:
+        writer = RowWriter(output, format, expanded_headers)
+        ctx['emit'] = partial(write_db, ctx, writer)
+        if estimate is not None:
+            ctx['emit'] = partial(estimate_db, ctx, estimate, ctx['emit'])
+        db_count = scan_databases(ctx, obj['URLs'])[1]
+        writer.close()
+        click.echo('Wrote {0} of {1} databases'.format(writer.count, db_count), err=ctx['status_err'])
+        if estimate is not None:
+            report_sample(ctx, ctx['sample'], estimate)
+        close_metrics(ctx)
+        return
+
+    if estimate is not None:
+        # every sampled db is complete with its follow-ups, to be estimated from
+        top = TopN(limit)
+        ctx['emit'] = partial(estimate_db, ctx, estimate, lambda db: top.push(db_score(ctx, db), db))
+        db_count = scan_databases(ctx, obj['URLs'])[1]
+        sorted_db_stats = top.sorted()
+    elif processes > 1 and len(obj['URLs']) > 1:
+        top = TopN(limit)
+        db_count = 0
+        for host_db_stats, host_db_count in scan_accounts(ctx, scan_databases, processes):
+            for db in host_db_stats:
+                top.push(db_score(ctx, db), db)
+            db_count = db_count + host_db_count
+        sorted_db_stats = top.sorted()
+    else:
+        sorted_db_stats, db_count = scan_databases(ctx, obj['URLs'])
 
-    db_stats = get_db_info(ctx, all_dbs)
+    if shards:
+        add_recommended_q(ctx, sorted_db_stats)
+    if compaction and not tasks:
+        # view group sizes are only known once the top dbs are in
+        sorted_db_stats.sort(key=reclaimable_bytes, reverse=True)
+
+    if format == 'table':
+        order = 'running tasks' if tasks else 'bytes reclaimable' if compaction else 'document count'
+        scanned = 'sampled databases' if estimate is not None else 'databases'
+        if limit > 0 and db_count > limit:
+            click.echo('Showing {0} of {1} {2}, '.format(limit, db_count, scanned) +
+                       'sorted by {0} descending.'.format(order))
+        else:
+            click.echo('Showing all {0} {1}, '.format(db_count, scanned) +
+                       'sorted by {0} descending.'.format(order))
 
-    ## sort and limit db_stats
-    sorted_db_stats = sorted(db_stats, key=lambda x: x['doc_count'] + x['doc_del_count'], reverse=True)
+        table = map(partial(format_stats, ctx), sorted_db_stats)
+        click.echo('\n')
+        click.echo(format_table(table, short_headers))
+    else:
+        writer = RowWriter(output, format, expanded_headers)
+        for db in sorted_db_stats:
+            writer.write(format_stats_expanded(ctx, db))
+        writer.close()
+
+    if estimate is not None:
+        report_sample(ctx, ctx['sample'], estimate)
+    close_metrics(ctx)
 
-    if limit > 0:
-        sorted_db_stats = sorted_db_stats[:limit]
 
+def get_headers(ctx):
+    """Headers of the table, and of the csv and ndjson rows."""
     short_headers = ['host','cloudant backend','db',
                      'docs (total/active/deleted)',
                      'db size']
@@ -49,199 +149,461 @@ def databases(obj, limit, pretty_print, ddocs, shards, shard_docs, shard_size, c
                      'total docs', 'active docs', 'deleted docs',
                      'db size (bytes)', 'db size']
 
-    # get sharding info for each database
-    if shards:
-        click.echo('Recommended docs/shard: {0}'.format(millify(shard_docs)))
-        click.echo('Recommended shard size: {0}GB'.format(shard_size))
-
-        short_headers.extend(['q', 'recommended q (by count/size)'])
-        expanded_headers.extend(['q', 'recommended q by count', 'recommended q by size)'])
-        sorted_db_stats = get_shard_data(ctx, sorted_db_stats)
-        add_recommended_q(ctx, sorted_db_stats)
+    if ctx['shards']:
+        short_headers.extend(['q/n', 'recommended q (by count/size)'])
+        expanded_headers.extend(['q', 'n', 'recommended q by count', 'recommended q by size)',
+                                 'recommended shard copies (q*n)'])
 
-    if ddocs:
+    if ctx['ddocs']:
         short_headers.extend(['v/vg/s/g/qv/qvg/qs', 'vdu/uh'])
         expanded_headers.extend(['views', 'view groups', 'search', 'geo', 'CQ json' ,'CQ view groups', 'CQ text', 'VDUs', 'update handlers'])
-        sorted_db_stats = get_index_data(ctx, sorted_db_stats)
 
-    if output is None:
-        if limit > 0 and len(db_stats) > limit:
-            click.echo('Showing {0} of {1} databases, '.format(limit, len(db_stats)) +
-                       'sorted by document count descending.')
-        else:
-            click.echo('Showing all {0} databases, '.format(len(db_stats)) +
-                       'sorted by document count descending.')
+    if ctx['compaction']:
+        short_headers.extend(['file / active', 'fragmentation', 'deleted share',
+                              'views file / active', 'reclaimable'])
+        expanded_headers.extend(['file size (bytes)', 'active size (bytes)', 'fragmentation', 'deleted share',
+                                 'views file size (bytes)', 'views active size (bytes)',
+                                 'reclaimable (bytes)', 'reclaimable'])
 
-        table = map(partial(format_stats, ctx), sorted_db_stats)
-        click.echo('\n')
-        click.echo(tabulate(table, headers=short_headers))
-    else:
-        table = map(partial(format_stats_expanded, ctx), sorted_db_stats)
-        with open(output, 'wb') as csvfile:
-            writer = csv.writer(csvfile, dialect='excel')
-            writer.writerow(expanded_headers)
-            writer.writerows(table)
+    if ctx['tasks']:
+        short_headers.extend(['tasks', 'indexing / compacting', 'replications', 'changes pending', 'changes/s'])
+        expanded_headers.extend(['tasks', 'indexing progress', 'compaction progress', 'replications',
+                                 'changes pending', 'changes per second'])
 
+    return short_headers, expanded_headers
 
-def get_database_list(root_url):
-    all_dbs_resp = requests.get(root_url + '/_all_dbs')
-    all_dbs = all_dbs_resp.json()
-    host = urlparse(root_url).hostname
-    return map(lambda x: {'url': root_url + '/' + x,
-                          'name': x,
-                          'host': host}, all_dbs)
 
+def write_db(ctx, writer, db):
+    if ctx['shards']:
+        add_recommended_q(ctx, [db])
+    writer.write(format_stats_expanded(ctx, db))
+
+
+# account totals a --sample scan estimates, and with --ddocs the index counts
+DB_ESTIMATES = ['databases', 'total docs', 'deleted docs', 'db size (bytes)']
+INDEX_ESTIMATES = ['views', 'view_groups', 'search', 'geo', 'query_views', 'query_view_groups', 'query_search']
+
+
+def estimate_db(ctx, estimate, emit, db):
+    """Add db, once complete, to the estimated totals, then pass it on to emit."""
+    values = dict(db.indexes or {})
+    values.update({'databases': 1, 'total docs': total_docs(db), 'deleted docs': db.doc_del_count,
+                   'db size (bytes)': db.data_size})
+    estimate.add(ctx['sample'].probability(db.root_url, db.name), values)
+    emit(db)
+
+
+def scan_databases(ctx, urls):
+    """Scan the dbs on urls, returning the top ctx['limit'] dbs by db_score
+    and the number of dbs scanned."""
+    limit = ctx['limit']
+    ctx['engine'] = create_engine(ctx)
+    ctx['session'] = ctx['engine'].session
+    options = [limit, ctx['shards'], ctx['ddocs'], ctx['compaction']] + ([ctx['sample'].rate] if ctx['sample'] else [])
+    if ctx['placement']:
+        options.append('placement')
+    if ctx['tasks']:
+        options.append('tasks')
+    ctx['checkpoint'] = open_checkpoint(default_checkpoint_path('databases', urls, options), ctx['resume'],
+                                        ctx['resumable'])
+    ctx['cache'] = open_cache(ctx)
+    ctx['snapshots'] = open_snapshots(ctx)
+    ctx['activity'] = open_activity(ctx)
+    if ctx['activity'] is not None:
+        for root_url in urls:
+            ctx['activity'].fetch(ctx, root_url)
+
+    db_pages = chain.from_iterable(get_database_list(ctx, root_url) for root_url in urls)
+    try:
+        result = get_db_info(ctx, db_pages, limit, ctx['emit'])
+    except BaseException:
+        ctx['checkpoint'].close(completed=False)
+        raise
+    finally:
+        if ctx['snapshots'] is not None:
+            ctx['snapshots'].close()
+    ctx['checkpoint'].close(completed=True)
+    if ctx['cache'] is not None:
+        ctx['cache'].close()
+    return result
 
-def process_requests(ctx, rs, count, process_fun):
-    errors = 0
 
-    request_iterator = grequests.imap(rs, size=ctx['connections'])
+def get_database_list(ctx, root_url):
+    """Yield pages of the dbs on root_url, skipping any that a resumed scan
+    has already finished. With ctx['sample'], _all_dbs is listed twice:
+    once to count name families, then to yield only the sampled dbs."""
+    checkpoint = ctx['checkpoint']
+    sample = ctx['sample']
+    host = host_of(root_url)
+    start_after = checkpoint.start_after(root_url)[0]
 
-    with click.progressbar(request_iterator, length=count) as bar:
-        for r in bar:
-            if r.status_code is requests.codes.ok:
-                process_fun(r)
-            elif r.status_code is 404:
+    if sample is not None:
+        for names in iter_all_dbs(ctx['session'], root_url, start_after):
+            sample.count(root_url, names)
+
+    for names in iter_all_dbs(ctx['session'], root_url, start_after):
+        page = []
+        for x in names:
+            if sample is not None and not sample.include(root_url, x):
+                continue
+            checkpoint.list_db(root_url, x)
+            if not checkpoint.is_done(root_url, x):
+                page.append(DbRecord(host, root_url, x))
+        yield page
+
+
+def db_request(ctx, url, db, parse=None):
+    """A request for db; with parse, its body is read by parse(response) as
+    it is received (see read_with)."""
+    request = ctx['engine'].request('GET', url,
+                                    session=ctx['session'],
+                                    stream=parse is not None,
+                                    hooks=keyed_hooks(db_key(db)))
+    return read_with(request, parse) if parse is not None else request
+
+
+def total_docs(db):
+    return db.doc_count + db.doc_del_count
+
+
+def reclaimable_bytes(db):
+    """Bytes compaction could free from the db file and its view groups,
+    plus an estimate of what purging the deleted docs could: their share of
+    the db's live data."""
+    reclaimable = 0
+    if db.file_size is not None and db.active_size is not None:
+        reclaimable = max(0, db.file_size - db.active_size)
+        if total_docs(db):
+            reclaimable += db.active_size * db.doc_del_count // total_docs(db)
+    if db.views_file_size is not None:
+        reclaimable += max(0, db.views_file_size - db.views_active_size)
+    return reclaimable
+
+
+def db_score(ctx, db):
+    """What dbs are ranked by: total docs, with --compaction the bytes
+    reclaimable, as far as db info alone tells, or with --tasks their
+    running tasks."""
+    if ctx['tasks']:
+        return activity_score(db.activity)
+    if ctx['compaction']:
+        return reclaimable_bytes(db)
+    return total_docs(db)
+
+
+# follow-up results that stay valid while a db is unchanged. Shard placement
+# is not one of them: a rebalance moves shards without changing the db.
+CACHED_FIELDS = ['q', 'n', 'indexes']
+
+
+def supports_dbs_info(ctx, root_url):
+    """True if the server answers POST /_dbs_info (CouchDB 2.2+ and Cloudant)."""
+    r = ctx['session'].post(root_url + '/_dbs_info', json={'keys': []})
+    return r.status_code == 200
+
+
+def get_backend(response):
+    if 'X-Cloudant-Backend' in response.headers:
+        return response.headers['X-Cloudant-Backend']
+    return None
+
+
+def get_db_info(ctx, db_pages, limit=0, emit=None, observe=None):
+    """Fetch db info for the dbs in db_pages, returning the top limit dbs by
+    db_score and the number of dbs scanned.
+
+    Pages are consumed as the pool has room for them. Where the server
+    supports it, info is fetched ctx['batch_size'] dbs at a time from
+    /_dbs_info, falling back to one GET per db otherwise.
+
+    Info is consumed as it arrives: dbs that cannot make the top limit are
+    dropped straight away, so memory and sort cost scale with limit. Shard
+    and design doc requests for a db are queued on the same pool as soon
+    as its info arrives, and only for dbs that made the cut. Every db is
+    logged to ctx['checkpoint'] once finished with, and the records of a
+    resumed scan are replayed first. With a snapshot store in
+    ctx['snapshots'], every db is recorded in it as its info arrives. With
+    ctx['activity'], every db is joined with its running tasks as its info
+    arrives.
+
+    If emit is given, every db is passed to it as soon as its stats are
+    complete instead of being ranked, and no dbs are returned. If observe
+    is given, every db is passed to it as soon as its info arrives, ranked
+    or not.
+    """
+    db_stats = DbStore()
+    scheduler = Scheduler(ctx)
+    top = TopN(limit) if emit is None else Passthrough()
+    checkpoint = ctx['checkpoint']
+    snapshots = ctx['snapshots']
+    activity = ctx['activity']
+    scanned = [checkpoint.scanned]
+    batch_size = ctx['batch_size']
+    bulk = {}
+    # follow-up requests in flight, keyed by db
+    outstanding = {}
+
+    click.echo('Fetching db info...', err=ctx['status_err'])
+
+    def push(db):
+        dropped = top.push(db_score(ctx, db), db)
+        if dropped is not None and dropped is not db:
+            key = db_key(dropped)
+            db_stats.discard(key)
+            if outstanding.pop(key, None) is not None:
+                checkpoint.finish(dropped.root_url, dropped.name)
+        return dropped is not db
+
+    def complete(db):
+        key = db_key(db)
+        outstanding.pop(key, None)
+        db_stats.discard(key)
+        checkpoint.finish(db.root_url, db.name, db.to_dict())
+        if emit is not None:
+            emit(db)
+
+    def add_db_info(db, metadata, backend):
+        db.add_info(metadata, backend)
+        if activity is not None:
+            db.activity = activity.for_db(db.host, db.name)
+        scanned[0] += 1
+        if snapshots is not None:
+            snapshots.add_db(ctx['snapshot_id'], db)
+        if observe is not None:
+            observe(db)
+
+        if not push(db):
+            db_stats.discard(db_key(db))
+            checkpoint.finish(db.root_url, db.name)
+            return
+
+        follow_ups = get_follow_ups(ctx, db)
+        if not follow_ups:
+            complete(db)
+            return
+
+        outstanding[db_key(db)] = 0
+        queue_follow_ups(db, follow_ups)
+
+    def queue_follow_ups(db, follow_ups):
+        outstanding[db_key(db)] += len(follow_ups)
+        for url, handler in follow_ups:
+            scheduler.follow(db_request(ctx, url, db, FOLLOW_UP_PARSERS.get(handler)),
+                             partial(process_follow_up, handler),
+                             failed=partial(follow_up_failed, db_key(db)))
+
+    def process_follow_up(handler, response):
+        db = db_stats.get(response.result_key)
+        if db is None:
+            # dropped out of the top limit while the request was in flight
+            return
+
+        # a handler may need further requests before db is complete
+        more = handler(db, response)
+        if more:
+            queue_follow_ups(db, more)
+        cache_follow_ups(ctx, db)
+        follow_up_done(db)
+
+    def follow_up_failed(key):
+        # db is complete with the fields it has
+        db = db_stats.get(key)
+        if db is not None:
+            follow_up_done(db)
+
+    def follow_up_done(db):
+        key = db_key(db)
+        outstanding[key] -= 1
+        if outstanding[key] == 0:
+            complete(db)
+
+    def info_failed(dbs):
+        for db in dbs:
+            db_stats.discard(db_key(db))
+            checkpoint.finish(db.root_url, db.name, scanned=False)
+
+    def process_response(response):
+        add_db_info(db_stats[response.result_key], response.json(), get_backend(response))
+
+    def process_bulk_response(response):
+        host = response.result_key
+        backend = get_backend(response)
+        for row in response.json():
+            db = db_stats[(host, row['key'])]
+            if 'info' not in row:
                 # indicates database was deleted before we queried it
+                db_stats.discard(db_key(db))
+                checkpoint.finish(db.root_url, db.name, scanned=False)
                 continue
-            elif r.status_code is 500:
-                errors = errors + 1
-                click.echo('500 error processing {0}. Continuing...' + r.url, err=True)
-            else:
-                click.echo(r.status_code)
-                r.raise_for_status()
+            add_db_info(db, row['info'], backend)
+
+    def requests_for(page):
+        root_url = page[0].root_url
+        if root_url not in bulk:
+            bulk[root_url] = batch_size > 1 and supports_dbs_info(ctx, root_url)
+
+        if not bulk[root_url]:
+            scheduler.expect(len(page))
+            for d in page:
+                request = db_request(ctx, d.url, db_stats.add(d))
+                yield on_failure(request, partial(info_failed, [d])), process_response
+            return
+
+        scheduler.expect(int(math.ceil(len(page) / float(batch_size))))
+        for i in range(0, len(page), batch_size):
+            batch = [db_stats.add(d) for d in page[i:i + batch_size]]
+            request = ctx['engine'].request('POST', root_url + '/_dbs_info',
+                                            json={'keys': [d.name for d in batch]},
+                                            session=ctx['session'],
+                                            hooks=keyed_hooks(batch[0].host))
+            yield on_failure(request, partial(info_failed, batch)), process_bulk_response
+
+    for record in checkpoint.records:
+        db = DbRecord.from_dict(record)
+        push(db)
+        if emit is not None:
+            emit(db)
+
+    rs = chain.from_iterable(requests_for(page) for page in db_pages if page)
+    scheduler.run(rs)
+
+    return top.sorted(), scanned[0]
+
+
+def get_follow_ups(ctx, db):
+    """(url, handler) pairs for the follow-up requests db still needs once
+    its info is in."""
+    if ctx['cache'] is not None:
+        cached = ctx['cache'].get('databases', db.host, db.name, db.version)
+        if cached is not None:
+            # only the fields this scan asked for, so rows keep their columns
+            wanted = (['q', 'n'] if ctx['shards'] else []) + (['indexes'] if ctx['ddocs'] else [])
+            for k in wanted:
+                if k in cached:
+                    setattr(db, k, cached[k])
+
+    follow_ups = []
+    if ctx['placement'] and db.placement is None:
+        follow_ups.append((get_shards_url(db), process_shard_placement))
+    elif ctx['shards'] and db.q is None:
+        follow_ups.append((get_shards_url(db), process_shard_data))
+
+    if ctx['ddocs'] and db.indexes is None:
+        follow_ups.append((get_ddocs_url(db), process_index_data))
+
+    # view groups compact on their own, so their sizes are never cached
+    if ctx['compaction']:
+        follow_ups.append((get_view_groups_url(db), process_view_groups))
+
+    return follow_ups
+
+
+def cache_follow_ups(ctx, db):
+    if ctx['cache'] is not None:
+        ctx['cache'].put('databases', db.host, db.name, db.version,
+                         dict((k, getattr(db, k)) for k in CACHED_FIELDS if getattr(db, k) is not None))
 
-    if errors > 0:
-        click.echo('Failed to get data for {0} databases due to server errors'.format(errors))
 
+def get_shards_url(db):
+    return '{0}/_shards'.format(db.url)
 
-def find_by_db(dbs, name):
-    for index, item in enumerate(dbs):
-        if item['name'] == name:
-            return item
 
+def add_shards(db, shards):
+    db.q = len(shards)
+    db.n = max(len(nodes) for nodes in shards.values()) if shards else None
 
-def get_db_info(ctx, all_dbs):
-    db_stats = all_dbs[:]
-    rs = (grequests.get(d['url'],
-                        session=ctx['session'],
-                        headers=dict(db_name=d['name'])) for d in db_stats)
-    url_count = len(db_stats)
 
-    click.echo('Fetching db info for {0} databases...'.format(url_count))
+def process_shard_data(db, response):
+    add_shards(db, response.json()['shards'])
 
-    def process_response(response):
-        metadata = response.json()
-        if 'X-Cloudant-Backend' in response.headers:
-            metadata['backend'] = response.headers['X-Cloudant-Backend']
-        else:
-            metadata['backend'] = None
 
-        # hack to associate response with a db
-        db_name = response.request.headers['db_name']
-        find_by_db(db_stats, db_name).update(metadata)
+def process_shard_placement(db, response):
+    """Keep which nodes host each shard range of db, as well as its q and n."""
+    db.placement = response.json()['shards']
+    add_shards(db, db.placement)
 
-    process_requests(ctx, rs, url_count, process_response)
 
-    return db_stats
+def get_ddocs_url(db):
+    return '{0}/_all_docs?startkey=%22_design%252F%22&endkey=%22_design0%22&include_docs=true'.format(db.url)
 
 
-def get_shards_url(db):
-    return '{0}/_shards'.format(db['url'])
+def get_view_groups_url(db):
+    return '{0}/_all_docs?startkey=%22_design%252F%22&endkey=%22_design0%22'.format(db.url)
 
 
-def get_shard_data(ctx, db_stats):
-    rs = (grequests.get(get_shards_url(d),
-                        session=ctx['session'],
-                        headers=dict(db_name=d['name'])) for d in db_stats)
+def process_view_groups(db, response):
+    """Start the view group totals of db, returning the _info requests of
+    its design docs."""
+    db.views_file_size = 0
+    db.views_active_size = 0
+    return [('{0}/{1}/_info'.format(db.url, row['id']), process_view_group_info)
+            for row in response.json()['rows']]
 
-    url_count = len(db_stats)
 
-    click.echo('Fetching shard counts for {0} databases...'.format(url_count))
+def process_view_group_info(db, response):
+    view_index = response.json()['view_index']
+    sizes = view_index.get('sizes') or {}
+    db.views_file_size += sizes.get('file', view_index.get('disk_size', 0))
+    db.views_active_size += sizes.get('active', view_index.get('data_size', 0))
 
-    def process_response(response):
-        q = len(response.json()['shards'])
 
-        # hack to associate response with a db
-        db_name = response.request.headers['db_name']
-        find_by_db(db_stats, db_name)['q'] = q
+def process_index_data(db, response):
+    design_docs = response.parsed
+    views = 0
+    view_groups = 0
+    search = 0
+    geo = 0
+    query_views = 0
+    query_view_groups = 0
+    query_search = 0
+    vdu = 0
+    uh = 0
 
-    process_requests(ctx, rs, url_count, process_response)
+    for row in design_docs:
+        doc = row['doc']
+        is_query = False
 
-    return db_stats
+        if 'language' in doc and doc['language'] == 'query':
+            is_query = True
 
+        if 'views' in doc:
+            if is_query:
+                query_views = query_views + len(doc['views'])
+                query_view_groups = query_view_groups + 1
+            else:
+                views = views + len(doc['views'])
+                view_groups = view_groups + 1
 
-def get_ddocs_url(db):
-    return '{0}/_all_docs?startkey=%22_design%252F%22&endkey=%22_design0%22&include_docs=true'.format(db['url'])
+        if 'indexes' in doc:
+            if is_query:
+                query_search = query_search + len(doc['indexes'])
+            else:
+                search = search + len(doc['indexes'])
 
+        if 'st_indexes' in doc:
+            geo = geo + len(doc['st_indexes'])
 
-def get_index_data(ctx, db_stats):
-    rs = (grequests.get(get_ddocs_url(d),
-                        session=ctx['session'],
-                        headers=dict(db_name=d['name'])) for d in db_stats)
-    url_count = len(db_stats)
+        if 'updates' in doc:
+            uh = uh + len(doc['updates'])
 
-    click.echo('Fetching index stats for {0} databases...'.format(url_count))
+        if 'validate_doc_update' in doc:
+            vdu = vdu + 1
+
+    db.indexes = {
+        'views': views,
+        'view_groups': view_groups,
+        'search': search,
+        'geo': geo,
+        'query_views': query_views,
+        'query_view_groups': query_view_groups,
+        'query_search': query_search,
+        'validate_doc_updates': vdu,
+        'update_handlers': uh
+    }
 
-    def process_response(response):
-        design_docs = response.json()['rows']
-        views = 0
-        view_groups = 0
-        search = 0
-        geo = 0
-        query_views = 0
-        query_view_groups = 0
-        query_search = 0
-        vdu = 0
-        uh = 0
-
-        for row in design_docs:
-            doc = row['doc']
-            is_query = False
-
-            if 'language' in doc and doc['language'] == 'query':
-                is_query = True
-
-            if 'views' in doc:
-                if is_query:
-                    query_views = query_views + len(doc['views'])
-                    query_view_groups = query_view_groups + 1
-                else:
-                    views = views + len(doc['views'])
-                    view_groups = view_groups + 1
-
-            if 'indexes' in doc:
-                if is_query:
-                    query_search = query_search + len(doc['indexes'])
-                else:
-                    search = search + len(doc['indexes'])
-
-            if 'st_indexes' in doc:
-                geo = geo + len(doc['st_indexes'])
-
-            if 'updates' in doc:
-                uh = uh + len(doc['updates'])
-
-            if 'validate_doc_update' in doc:
-                vdu = vdu + 1
-
-        # hack to associate response with a db
-        db_name = response.request.headers['db_name']
-        find_by_db(db_stats, db_name)['indexes'] = {
-            'views': views,
-            'view_groups': view_groups,
-            'search': search,
-            'geo': geo,
-            'query_views': query_views,
-            'query_view_groups': query_view_groups,
-            'query_search': query_search,
-            'validate_doc_updates': vdu,
-            'update_handlers': uh
-        }
-
-    process_requests(ctx, rs, url_count, process_response)
-
-    return db_stats
+
+# follow-ups whose responses are read on the workers, by handler
+FOLLOW_UP_PARSERS = {process_index_data: read_design_docs}
 
 
 def millify(n):
@@ -263,18 +625,21 @@ def sizeof_fmt(num):
 
 def add_recommended_q(ctx, db_stats):
     for s in db_stats:
-        if 'q' in s:
-            total_docs = s['doc_count'] + s['doc_del_count']
-            size_bytes = s['other']['data_size']
-            s['q_docs'] = math.ceil((total_docs + 1.0) / ctx['shard_docs'])
-            s['q_bytes'] = math.ceil((size_bytes + 1.0) / ctx['shard_bytes'])
+        if s.q is not None:
+            total_docs = s.doc_count + s.doc_del_count
+            size_bytes = s.data_size
+            s.q_docs = math.ceil((total_docs + 1.0) / ctx['shard_docs'])
+            s.q_bytes = math.ceil((size_bytes + 1.0) / ctx['shard_bytes'])
+            # every shard range is stored n times across the cluster
+            if s.n:
+                s.shard_copies = max(s.q_docs, s.q_bytes) * s.n
 
 
 def format_stats(ctx, db_stats):
-    doc_count = db_stats['doc_count']
-    doc_del_count = db_stats['doc_del_count']
+    doc_count = db_stats.doc_count
+    doc_del_count = db_stats.doc_del_count
     doc_count_total = doc_count + doc_del_count
-    size = db_stats['other']['data_size']
+    size = db_stats.data_size
 
     if ctx['pretty_print']:
         doc_count_total = millify(doc_count_total)
@@ -282,17 +647,20 @@ def format_stats(ctx, db_stats):
         doc_del_count = millify(doc_del_count)
         size = sizeof_fmt(size)
 
-    result = [db_stats['host'], db_stats['backend'], db_stats['name'],
+    result = [db_stats.host, db_stats.backend, db_stats.name,
               '{0} / {1} / {2}'.format(doc_count_total, doc_count, doc_del_count),
               size]
 
-    if ctx['shards']:
+    if ctx['shards'] and db_stats.q is not None:
         result.extend([
-            db_stats['q'],
-            '{0}/{1}'.format(int(db_stats['q_docs']), int(db_stats['q_bytes']))])
-
-    if 'indexes' in db_stats:
-        indexes = db_stats['indexes']
+            '{0}/{1}'.format(db_stats.q, db_stats.n or '?'),
+            '{0}/{1}'.format(int(db_stats.q_docs), int(db_stats.q_bytes))])
+    elif ctx['shards']:
+        # no cluster.q in db info, and _shards could not be read
+        result.extend([None] * 2)
+
+    if db_stats.indexes is not None:
+        indexes = db_stats.indexes
         result.append('{0}/{1}/{2}/{3}/{4}/{5}/{6}'.format(indexes['views'],
             indexes['view_groups'],
             indexes['search'],
@@ -303,28 +671,58 @@ def format_stats(ctx, db_stats):
         result.append('{0}/{1}'.format(
             indexes['validate_doc_updates'],
             indexes['update_handlers']))
+    elif ctx['ddocs']:
+        result.extend([None] * 2)
+
+    if ctx['compaction']:
+        sizes = [db_stats.file_size, db_stats.active_size, db_stats.views_file_size, db_stats.views_active_size,
+                 reclaimable_bytes(db_stats)]
+        if ctx['pretty_print']:
+            sizes = [sizeof_fmt(s) if s is not None else None for s in sizes]
+        file_size, active_size, views_file_size, views_active_size, reclaimable = sizes
+        result.extend([
+            '{0} / {1}'.format(file_size, active_size),
+            format_share(fragmentation(db_stats)),
+            format_share(deleted_share(db_stats)),
+            '{0} / {1}'.format(views_file_size, views_active_size) if views_file_size is not None else None,
+            reclaimable])
+
+    if ctx['tasks'] and db_stats.activity is not None:
+        activity = db_stats.activity
+        result.extend([
+            activity['tasks'],
+            '{0} / {1}'.format(format_share(activity['indexing']) or '-', format_share(activity['compacting']) or '-'),
+            activity['replications'],
+            millify(activity['changes_pending']) if ctx['pretty_print'] else activity['changes_pending'],
+            activity['changes_rate']])
+    elif ctx['tasks']:
+        result.extend([0, None, 0, 0, 0])
 
     return result
 
 
 def format_stats_expanded(ctx, db_stats):
-    doc_count = db_stats['doc_count']
-    doc_del_count = db_stats['doc_del_count']
+    doc_count = db_stats.doc_count
+    doc_del_count = db_stats.doc_del_count
     doc_count_total = doc_count + doc_del_count
-    size = db_stats['other']['data_size']
+    size = db_stats.data_size
 
-    result = [db_stats['host'], db_stats['backend'], db_stats['name'],
+    result = [db_stats.host, db_stats.backend, db_stats.name,
               doc_count_total, doc_count, doc_del_count,
               size, sizeof_fmt(size)]
 
-    if ctx['shards']:
+    if ctx['shards'] and db_stats.q is not None:
         result.extend([
-            db_stats['q'],
-            int(db_stats['q_docs']),
-            int(db_stats['q_bytes'])])
-
-    if 'indexes' in db_stats:
-        indexes = db_stats['indexes']
+            db_stats.q,
+            db_stats.n,
+            int(db_stats.q_docs),
+            int(db_stats.q_bytes),
+            int(db_stats.shard_copies) if db_stats.shard_copies is not None else None])
+    elif ctx['shards']:
+        result.extend([None] * 5)
+
+    if db_stats.indexes is not None:
+        indexes = db_stats.indexes
         result.extend([indexes['views'],
             indexes['view_groups'],
             indexes['search'],
@@ -334,5 +732,43 @@ def format_stats_expanded(ctx, db_stats):
             indexes['query_search'],
             indexes['validate_doc_updates'],
             indexes['update_handlers']])
+    elif ctx['ddocs']:
+        result.extend([None] * 9)
+
+    if ctx['compaction']:
+        reclaimable = reclaimable_bytes(db_stats)
+        result.extend([
+            db_stats.file_size,
+            db_stats.active_size,
+            fragmentation(db_stats),
+            deleted_share(db_stats),
+            db_stats.views_file_size,
+            db_stats.views_active_size,
+            reclaimable,
+            sizeof_fmt(reclaimable)])
+
+    if ctx['tasks'] and db_stats.activity is not None:
+        activity = db_stats.activity
+        result.extend([activity['tasks'], activity['indexing'], activity['compacting'], activity['replications'],
+                       activity['changes_pending'], activity['changes_rate']])
+    elif ctx['tasks']:
+        result.extend([0, None, None, 0, 0, 0])
 
     return result
+
+
+def fragmentation(db):
+    """Share of the db file that is not live data."""
+    if not db.file_size or db.active_size is None:
+        return None
+    return max(0.0, 1 - float(db.active_size) / db.file_size)
+
+
+def deleted_share(db):
+    if not total_docs(db):
+        return None
+    return float(db.doc_del_count) / total_docs(db)
+
+
+def format_share(share):
+    return '{0:.0%}'.format(share) if share is not None else None
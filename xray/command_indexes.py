@@ -1,206 +1,669 @@
 import click
-import requests
-import grequests
 import math
 from functools import partial
-from tabulate import tabulate
-import csv
+from itertools import chain
 import json
 import urllib
+from collections import OrderedDict
+from store import Passthrough, TopN, keyed_hooks
+from scheduler import Scheduler, on_failure, read_with
+from cache import db_version, open_cache
+from all_dbs import iter_all_dbs
+from checkpoint import default_checkpoint_path, open_checkpoint
+from engines import create_engine
+from accounts import host_of, scan_accounts
+from output import FORMATS, RowWriter, format_table
+from records import IndexRecord
+from metrics import close_metrics, open_metrics
+from snapshots import begin_snapshot, open_snapshots
+from sampling import Estimate, report_sample, start_sample
+from command_databases import format_share, supports_dbs_info
+from listings import read_design_docs
+from tasks import activity_score, open_activity
 
 
 @click.command()
 @click.pass_obj
 @click.option('--limit', '-l', default=50, help='Limit results. Set to 0 for all.')
 @click.option('--pretty-print', '-pp', is_flag=True, default=False)
-@click.option('--connections', '-con', default=100, help='Number of parallel connections to make to the server.')
-@click.option('--format', type=click.Choice(['table', 'csv', 'json']), default='table', help='Output format. Accepted values are table, csv and json')
+@click.option('--connections', '-con', default=100, help='Maximum number of parallel connections to make to the server. The number in use adapts to how the server copes.')
+@click.option('--max-rps', default=0, type=float, help='Maximum requests per second to send. Set to 0 for no limit.')
+@click.option('--retries', default=5, help='Attempts to retry throttled or failed requests before giving up on them.')
+@click.option('--sort', type=click.Choice(['db', 'size']), default='db', help='Order indexes by database/_design doc or by size descending, across views, search and geo indexes.')
+@click.option('--lag', is_flag=True, default=False, help='Compare each view group with its database: how many updates it is behind, whether it is updating or compacting and how many queries are waiting on it. Ranks the views queries wait on first, then the most stale, instead of --sort.')
+@click.option('--tasks', is_flag=True, default=False, help='Join the indexer and compaction tasks running on each index from /_active_tasks: their progress, changes pending and changes per second. Ranks indexes by their running tasks instead of --sort or --lag.')
+@click.option('--format', type=click.Choice(['table', 'json'] + FORMATS), default='table', help='Output format. Accepted values are table, csv, json and ndjson')
+@click.option('--stream', is_flag=True, default=False, help='Write each index as soon as its database is complete, in csv or ndjson, rather than a sorted report at the end. --limit and --sort do not apply.')
 @click.option('--verbose', '-v', default=False)
-@click.option('--output', '-o', type=click.Path(), default=None, help='Output to the specified csv')
-def indexes(obj, limit, pretty_print, connections, format, verbose, output):
+@click.option('--resume', is_flag=True, default=False, help='Resume an interrupted scan of the same URLs and options from its checkpoint.')
+@click.option('--processes', '-p', default=1, help='Scan the hosts of multiple source URLs in parallel on this many processes, each host with its own --connections budget. A host that fails is reported and skipped.')
+@click.option('--snapshot', is_flag=True, default=False, help='Record the size of every index scanned in the local snapshot store, for the trend command.')
+@click.option('--sample', default=0, type=float, help='Fetch the indexes of only this fraction of the databases, e.g. 0.01, and estimate the account totals from them. Databases whose name family is rare in _all_dbs, or that /_dbs_info shows to hold at least --outlier-docs docs, are always fetched.')
+@click.option('--outlier-docs', default=1000000, help='With --sample, always fetch the indexes of databases with at least this many docs, deleted or not.')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Output to the specified file, as csv unless --format is given.')
+def indexes(obj, limit, pretty_print, connections, max_rps, retries, sort, lag, tasks, format, stream, verbose, resume,
+            processes, snapshot, sample, outlier_docs, output):
     ctx = obj
+    ctx['limit'] = limit
+    ctx['sort'] = 'tasks' if tasks else 'lag' if lag else sort
+    ctx['lag'] = lag
+    ctx['tasks'] = tasks
+    ctx['sample'] = start_sample(sample, resume, processes)
+    ctx['outlier_docs'] = outlier_docs
     ctx['pretty_print'] = pretty_print
     ctx['connections'] = connections
+    ctx['max_rps'] = max_rps
+    ctx['retries'] = retries
     ctx['verbose'] = verbose
+    ctx['resume'] = resume
+    # sampled scans cannot be resumed
+    ctx['resumable'] = ctx['sample'] is None
+    ctx['snapshot'] = snapshot
+    ctx['metrics'] = open_metrics(ctx)
+    ctx['emit'] = None
+
+    if output is not None and format == 'table':
+        format = 'csv'
+    if stream and format not in FORMATS:
+        raise click.UsageError('--stream needs --format csv or ndjson, or --output')
+    if stream and processes > 1:
+        raise click.UsageError('--stream cannot be combined with --processes')
+    ctx['status_err'] = output is None and format != 'table'
+    ctx['snapshot_id'] = begin_snapshot(ctx, 'indexes')
+    if lag:
+        # cached rows would carry the lag of an earlier scan
+        ctx['no_cache'] = True
+
+    table_headers = (['db name', 'type', 'ddoc', 'index name', 'size', 'dbcopy', 'reduce', 'custom_reduce', 'docs',
+                      'fragmentation'])
+    if lag:
+        table_headers.extend(['behind', 'updating', 'compacting', 'waiting clients', 'status'])
+    if tasks:
+        table_headers.extend(['tasks', 'indexing progress', 'compaction progress', 'changes pending', 'changes/s'])
+    if len(ctx['URLs']) > 1:
+        table_headers.insert(0, 'host')
+    ctx['estimate'] = Estimate(INDEX_ESTIMATES) if ctx['sample'] else None
+
+    if stream:
+        writer = RowWriter(output, format, table_headers)
+        ctx['emit'] = partial(write_index, ctx, writer)
+        index_count = scan_indexes(ctx, obj['URLs'])[1]
+        writer.close()
+        click.echo('Wrote {0} of {1} indexes'.format(writer.count, index_count), err=ctx['status_err'])
+        if ctx['estimate'] is not None:
+            report_sample(ctx, ctx['sample'], ctx['estimate'])
+        close_metrics(ctx)
+        return
+
+    if processes > 1 and len(obj['URLs']) > 1:
+        results = scan_accounts(ctx, scan_indexes, processes)
+    else:
+        results = [scan_indexes(ctx, obj['URLs'])]
+    sorted_index_stats, index_count = merge_index_data(results, limit, ctx['sort'])
 
-    # Hack - only support first URL for now
-    url = obj['URLs'][0]
-    r = requests.get(url)
+    if format == 'json':
+        if output is None:
+            click.echo(json.dumps([index_stats.to_dict() for index_stats in sorted_index_stats]))
+        else:
+            with open(output, 'wb') as jsonfile:
+                json.dump([index_stats.to_dict() for index_stats in sorted_index_stats], jsonfile)
+    elif format == 'table':
+        table = map(partial(format_stats, ctx), sorted_index_stats)
+        found = 'indexes of the sampled databases' if ctx['sample'] else 'indexes'
+        if limit > 0 and index_count > limit:
+            click.echo('Showing {0} of {1} {2}'.format(limit, index_count, found))
+        else:
+            click.echo('Showing all {0} {1}'.format(index_count, found))
+
+        click.echo('\n')
+        click.echo(format_table(table, table_headers))
+    else:
+        writer = RowWriter(output, format, table_headers)
+        for index_stats in sorted_index_stats:
+            write_index(ctx, writer, index_stats)
+        writer.close()
+
+    if ctx['estimate'] is not None:
+        report_sample(ctx, ctx['sample'], ctx['estimate'])
+    close_metrics(ctx)
+
+
+def write_index(ctx, writer, index_stats):
+    writer.write(format_stats(ctx, index_stats), index_stats.to_dict())
+
+
+def scan_indexes(ctx, urls):
+    """Scan the indexes on urls, one URL at a time, returning the top
+    ctx['limit'] of them and the number found.
+
+    Each URL may be an account or a single db. Each has its own checkpoint.
+    """
+    ctx['engine'] = create_engine(ctx)
+    ctx['session'] = ctx['engine'].session
+    ctx['cache'] = open_cache(ctx)
+    ctx['snapshots'] = open_snapshots(ctx)
+    ctx['activity'] = open_activity(ctx)
+
+    try:
+        results = [scan_url(ctx, url) for url in urls]
+    finally:
+        if ctx['snapshots'] is not None:
+            ctx['snapshots'].close()
+    if ctx['cache'] is not None:
+        ctx['cache'].close()
+    return merge_index_data(results, ctx['limit'], ctx['sort'])
+
+
+def scan_url(ctx, url):
+    limit = ctx['limit']
+    sort = ctx['sort']
+    r = ctx['session'].get(url)
     r.raise_for_status()
 
+    options = [limit, sort] + ([ctx['sample'].rate] if ctx['sample'] else [])
+    ctx['checkpoint'] = open_checkpoint(default_checkpoint_path('indexes', [url], options), ctx['resume'],
+                                        ctx['resumable'])
+
     is_db = 'db_name' in r.json()
     if is_db:
         db_name = r.json()['db_name']
-        all_dbs = [db_name]
-        ctx['URL'] = url.replace("/" + db_name, "")
-    else:
-        all_dbs_resp = requests.get(url + '/_all_dbs')
-        all_dbs = map(lambda n: urllib.quote(n, safe=''), all_dbs_resp.json())
-        ctx['URL'] = obj['URLs'][0]
-
-    ctx['session'] = requests.session()
-
-    index_stats = get_index_data(ctx, all_dbs)
-
-    if limit > 0:
-        sorted_index_stats = index_stats[:limit]
+        db_pages = [[(0, db_name)]]
+        # the db's own path, however its name was quoted
+        ctx['URL'] = url.rstrip('/').rsplit('/', 1)[0]
     else:
-        sorted_index_stats = index_stats
+        ctx['URL'] = url
+        db_pages = get_database_list(ctx, ctx['URL'])
+    if ctx['activity'] is not None:
+        ctx['activity'].fetch(ctx, ctx['URL'])
+
+    try:
+        result = get_index_data(ctx, db_pages, limit, sort, ctx['emit'])
+    except BaseException:
+        ctx['checkpoint'].close(completed=False)
+        raise
+    ctx['checkpoint'].close(completed=True)
+    return result
 
-    if len(output) > 0:
-        format = 'csv'
 
-    if format == 'json':
-        click.echo(json.dumps(sorted_index_stats))
-    else:
-        table_headers = (['db name', 'type', 'ddoc', 'index name', 'size', 'dbcopy', 'reduce', 'custom_reduce'])
-        table = map(partial(format_stats, ctx), sorted_index_stats)
-
-        if format == 'table':
-            if limit > 0 and len(index_stats) > limit:
-                click.echo('Showing {0} of {1} indexes'.format(limit, len(index_stats)))
-            else:
-                click.echo('Showing all {0} indexes'.format(len(index_stats)))
-
-            click.echo('\n')
-            click.echo(tabulate(table, headers=table_headers))
-        elif format == 'csv':
-            if output is None:
-                writer = csv.writer(click.get_text_stream('stdout'), dialect='excel')
-                writer.writerow(table_headers)
-                writer.writerows(table)
+def merge_index_data(results, limit=0, sort='db'):
+    """Merge the (top indexes, number found) results of several scans, in
+    the order the scans were listed when sorting by db."""
+    if len(results) == 1:
+        return results[0]
+
+    top = TopN(limit)
+    found = 0
+    for scan, (index_stats, index_count) in enumerate(results):
+        for position, index_metadata in enumerate(index_stats):
+            if sort == 'size':
+                top.push(index_metadata.size_bytes, index_metadata)
+            elif sort == 'lag':
+                top.push(lag_score(index_metadata), index_metadata)
+            elif sort == 'tasks':
+                top.push(activity_score(index_metadata.activity), index_metadata)
             else:
-                with open(output, 'wb') as csvfile:
-                    writer = csv.writer(csvfile, dialect='excel')
-                    writer.writerow(table_headers)
-                    writer.writerows(table)
-
-
-def process_requests(ctx, rs, count, process_fun, ordered=False):
-    errors = 0
-    index = -1
+                top.push((-scan, -position), index_metadata)
+        found = found + index_count
+    return top.sorted(), found
 
-    if ordered:
-        request_iterator = grequests.map(rs, size=ctx['connections'])
-    else:
-        request_iterator = grequests.imap(rs, size=ctx['connections'])
-
-    with click.progressbar(request_iterator, length=count) as bar:
-        for r in bar:
-            index = index + 1
-            if r.status_code is requests.codes.ok:
-                process_fun(index, r)
-            elif r.status_code is 404:
-                # indicates database was deleted before we queried it
-                continue
-            elif r.status_code is 500:
-                errors = errors + 1
-                click.echo('500 error processing {0}. Continuing...' + r.url, err=True)
-            else:
-                click.echo(r.status_code)
-                r.raise_for_status()
 
-    if errors > 0:
-        click.echo('Failed to get data for {0} requests due to server errors'.format(errors))
+def get_db_url(url, db):
+    return '{0}/{1}'.format(url, urllib.quote(db, safe=''))
 
 
 def get_ddocs_url(url, db):
-    return '{0}/{1}/_all_docs?startkey=%22_design%252F%22&endkey=%22_design0%22&include_docs=true'.format(url, db)
-
-
-def get_ddocs_info_url(url, db, ddoc):
-    return '{0}/{1}/{2}/_info'.format(url, db, ddoc)
-
-
-def get_ddocs_info(url, db, ddoc):
-    url = get_ddocs_info_url(url, db, ddoc)
-    r = requests.get(url)
-    r.raise_for_status()
-    return r.json()
-
-
-def get_index_data(ctx, db_names):
-    urls = map(partial(get_ddocs_url, ctx['URL']), db_names)
-    rs = (grequests.get(u, session=ctx['session']) for u in urls)
-    url_count = len(urls)
-    result = []
+    return '{0}/_all_docs?startkey=%22_design%252F%22&endkey=%22_design0%22&include_docs=true'.format(
+        get_db_url(url, db))
+
+
+def get_size_url(url, db, path):
+    return '{0}/{1}'.format(get_db_url(url, db), path)
+
+
+def get_size_path(index_metadata):
+    """The path, under its db, of the info that reports an index's size, or
+    None for indexes with no size to fetch. The views of a design doc share
+    one _info; search and geo indexes have an info each."""
+    ddoc = index_metadata.ddoc
+    name = urllib.quote(index_metadata.name, safe='')
+    if index_metadata.type in VIEW_TYPES:
+        return '{0}/_info'.format(ddoc)
+    if index_metadata.type in SEARCH_TYPES:
+        return '{0}/_search_info/{1}'.format(ddoc, name)
+    if index_metadata.type == 'geo':
+        return '{0}/_geo_info/{1}'.format(ddoc, name)
+    return None
+
+
+def seq_number(seq):
+    """The number in an update seq. Clustered servers send "N-opaque"
+    strings, where N sums the seqs of the db's shards."""
+    if isinstance(seq, basestring):
+        return int(seq.split('-', 1)[0])
+    return seq
+
+
+def add_index_lag(index_metadata, info, db_seq):
+    """Fill in how far a view is behind its db, from its design doc's _info
+    and the db's update seq."""
+    stats = info.get('view_index')
+    if stats is None or db_seq is None:
+        return
+    index_metadata.behind = max(0, db_seq - seq_number(stats.get('update_seq', 0)))
+    index_metadata.updater_running = stats.get('updater_running', False)
+    index_metadata.compact_running = stats.get('compact_running', False)
+    index_metadata.waiting_clients = stats.get('waiting_clients', 0)
+
+
+def lag_status(index_metadata):
+    """blocking: queries are waiting on the view right now. updating: the
+    view is catching up. stale: the next query without stale/update=false
+    waits for it to catch up."""
+    if index_metadata.behind is None:
+        return None
+    if index_metadata.waiting_clients:
+        return 'blocking'
+    if index_metadata.behind > 0 and index_metadata.updater_running:
+        return 'updating'
+    if index_metadata.behind > 0:
+        return 'stale'
+    return 'fresh'
+
+
+def lag_score(index_metadata):
+    # views with waiting queries first, then by updates behind
+    if index_metadata.behind is None:
+        return (0, -1)
+    return (index_metadata.waiting_clients or 0, index_metadata.behind)
+
+
+def get_index_size(info):
+    """(disk size, doc count) from a design doc's _info or an index's
+    _search_info or _geo_info. Views report no doc count."""
+    for key in ('view_index', 'search_index', 'geo_index'):
+        if key in info:
+            stats = info[key]
+            size = stats['disk_size'] if 'disk_size' in stats else stats.get('sizes', {}).get('file', -1)
+            return size, stats.get('doc_count')
+    return -1, None
+
+
+def get_active_size(info):
+    """Live bytes of a design doc's view group, from its _info, or None for
+    other indexes."""
+    stats = info.get('view_index')
+    if stats is None:
+        return None
+    return (stats.get('sizes') or {}).get('active', stats.get('data_size'))
+
+
+def view_fragmentation(index_metadata):
+    """Share of a view group's file that compacting it would free."""
+    if index_metadata.active_bytes is None or index_metadata.size_bytes <= 0:
+        return None
+    return max(0.0, 1 - float(index_metadata.active_bytes) / index_metadata.size_bytes)
+
+
+def index_request(ctx, url, key, parse=None):
+    """A request keyed by key; with parse, its body is read by
+    parse(response) as it is received (see read_with)."""
+    request = ctx['engine'].request('GET', url,
+                                    session=ctx['session'],
+                                    stream=parse is not None,
+                                    hooks=keyed_hooks(key))
+    return read_with(request, parse) if parse is not None else request
+
+
+VIEW_TYPES = ('view', 'CQ json')
+SEARCH_TYPES = ('search', 'CQ text')
+
+# dbs per /_dbs_info request, for db versions and when probing the dbs
+# left out of a --sample
+DBS_INFO_BATCH = 100
+# account totals a --sample scan estimates
+INDEX_ESTIMATES = ['databases', 'indexes', 'views', 'search', 'geo', 'index size (bytes)']
+
+
+def index_totals(rows):
+    """The INDEX_ESTIMATES of one db, from its index rows."""
+    sizes = {}
+    for row in rows:
+        # the views of a design doc share one size
+        key = (row.ddoc, None) if row.type in VIEW_TYPES else (row.ddoc, row.name)
+        if row.size_bytes > 0:
+            sizes[key] = row.size_bytes
+    return {'databases': 1,
+            'indexes': len(rows),
+            'views': sum(1 for row in rows if row.type in VIEW_TYPES),
+            'search': sum(1 for row in rows if row.type in SEARCH_TYPES),
+            'geo': sum(1 for row in rows if row.type == 'geo'),
+            'index size (bytes)': sum(sizes.values())}
+
+
+def get_index_rows(db_name, design_docs):
+    """Index rows for the design docs of db_name, in design doc order."""
+    rows = []
+
+    for row in design_docs:
+        doc = row['doc']
+        is_query = False
+
+        # can happen when attempting to fetch invalid design documents
+        if doc is None:
+            continue
+
+        if 'language' in doc and doc['language'] == 'query':
+            is_query = True
+
+        dbcopy = {}
+        if 'options' in doc and 'epi' in doc['options'] and 'dbcopy' in doc['options']['epi']:
+            dbcopy = doc['options']['epi']['dbcopy']
+
+        if 'views' in doc:
+            for view in doc['views']:
+                view_definition = doc['views'][view]
+                has_reduce = 'reduce' in view_definition
+                custom_reduce = has_reduce and not view_definition['reduce'] \
+                                .strip().startswith('_')
+                view_metadata = IndexRecord(db_name, doc['_id'], 'CQ json' if is_query else 'view', view,
+                                            dbcopy=view['dbcopy'] if 'dbcopy' in view else '',
+                                            reduce=has_reduce,
+                                            custom_reduce=custom_reduce)
+
+                if view in dbcopy:
+                    view_metadata.dbcopy = dbcopy[view]
+
+                rows.append(view_metadata)
+
+        if 'indexes' in doc:
+            for i in doc['indexes']:
+                rows.append(IndexRecord(db_name, doc['_id'], 'CQ text' if is_query else 'search', i))
+
+        if 'st_indexes' in doc:
+            for g in doc['st_indexes']:
+                rows.append(IndexRecord(db_name, doc['_id'], 'geo', g))
+
+    return rows
+
+
+def get_database_list(ctx, root_url):
+    """Yield pages of (index, db name) pairs for the dbs on root_url, where
+    index is the db's position in _all_dbs, skipping any that a resumed
+    scan has already finished. With ctx['sample'], _all_dbs is listed
+    twice: once to count name families, then to yield the dbs.
+    get_index_data picks the sampled ones."""
+    checkpoint = ctx['checkpoint']
+    start_after, index = checkpoint.start_after(root_url)
+
+    if ctx['sample'] is not None:
+        for names in iter_all_dbs(ctx['session'], root_url, start_after):
+            ctx['sample'].count(root_url, names)
+
+    for names in iter_all_dbs(ctx['session'], root_url, start_after):
+        page = []
+        for name in names:
+            checkpoint.list_db(root_url, name)
+            if not checkpoint.is_done(root_url, name):
+                page.append((index, name))
+            index = index + 1
+        yield page
+
+
+def get_index_data(ctx, db_pages, limit=0, sort='db', emit=None):
+    """Fetch index definitions and sizes for the (index, db name) pairs in
+    db_pages, returning the top limit indexes and the number found.
+
+    sort='db' keeps database/_design doc order, sort='size' orders by index
+    size descending, sort='lag' by lag_score and sort='tasks' by
+    activity_score. Either way indexes are pushed into a bounded TopN as
+    soon as they are complete, so only limit of them are held in memory.
+    View sizes come from each design doc's _info, and search and geo index
+    sizes and doc counts from each index's _search_info or _geo_info, all
+    queued on the same pool as soon as the db's listing arrives.
+
+    With the scan cache enabled, each db's info is fetched first, and the
+    index rows of dbs unchanged since an earlier scan come from the cache
+    instead of their design doc listing and _info. With ctx['lag'], each
+    db's info is fetched first too, and every view's _info is compared with
+    the db's update seq. Where the server supports it, that info is fetched
+    DBS_INFO_BATCH dbs at a time from /_dbs_info. With ctx['activity'], every index is joined with
+    the tasks running on it as soon as its db's listing arrives.
+
+    With ctx['sample'], only the sampled dbs are scanned. Where the server
+    supports /_dbs_info, every listed db is probed with it first, and any
+    with at least ctx['outlier_docs'] docs is scanned with certainty, drawn
+    or not. Every scanned db is added to the totals in ctx['estimate'] once
+    complete.
+
+    Every db's rows are logged to ctx['checkpoint'] once complete, and the
+    rows of a resumed scan are replayed first. With a snapshot store in
+    ctx['snapshots'], every index is recorded in it, with its size, once its
+    db is complete.
+
+    If emit is given, every index is passed to it as soon as its db is
+    complete instead of being ranked, and no indexes are returned.
+    """
+    scheduler = Scheduler(ctx)
+    top = TopN(limit) if emit is None else Passthrough()
+    cache = ctx['cache']
+    checkpoint = ctx['checkpoint']
+    snapshots = ctx['snapshots']
+    lag = ctx['lag']
+    activity = ctx['activity']
+    sample = ctx['sample']
+    estimate = ctx['estimate']
+    info_first = cache is not None or lag
+    dbs_info = (info_first or sample is not None) and supports_dbs_info(ctx, ctx['URL'])
+    probe = sample is not None and dbs_info
+    # a sampled scan needs every size for its estimate, and a snapshot for trend
+    every_size = estimate is not None or snapshots is not None
+    host = host_of(ctx['URL'])
+    found = [0]
+    # dbs with rows waiting for their size, keyed by db index
+    pending_dbs = {}
+    # update seq numbers of the dbs being compared with their views, keyed by db index
+    db_seqs = {}
 
     if ctx['verbose']:
-        click.echo('Fetching index stats for {0} databases...'.format(url_count))
+        click.echo('Fetching index stats...', err=ctx['status_err'])
+
+    def add_index(index, position, index_metadata):
+        found[0] += 1
+        index_metadata.host = host
+        if sort == 'size':
+            score = index_metadata.size_bytes
+        elif sort == 'lag':
+            score = lag_score(index_metadata)
+        elif sort == 'tasks':
+            score = activity_score(index_metadata.activity)
+        else:
+            # earliest db / design doc first
+            score = (-index, -position)
+        return top.push(score, index_metadata) is not index_metadata
+
+    def add_db_rows(index, db, rows, version, cached):
+        if activity is not None:
+            for row in rows:
+                # the views of a design doc share one indexer
+                row.activity = activity.for_index(host, db, row.ddoc,
+                                                  None if row.type in VIEW_TYPES else row.name)
+        # rows waiting for their size, keyed by the path of their info
+        waiting = OrderedDict()
+        for position, row in enumerate(rows):
+            path = get_size_path(row) if row.size_bytes < 0 else None
+            if path is not None and sort != 'db':
+                waiting.setdefault(path, []).append(row)
+            elif (add_index(index, position, row) or every_size) and path is not None:
+                waiting.setdefault(path, []).append(row)
+
+        for path in waiting:
+            scheduler.follow(index_request(ctx, get_size_url(ctx['URL'], db, path), (index, path)),
+                             process_info, failed=partial(add_sizes, index, path, None))
+
+        pending = {'db': db, 'rows': rows, 'version': version, 'waiting': waiting}
+        if waiting:
+            pending_dbs[index] = pending
+        else:
+            finish(index, pending, store=not cached)
+
+    def finish(index, pending, store=True):
+        rows = [row.to_dict() for row in pending['rows']]
+        if store and cache is not None and pending['version'] is not None:
+            # running tasks are only current for this scan
+            cache.put('indexes', host, pending['db'], pending['version'],
+                      {'rows': [dict((k, v) for k, v in row.items() if k != 'activity') for row in rows]})
+        checkpoint.finish(ctx['URL'], pending['db'], {'index': index, 'rows': rows})
+        db_seqs.pop(index, None)
+        if snapshots is not None:
+            for index_metadata in pending['rows']:
+                snapshots.add_index(ctx['snapshot_id'], index_metadata)
+        if estimate is not None:
+            estimate.add(sample.probability(ctx['URL'], pending['db']),
+                         index_totals(pending['rows']))
+        if emit is not None:
+            for index_metadata in pending['rows']:
+                emit(index_metadata)
+
+    def process_db_info(response):
+        index, db = response.result_key
+        add_db_info(index, db, response.json())
+
+    def process_bulk_info(response):
+        for (index, db), row in zip(response.result_key, response.json()):
+            if 'info' in row:
+                add_db_info(index, db, row['info'])
+            else:
+                # deleted since it was listed
+                db_failed(index, db)
+
+    def add_db_info(index, db, info):
+        version = db_version(info)
+        if lag:
+            db_seqs[index] = seq_number(info['update_seq'])
+        cached = cache.get('indexes', host, db, version) if cache is not None else None
+        if cached is not None:
+            add_db_rows(index, db, [IndexRecord.from_dict(row) for row in cached['rows']], version, True)
+        else:
+            scheduler.follow(*listing_request(index, db, version))
 
     # ['db name', 'ddoc', 'type', 'index name']
-    def process_response(index, response):
-        design_docs = response.json()['rows']
+    def process_response(response):
+        index, db, version = response.result_key
+        rows = get_index_rows(db, response.parsed)
+        add_db_rows(index, db, rows, version, False)
+
+    def process_info(response):
+        index, path = response.result_key
+        add_sizes(index, path, response.json())
+
+    def add_sizes(index, path, info):
+        # without info, the indexes are reported without a size
+        pending = pending_dbs[index]
+        size, doc_count = get_index_size(info) if info is not None else (-1, None)
+        active = get_active_size(info) if info is not None else None
+        for index_metadata in pending['waiting'].pop(path):
+            index_metadata.size_bytes = size
+            index_metadata.active_bytes = active
+            index_metadata.doc_count = doc_count
+            if lag and info is not None:
+                add_index_lag(index_metadata, info, db_seqs.get(index))
+            if sort != 'db':
+                add_index(index, None, index_metadata)
+
+        if not pending['waiting']:
+            del pending_dbs[index]
+            finish(index, pending)
+
+    def process_probe(included, response):
+        # included holds the indexes of the dbs the sample drew
+        for (index, db), row in zip(response.result_key, response.json()):
+            info = row.get('info')
+            if info is None:
+                if index in included:
+                    db_failed(index, db)
+                continue
+            if info['doc_count'] + info['doc_del_count'] >= ctx['outlier_docs']:
+                sample.add_outlier(ctx['URL'], db, included=index in included)
+            elif index not in included:
+                continue
+            add_db_info(index, db, info)
+
+    def probe_failed(included, batch):
+        batch_failed([(index, db) for index, db in batch if index in included])
+
+    def db_failed(index, db):
+        # the db is finished with, without any indexes
+        db_seqs.pop(index, None)
+        checkpoint.finish(ctx['URL'], db)
+
+    def batch_failed(batch):
+        for index, db in batch:
+            db_failed(index, db)
+
+    def listing_request(index, db, version=None):
+        request = index_request(ctx, get_ddocs_url(ctx['URL'], db), (index, db, version), read_design_docs)
+        return on_failure(request, partial(db_failed, index, db)), process_response
+
+    def dbs_info_requests(dbs, handler, failed=None):
+        """Requests for the info of dbs, (index, db name) pairs, from
+        /_dbs_info."""
+        scheduler.expect(int(math.ceil(len(dbs) / float(DBS_INFO_BATCH))))
+        for i in range(0, len(dbs), DBS_INFO_BATCH):
+            batch = dbs[i:i + DBS_INFO_BATCH]
+            request = ctx['engine'].request('POST', ctx['URL'] + '/_dbs_info',
+                                            json={'keys': [db for _, db in batch]},
+                                            session=ctx['session'],
+                                            hooks=keyed_hooks(batch))
+            if failed is not None:
+                on_failure(request, partial(failed, batch))
+            yield request, handler
+
+    def requests_for(page):
+        if sample is not None:
+            sampled = [(index, db) for index, db in page if sample.include(ctx['URL'], db)]
+            if probe:
+                # drawn dbs are probed too: one over the threshold is certain
+                included = set(index for index, _ in sampled)
+                for request in dbs_info_requests(page, partial(process_probe, included),
+                                                 partial(probe_failed, included)):
+                    yield request
+                return
+            page = sampled
+
+        if not page:
+            return
+        if info_first and dbs_info:
+            for request in dbs_info_requests(page, process_bulk_info, batch_failed):
+                yield request
+            return
+
+        scheduler.expect(len(page))
+        for index, db in page:
+            if info_first:
+                request = index_request(ctx, get_db_url(ctx['URL'], db), (index, db))
+                yield on_failure(request, partial(db_failed, index, db)), process_db_info
+            else:
+                yield listing_request(index, db)
 
-        for row in design_docs:
-            doc = row['doc']
-            is_query = False
+    for record in checkpoint.records:
+        for position, row in enumerate(record['rows']):
+            row = IndexRecord.from_dict(row)
+            add_index(record['index'], position, row)
+            if emit is not None:
+                emit(row)
 
-            # can happen when attempting to fetch invalid design documents
-            if doc is None:
-                continue
+    rs = chain.from_iterable(requests_for(page) for page in db_pages if page)
+    scheduler.run(rs)
 
-            if 'language' in doc and doc['language'] == 'query':
-                is_query = True
-
-            dbcopy = {}
-            if 'options' in doc and 'epi' in doc['options'] and 'dbcopy' in doc['options']['epi']:
-                dbcopy = doc['options']['epi']['dbcopy']
-
-            if 'views' in doc:
-                info = get_ddocs_info(ctx['URL'], db_names[index], doc['_id'])
-                for view in doc['views']:
-                    view_definition = doc['views'][view]
-                    has_reduce = 'reduce' in view_definition
-                    custom_reduce = has_reduce and not view_definition['reduce'] \
-                                    .strip().startswith('_')
-                    view_metadata = {
-                        'db_name': db_names[index],
-                        'ddoc': doc['_id'],
-                        'type': 'CQ json' if is_query else 'view',
-                        'name': view,
-                        'size_bytes': info['view_index']['disk_size'],
-                        'dbcopy': view['dbcopy'] if 'dbcopy' in view else '',
-                        'reduce': has_reduce,
-                        'custom_reduce': custom_reduce
-                    }
-
-                    if view in dbcopy:
-                        view_metadata['dbcopy'] = dbcopy[view]
-
-                    result.append(view_metadata)
-
-            if 'indexes' in doc:
-                for i in doc['indexes']:
-                    result.append({
-                        'db_name': db_names[index],
-                        'ddoc': doc['_id'],
-                        'type': 'CQ text' if is_query else 'search',
-                        'name': i,
-                        'size_bytes': -1,
-                        'dbcopy': '',
-                        'reduce': False,
-                        'custom_reduce': False
-                    })
-
-            if 'st_indexes' in doc:
-                for g in doc['st_indexes']:
-                    result.append({
-                        'db_name': db_names[index],
-                        'ddoc': doc['_id'],
-                        'type': 'geo',
-                        'name': g,
-                        'size_bytes': -1,
-                        'dbcopy': '',
-                        'reduce': False,
-                        'custom_reduce': False
-                    })
-
-        return result
-
-    process_requests(ctx, rs, url_count, process_response, ordered=True)
+    # indexes whose info could not be fetched are reported without a size
+    for index, pending in pending_dbs.items():
+        if sort != 'db':
+            for index_rows in pending['waiting'].values():
+                for index_metadata in index_rows:
+                    add_index(index, None, index_metadata)
+        finish(index, pending)
 
-    return result
+    return top.sorted(), found[0]
 
 
 def millify(n):
@@ -222,17 +685,41 @@ def sizeof_fmt(num):
 
 def format_stats(ctx, index_stats):
 
-    size = index_stats['size_bytes']
+    size = index_stats.size_bytes
     if ctx['pretty_print']:
         size = sizeof_fmt(size)
 
-    result = [index_stats['db_name'],
-              index_stats['type'],
-              index_stats['ddoc'],
-              index_stats['name'],
+    result = [index_stats.db_name,
+              index_stats.type,
+              index_stats.ddoc,
+              index_stats.name,
               size,
-              index_stats['dbcopy'],
-              'true' if index_stats['reduce'] else 'false',
-              'true' if index_stats['custom_reduce'] else 'false']
+              index_stats.dbcopy,
+              'true' if index_stats.reduce else 'false',
+              'true' if index_stats.custom_reduce else 'false',
+              index_stats.doc_count,
+              format_share(view_fragmentation(index_stats))]
+
+    if ctx['lag'] and index_stats.behind is not None:
+        result.extend([index_stats.behind,
+                       'true' if index_stats.updater_running else 'false',
+                       'true' if index_stats.compact_running else 'false',
+                       index_stats.waiting_clients,
+                       lag_status(index_stats)])
+    elif ctx['lag']:
+        result.extend([None] * 5)
+
+    if ctx['tasks'] and index_stats.activity is not None:
+        activity = index_stats.activity
+        result.extend([activity['tasks'],
+                       format_share(activity['indexing']),
+                       format_share(activity['compacting']),
+                       activity['changes_pending'],
+                       activity['changes_rate']])
+    elif ctx['tasks']:
+        result.extend([0, None, None, 0, 0])
+
+    if len(ctx['URLs']) > 1:
+        result.insert(0, index_stats.host)
 
     return result
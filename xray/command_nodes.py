@@ -0,0 +1,183 @@
+from collections import defaultdict
+from functools import partial
+
+import click
+
+from command_databases import format_share, millify, scan_databases, sizeof_fmt, total_docs
+from metrics import close_metrics, open_metrics
+from output import FORMATS, RowWriter, format_table
+
+
+@click.command()
+@click.pass_obj
+@click.option('--limit', '-l', default=50, help='Limit the nodes shown. Set to 0 for all.')
+@click.option('--pretty-print', '-pp', is_flag=True, default=False)
+@click.option('--ddocs', '-dd', is_flag=True, default=False, help='Count the index shards each node hosts too, from every database\'s design docs.')
+@click.option('--connections', '-con', default=100, help='Maximum number of parallel connections to make to the server. The number in use adapts to how the server copes.')
+@click.option('--max-rps', default=0, type=float, help='Maximum requests per second to send. Set to 0 for no limit.')
+@click.option('--retries', default=5, help='Attempts to retry throttled or failed requests before giving up on them.')
+@click.option('--batch-size', '-b', default=100, help='Databases per /_dbs_info request, where the server supports it. Set to 1 to fetch db info one database at a time.')
+@click.option('--format', type=click.Choice(['table'] + FORMATS), default='table', help='Output format. Accepted values are table, csv and ndjson')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Output the nodes to the specified file, as csv unless --format is given.')
+def nodes(obj, limit, pretty_print, ddocs, connections, max_rps, retries, batch_size, format, output):
+    """Rank the nodes holding the most data relative to the rest of their
+    backend.
+
+    Every database's shard placement from /{db}/_shards is combined with
+    its doc count and size, each split evenly across its q shard ranges,
+    and summed over the shard copies each node hosts.
+    """
+    ctx = obj
+    ctx['limit'] = 0
+    ctx['shards'] = True
+    ctx['ddocs'] = ddocs
+    ctx['compaction'] = False
+    ctx['tasks'] = False
+    ctx['sample'] = None
+    ctx['placement'] = True
+    ctx['pretty_print'] = pretty_print
+    ctx['connections'] = connections
+    ctx['max_rps'] = max_rps
+    ctx['retries'] = retries
+    ctx['batch_size'] = batch_size
+    ctx['resume'] = False
+    ctx['resumable'] = False
+    ctx['snapshot_id'] = None
+    ctx['metrics'] = open_metrics(ctx)
+
+    if output is not None and format == 'table':
+        format = 'csv'
+    ctx['status_err'] = output is None and format != 'table'
+
+    load = NodeLoad()
+    ctx['emit'] = load.add_db
+    db_count = scan_databases(ctx, ctx['URLs'])[1]
+    ranked, backends = load.ranked()
+    if load.unplaced:
+        click.echo('Left out {0} databases whose shard placement could not be read'.format(load.unplaced),
+                   err=ctx['status_err'])
+    shown = ranked[:limit] if limit > 0 else ranked
+
+    if format == 'table':
+        click.echo('{0} shard copies of {1} databases on {2} nodes, in {3} backends.'.format(
+            load.copies, db_count, len(ranked), len(backends)))
+        click.echo('\n')
+        click.echo(format_table(map(partial(format_backend, ctx), backends), BACKEND_HEADERS))
+        click.echo('\n')
+        if limit > 0 and len(ranked) > limit:
+            click.echo('Showing {0} of {1} nodes, sorted by bytes relative to their backend\'s mean descending.'.format(
+                limit, len(ranked)))
+        click.echo(format_table(map(partial(format_node, ctx), shown), NODE_HEADERS))
+    else:
+        ctx['pretty_print'] = False
+        writer = RowWriter(output, format, NODE_HEADERS)
+        for node in shown:
+            writer.write(format_node(ctx, node, expanded=True))
+        writer.close()
+
+    close_metrics(ctx)
+
+
+NODE_HEADERS = ['backend', 'node', 'shard copies', 'docs', 'bytes', 'index shards',
+                'share of backend bytes', 'bytes vs backend mean']
+BACKEND_HEADERS = ['backend', 'nodes', 'shard copies', 'docs', 'bytes', 'index shards',
+                   'busiest node', 'busiest vs mean']
+
+# totals kept per node and per backend
+FIELDS = SHARDS, DOCS, BYTES, INDEXES = range(4)
+
+
+def index_files(db):
+    """Index files in each shard range of db. The views of a design doc
+    share a file; search and geo indexes have one each."""
+    if db.indexes is None:
+        return 0
+    i = db.indexes
+    return i['view_groups'] + i['query_view_groups'] + i['search'] + i['query_search'] + i['geo']
+
+
+class NodeLoad(object):
+    """Shard copies, docs, bytes and index shards per node, summed as each
+    db arrives, so no db is kept once it is added.
+
+    A db's docs and bytes are split evenly across its shard ranges, and
+    every node hosting a copy of a range holds that share. Nodes are grouped
+    by the X-Cloudant-Backend they were reached through, or by host where
+    the server sends none.
+    """
+
+    def __init__(self):
+        # (backend, node) -> [shard copies, docs, bytes, index shards]
+        self.nodes = defaultdict(lambda: [0, 0.0, 0.0, 0])
+        self.copies = 0
+        # dbs whose _shards could not be read
+        self.unplaced = 0
+
+    def add_db(self, db):
+        if not db.placement:
+            self.unplaced += 1
+            return
+        backend = db.backend or db.host
+        q = float(len(db.placement))
+        size = db.file_size if db.file_size is not None else db.data_size
+        share = [1, total_docs(db) / q, (size or 0) / q, index_files(db)]
+        # copies per node first, so each node's totals are added to once
+        copies = defaultdict(int)
+        for nodes in db.placement.values():
+            for node in nodes:
+                copies[node] += 1
+        for node, count in copies.items():
+            totals = self.nodes[(backend, node)]
+            for k in FIELDS:
+                totals[k] += share[k] * count
+            self.copies += count
+
+    def ranked(self):
+        """(backend, node, totals, bytes vs backend mean, backend bytes) of
+        every node, the most loaded relative to its backend first, and
+        (backend, nodes, totals, busiest node, its bytes vs mean) of every
+        backend."""
+        by_backend = defaultdict(list)
+        for (backend, node), totals in self.nodes.items():
+            by_backend[backend].append((node, totals))
+
+        nodes = []
+        backends = []
+        for backend, members in sorted(by_backend.items()):
+            summed = [sum(totals[k] for _, totals in members) for k in FIELDS]
+            mean = summed[BYTES] / len(members)
+            for node, totals in members:
+                nodes.append((backend, node, totals, totals[BYTES] / mean if mean else None, summed[BYTES]))
+            busiest, totals = max(members, key=lambda member: member[1][BYTES])
+            backends.append((backend, len(members), summed, busiest, totals[BYTES] / mean if mean else None))
+
+        nodes.sort(key=lambda node: node[3], reverse=True)
+        return nodes, backends
+
+
+def format_bytes(ctx, size):
+    return sizeof_fmt(size) if ctx['pretty_print'] else int(round(size))
+
+
+def format_docs(ctx, docs):
+    return millify(docs) if ctx['pretty_print'] else int(round(docs))
+
+
+def format_ratio(ratio):
+    return '{0:.2f}x'.format(ratio) if ratio is not None else None
+
+
+def format_node(ctx, node, expanded=False):
+    backend, name, totals, ratio, backend_bytes = node
+    share = totals[BYTES] / backend_bytes if backend_bytes else None
+    result = [backend, name, totals[SHARDS], format_docs(ctx, totals[DOCS]), format_bytes(ctx, totals[BYTES]),
+              totals[INDEXES]]
+    if expanded:
+        return result + [share, ratio]
+    return result + [format_share(share), format_ratio(ratio)]
+
+
+def format_backend(ctx, backend):
+    backend, count, summed, busiest, ratio = backend
+    return [backend, count, summed[SHARDS], format_docs(ctx, summed[DOCS]), format_bytes(ctx, summed[BYTES]),
+            summed[INDEXES], busiest, format_ratio(ratio)]
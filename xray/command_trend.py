@@ -0,0 +1,192 @@
+import time
+from functools import partial
+
+import click
+
+from accounts import host_of
+from command_databases import add_recommended_q, millify, sizeof_fmt
+from output import FORMATS, RowWriter, format_table
+from records import DbRecord
+from snapshots import KINDS, SnapshotStore, default_snapshot_path
+from store import TopN
+
+SECONDS_PER_DAY = 86400.0
+
+
+@click.command()
+@click.pass_obj
+@click.option('--kind', type=click.Choice(KINDS), default='databases', help='Compare snapshots taken by the databases or the indexes command.')
+@click.option('--days', default=7, type=float, help='Compare the latest snapshot with the earliest one of the same hosts taken at most this many days before it.')
+@click.option('--from', 'first', default=None, type=int, help='Id of the earlier snapshot to compare, instead of --days.')
+@click.option('--to', 'last', default=None, type=int, help='Id of the later snapshot to compare, instead of the latest.')
+@click.option('--list', 'list_snapshots', is_flag=True, default=False, help='List the stored snapshots and exit.')
+@click.option('--sort', type=click.Choice(['docs', 'deleted', 'size']), default='docs', help='Rank databases by growth per day of total docs, deleted docs or size. Indexes are ranked by size.')
+@click.option('--limit', '-l', default=50, help='Limit results. Set to 0 for all.')
+@click.option('--shard-docs', '-qd', default=10000000, type=float, help='Recommended docs per shard.')
+@click.option('--shard-size', '-qs', default=10, type=float, help='Recommended GB per shard.')
+@click.option('--horizon', default=90, type=float, help='Days ahead to project the recommended q of each database at its current growth rate.')
+@click.option('--pretty-print', '-pp', is_flag=True, default=False)
+@click.option('--format', type=click.Choice(['table'] + FORMATS), default='table', help='Output format. Accepted values are table, csv and ndjson')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Output to the specified file, as csv unless --format is given.')
+def trend(obj, kind, days, first, last, list_snapshots, sort, limit, shard_docs, shard_size, horizon, pretty_print,
+          format, output):
+    """Rank the fastest growing databases or indexes between two snapshots
+    recorded with --snapshot. Given --url or --source, only their hosts are
+    shown."""
+    ctx = obj
+    ctx['pretty_print'] = pretty_print
+    ctx['shard_docs'] = float(shard_docs)
+    ctx['shard_bytes'] = float(shard_size * 1073741824)
+    ctx['horizon'] = horizon
+    if output is not None and format == 'table':
+        format = 'csv'
+    ctx['status_err'] = output is None and format != 'table'
+
+    store = SnapshotStore(default_snapshot_path())
+    snapshots = store.snapshots(kind)
+
+    if list_snapshots:
+        click.echo(format_table([[id, format_time(taken_at), hosts] for id, hosts, taken_at in snapshots],
+                                ['snapshot', 'taken', 'hosts']))
+        store.close()
+        return
+
+    first, last = pick_snapshots(snapshots, days, first, last)
+    elapsed_days = (last[2] - first[2]) / SECONDS_PER_DAY
+    click.echo('Comparing {0} snapshot {1} ({2}) with {3} ({4}), {5:.1f} days apart'.format(
+        kind, first[0], format_time(first[2]), last[0], format_time(last[2]), elapsed_days), err=ctx['status_err'])
+
+    hosts = set(host_of(url) for url in ctx['URLs'])
+    growth = get_growth if kind == 'databases' else get_index_growth
+    top = TopN(limit)
+    compared = 0
+    for row in store.compare(first[0], last[0]):
+        if hosts and row[0] not in hosts:
+            continue
+        compared = compared + 1
+        score, item = growth(ctx, row, elapsed_days, sort)
+        top.push(score, item)
+    store.close()
+    ranked = top.sorted()
+
+    if kind == 'databases':
+        headers = ['host', 'db', 'total docs', 'docs/day', 'deleted docs', 'deleted/day', 'size', 'size/day',
+                   'q', 'recommended q', 'recommended q in {0:g} days'.format(horizon)]
+        format_row = format_growth
+    else:
+        headers = ['host', 'db', 'ddoc', 'index name', 'type', 'size', 'size/day']
+        format_row = format_index_growth
+
+    if format == 'table':
+        if limit > 0 and compared > limit:
+            click.echo('Showing {0} of {1} {2}, sorted by growth per day descending.'.format(limit, compared, kind))
+        else:
+            click.echo('Showing all {0} {1}, sorted by growth per day descending.'.format(compared, kind))
+        click.echo('\n')
+        click.echo(format_table(map(partial(format_row, ctx), ranked), headers))
+    else:
+        ctx['pretty_print'] = False
+        writer = RowWriter(output, format, headers)
+        for item in ranked:
+            writer.write(format_row(ctx, item))
+        writer.close()
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+
+
+def pick_snapshots(snapshots, days, first=None, last=None):
+    """The (id, hosts, taken_at) of the two snapshots to compare: last, or
+    the latest, and first, or the earliest of the same hosts within days
+    of it."""
+    by_id = dict((s[0], s) for s in snapshots)
+    for id in (first, last):
+        if id is not None and id not in by_id:
+            raise click.UsageError('No such snapshot: {0}'.format(id))
+
+    last = by_id[last] if last is not None else (snapshots[-1] if snapshots else None)
+    if first is not None:
+        first = by_id[first]
+    elif last is not None:
+        earliest = [s for s in snapshots if s[1] == last[1] and last[2] - days * SECONDS_PER_DAY <= s[2] < last[2]]
+        first = earliest[0] if earliest else None
+
+    if first is None or last is None or first[0] == last[0]:
+        raise click.ClickException('Need two snapshots of the same hosts to compare. '
+                                   'Record them with the --snapshot option of the databases and indexes commands.')
+    if first[2] > last[2]:
+        first, last = last, first
+    return first, last
+
+
+def rate(before, after, days):
+    if before is None or after is None or days <= 0:
+        return 0.0
+    return (after - before) / days
+
+
+def get_growth(ctx, row, days, sort):
+    host, name, _, _, _, before, after = row
+    doc_count, doc_del_count, size, q = after
+    db = DbRecord(host, None, name)
+    db.doc_count = doc_count
+    db.doc_del_count = doc_del_count
+    db.data_size = size
+    db.q = q
+    docs_per_day = rate((before[0] or 0) + (before[1] or 0), doc_count + doc_del_count, days)
+    deleted_per_day = rate(before[1], doc_del_count, days)
+    size_per_day = rate(before[2], size, days)
+
+    # the recommended q now, and at the same growth after the horizon
+    projected = DbRecord(host, None, name)
+    projected.q = q
+    projected.doc_count = doc_count + docs_per_day * ctx['horizon']
+    projected.doc_del_count = 0
+    projected.data_size = size + size_per_day * ctx['horizon']
+    add_recommended_q(ctx, [db, projected])
+
+    score = {'docs': docs_per_day, 'deleted': deleted_per_day, 'size': size_per_day}[sort]
+    return score, (db, docs_per_day, deleted_per_day, size_per_day, projected)
+
+
+def get_index_growth(ctx, row, days, sort):
+    size = row[6][2]
+    size_per_day = rate(row[5][2], size, days)
+    return size_per_day, (row[:5], size, size_per_day)
+
+
+def recommended_q(db):
+    if db.q is None:
+        return None
+    return int(max(db.q_docs, db.q_bytes))
+
+
+def format_growth(ctx, item):
+    db, docs_per_day, deleted_per_day, size_per_day, projected = item
+    total = db.doc_count + db.doc_del_count
+    deleted = db.doc_del_count
+    size = db.data_size
+    docs_per_day = int(round(docs_per_day))
+    deleted_per_day = int(round(deleted_per_day))
+    size_per_day = int(round(size_per_day))
+
+    if ctx['pretty_print']:
+        total = millify(total)
+        deleted = millify(deleted)
+        docs_per_day = millify(docs_per_day)
+        deleted_per_day = millify(deleted_per_day)
+        size = sizeof_fmt(size)
+        size_per_day = sizeof_fmt(size_per_day)
+
+    return [db.host, db.name, total, docs_per_day, deleted, deleted_per_day, size, size_per_day,
+            db.q, recommended_q(db), recommended_q(projected)]
+
+
+def format_index_growth(ctx, item):
+    (host, db, ddoc, name, type), size, size_per_day = item
+    size_per_day = int(round(size_per_day))
+    if ctx['pretty_print'] and size is not None:
+        size = sizeof_fmt(size)
+        size_per_day = sizeof_fmt(size_per_day)
+    return [host, db, ddoc, name, type, size, size_per_day]
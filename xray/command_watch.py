@@ -0,0 +1,207 @@
+import heapq
+import time
+from collections import OrderedDict
+from functools import partial
+from urlparse import urlparse
+
+import click
+
+from accounts import host_of
+from cache import open_cache
+from checkpoint import NullCheckpoint
+from command_databases import (add_recommended_q, format_stats, format_stats_expanded, get_database_list,
+                               get_db_info, get_headers, total_docs)
+from engines import create_engine
+from metrics import close_metrics, open_metrics
+from output import FORMATS, RowWriter, format_table
+from records import DbRecord
+from store import db_key
+
+
+@click.command()
+@click.pass_obj
+@click.option('--limit', '-l', default=50, help='Limit results. Set to 0 for all.')
+@click.option('--pretty-print', '-pp', is_flag=True, default=False)
+@click.option('--ddocs', '-dd', is_flag=True, default=False, help='Show ddoc stats / index counts per db, as for the databases command.')
+@click.option('--shards', '-s', is_flag=True, default=False, help='Show shard counts per db.')
+@click.option('--shard-docs', '-qd', default=10000000, type=float, help='Recommended docs per shard.')
+@click.option('--shard-size', '-qs', default=10, type=float, help='Recommended GB per shard.')
+@click.option('--connections', '-con', default=100, help='Maximum number of parallel connections to make to the server. The number in use adapts to how the server copes.')
+@click.option('--max-rps', default=0, type=float, help='Maximum requests per second to send. Set to 0 for no limit.')
+@click.option('--retries', default=5, help='Attempts to retry throttled or failed requests before giving up on them.')
+@click.option('--batch-size', '-b', default=100, help='Databases per /_dbs_info request, where the server supports it.')
+@click.option('--interval', '-i', default=60, type=float, help='Seconds between reads of _db_updates, each followed by a refresh and a dump of the top databases.')
+@click.option('--format', type=click.Choice(['table'] + FORMATS), default='table', help='Output format. Accepted values are table, csv and ndjson')
+@click.option('--output', '-o', type=click.Path(), default=None, help='Rewrite the specified file with the top databases on every refresh, as csv unless --format is given.')
+def watch(obj, limit, pretty_print, ddocs, shards, shard_docs, shard_size, connections, max_rps, retries, batch_size,
+          interval, format, output):
+    """Scan once, then keep the top databases current from _db_updates.
+
+    After the first full scan, each account's _db_updates feed is read
+    every --interval seconds, and only the dbs created, updated or deleted
+    since are fetched again. Stop with Ctrl-C.
+    """
+    ctx = obj
+    ctx['limit'] = limit
+    ctx['shards'] = shards
+    ctx['ddocs'] = ddocs
+    ctx['compaction'] = False
+    ctx['tasks'] = False
+    ctx['sample'] = None
+    ctx['placement'] = False
+    ctx['pretty_print'] = pretty_print
+    ctx['connections'] = connections
+    ctx['max_rps'] = max_rps
+    ctx['retries'] = retries
+    ctx['batch_size'] = batch_size
+    ctx['resume'] = False
+    ctx['snapshot_id'] = None
+    ctx['snapshots'] = None
+    ctx['metrics'] = open_metrics(ctx)
+
+    if output is not None and format == 'table':
+        format = 'csv'
+    ctx['status_err'] = output is None and format != 'table'
+    ctx['shard_docs'] = float(shard_docs)
+    ctx['shard_bytes'] = float(shard_size * 1073741824)
+
+    ctx['engine'] = create_engine(ctx)
+    ctx['session'] = ctx['engine'].session
+    # a watch is never resumed, and would grow a checkpoint without end
+    ctx['checkpoint'] = NullCheckpoint()
+    ctx['cache'] = open_cache(ctx)
+    ctx['activity'] = None
+
+    watcher = Watcher(ctx, ctx['URLs'])
+    try:
+        # read the feed positions first, so no change during the scan is missed
+        seqs = OrderedDict((url, get_update_seq(ctx, url)) for url in ctx['URLs'])
+        watcher.scan()
+        dump(ctx, watcher, format, output)
+        # refreshes are small; their progress bars would only get in the way
+        ctx['progress'] = False
+
+        last = time.time()
+        while True:
+            time.sleep(max(0, last + interval - time.time()))
+            last = time.time()
+            updated = set()
+            deleted = set()
+            for url in seqs:
+                events, seqs[url] = get_db_updates(ctx, url, seqs[url])
+                host = host_of(url)
+                for event in events:
+                    key = (host, event['db_name'])
+                    if event['type'] == 'deleted':
+                        deleted.add(key)
+                        updated.discard(key)
+                    else:
+                        updated.add(key)
+                        deleted.discard(key)
+
+            watcher.refresh(updated, deleted)
+            dump(ctx, watcher, format, output)
+    except KeyboardInterrupt:
+        click.echo('Stopped watching', err=True)
+    finally:
+        if ctx['cache'] is not None:
+            ctx['cache'].close()
+        close_metrics(ctx)
+
+
+def get_update_seq(ctx, root_url):
+    """The current position of root_url's _db_updates feed."""
+    return get_db_updates(ctx, root_url, 'now')[1]
+
+
+def get_db_updates(ctx, root_url, since):
+    """The _db_updates events on root_url after since, and the seq to read
+    on from next time."""
+    r = ctx['session'].get(root_url + '/_db_updates', params={'feed': 'normal', 'since': since})
+    if r.status_code != 200:
+        raise click.ClickException('Cannot read _db_updates on {0} ({1}). It needs server admin rights.'.format(
+            urlparse(root_url).hostname, r.status_code))
+    body = r.json()
+    return body['results'], body['last_seq']
+
+
+class Watcher(object):
+    """The top ctx['limit'] dbs of the watched accounts, kept current.
+
+    The total doc count of every db is kept, but full stats only for the
+    dbs in the top, so a refresh can tell which dbs move into the top
+    without holding every db's record.
+    """
+
+    def __init__(self, ctx, urls):
+        self.ctx = ctx
+        self.urls = urls
+        self.root_urls = dict((host_of(url), url) for url in urls)
+        # (host, db name) -> total docs, for every db
+        self.totals = {}
+        # (host, db name) -> DbRecord, for the dbs in the top
+        self.top = {}
+        self.refreshed = 0
+        self.removed = 0
+
+    def observe(self, db):
+        self.totals[db_key(db)] = total_docs(db)
+
+    def fetch(self, pages, limit):
+        top, _ = get_db_info(self.ctx, pages, limit, observe=self.observe)
+        for db in top:
+            self.top[db_key(db)] = db
+
+    def scan(self):
+        db_pages = (page for url in self.urls for page in get_database_list(self.ctx, url))
+        self.fetch(db_pages, self.ctx['limit'])
+
+    def pages(self, keys):
+        by_host = OrderedDict()
+        for host, name in sorted(keys):
+            by_host.setdefault(host, []).append(DbRecord(host, self.root_urls[host], name))
+        return by_host.values()
+
+    def refresh(self, updated, deleted):
+        """Fetch the updated dbs again and drop the deleted ones."""
+        self.refreshed = len(updated)
+        self.removed = len(deleted)
+        # an updated db that is gone by the time it is fetched stays out
+        for key in updated | deleted:
+            self.totals.pop(key, None)
+            self.top.pop(key, None)
+        if updated:
+            self.fetch(self.pages(updated), self.ctx['limit'])
+
+        limit = self.ctx['limit']
+        if limit > 0:
+            wanted = heapq.nlargest(limit, self.totals, key=self.totals.get)
+        else:
+            wanted = list(self.totals)
+
+        # dbs that moved up into the top as others shrank or were deleted
+        missing = [key for key in wanted if key not in self.top]
+        if missing:
+            self.fetch(self.pages(missing), 0)
+        self.top = dict((key, self.top[key]) for key in wanted if key in self.top)
+
+    def sorted(self):
+        return sorted(self.top.values(), key=total_docs, reverse=True)
+
+
+def dump(ctx, watcher, format, output):
+    dbs = watcher.sorted()
+    if ctx['shards']:
+        add_recommended_q(ctx, dbs)
+    short_headers, expanded_headers = get_headers(ctx)
+
+    if format == 'table':
+        click.echo('\n{0}: top {1} of {2} databases, {3} updated and {4} deleted since the last refresh\n'.format(
+            time.strftime('%H:%M:%S'), len(dbs), len(watcher.totals), watcher.refreshed, watcher.removed))
+        click.echo(format_table(map(partial(format_stats, ctx), dbs), short_headers))
+        return
+
+    writer = RowWriter(output, format, expanded_headers)
+    for db in dbs:
+        writer.write(format_stats_expanded(ctx, db))
+    writer.close()
@@ -0,0 +1,136 @@
+import threading
+import traceback
+import Queue
+
+ENGINES = ['grequests', 'threads']
+# seconds a threads engine queue waits at a time, so Ctrl-C gets through
+QUEUE_POLL = 1
+
+
+def pooled_session(connections):
+    """Session keeping up to connections keep-alive connections per host.
+
+    requests is imported here rather than at startup: commands that send
+    nothing, --help and usage errors never need it.
+    """
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.session()
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def with_session_hooks(kwargs):
+    """kwargs, with the session's response hooks added to the request's.
+
+    requests ignores a session's response hooks for requests that have
+    their own, so they are passed on explicitly.
+    """
+    session = kwargs.get('session')
+    hooks = kwargs.get('hooks')
+    if session is not None and hooks and session.hooks['response']:
+        response_hooks = hooks.get('response', [])
+        if callable(response_hooks):
+            response_hooks = [response_hooks]
+        kwargs['hooks'] = dict(hooks, response=list(response_hooks) + session.hooks['response'])
+    return kwargs
+
+
+class GreenletEngine(object):
+    """Sends grequests requests on gevent greenlets.
+
+    grequests monkeypatches the process with gevent when imported, so it is
+    only imported once this engine is chosen.
+    """
+
+    def __init__(self, connections):
+        import grequests
+        import gevent
+        from gevent.queue import Queue as GreenletQueue
+        self.grequests = grequests
+        self.gevent = gevent
+        self.queue_class = GreenletQueue
+        self.session = pooled_session(connections)
+
+    def request(self, method, url, **kwargs):
+        return self.grequests.AsyncRequest(method, url, **with_session_hooks(kwargs))
+
+    def queue(self):
+        return self.queue_class()
+
+    def spawn(self, fn, *args):
+        self.gevent.spawn(fn, *args)
+
+
+class ThreadRequest(object):
+    """Request sent from a worker thread, with the same interface as
+    grequests.AsyncRequest: send() sets response, or exception on failure."""
+
+    def __init__(self, method, url, session, **kwargs):
+        self.method = method
+        self.url = url
+        self.session = session
+        self.kwargs = kwargs
+        self.response = None
+
+    def send(self):
+        try:
+            self.response = self.session.request(self.method, self.url, **self.kwargs)
+        except Exception as e:
+            self.exception = e
+            self.traceback = traceback.format_exc()
+        return self
+
+
+class PollingQueue(Queue.Queue):
+    """Queue whose blocking get() can be interrupted by Ctrl-C."""
+
+    def get(self, block=True, timeout=None):
+        if not block or timeout is not None:
+            return Queue.Queue.get(self, block, timeout)
+        while True:
+            try:
+                return Queue.Queue.get(self, True, QUEUE_POLL)
+            except Queue.Empty:
+                continue
+
+
+class ThreadEngine(object):
+    """Sends requests from a pool of worker threads, without gevent."""
+
+    def __init__(self, connections):
+        self.session = pooled_session(connections)
+        self.work = Queue.Queue()
+        for _ in range(connections):
+            worker = threading.Thread(target=self.worker)
+            worker.daemon = True
+            worker.start()
+
+    def worker(self):
+        while True:
+            fn, args = self.work.get()
+            fn(*args)
+
+    def request(self, method, url, **kwargs):
+        return ThreadRequest(method, url, **with_session_hooks(kwargs))
+
+    def queue(self):
+        return PollingQueue()
+
+    def spawn(self, fn, *args):
+        self.work.put((fn, args))
+
+
+def create_engine(ctx):
+    """The request engine chosen on the command line, sized for
+    ctx['connections']."""
+    if ctx['engine_name'] == 'threads':
+        engine = ThreadEngine(ctx['connections'])
+    else:
+        engine = GreenletEngine(ctx['connections'])
+    if ctx['metrics'] is not None:
+        ctx['metrics'].watch(engine.session)
+    return engine
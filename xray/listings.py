@@ -0,0 +1,83 @@
+import json
+
+# bytes read from a streamed listing at a time
+CHUNK_SIZE = 65536
+
+
+def slim_design_doc(doc):
+    """doc with only the fields the databases and indexes reports look at:
+    map and search functions, attachments and the rest are dropped."""
+    if doc is None:
+        return None
+    slim = {'_id': doc.get('_id')}
+    if 'language' in doc:
+        slim['language'] = doc['language']
+    if 'views' in doc:
+        slim['views'] = dict((name, {'reduce': view['reduce']} if 'reduce' in view else {})
+                             for name, view in doc['views'].items())
+    for key in ('indexes', 'st_indexes', 'updates'):
+        if key in doc:
+            slim[key] = dict.fromkeys(doc[key])
+    if 'validate_doc_update' in doc:
+        slim['validate_doc_update'] = True
+    dbcopy = doc.get('options', {}).get('epi', {}).get('dbcopy')
+    if dbcopy is not None:
+        slim['options'] = {'epi': {'dbcopy': dbcopy}}
+    return slim
+
+
+def slim_row(row):
+    return {'id': row.get('id'), 'doc': slim_design_doc(row.get('doc'))}
+
+
+def iter_design_docs(response):
+    """Yield the rows of a streamed _all_docs listing of design docs, each
+    slimmed by slim_design_doc, as they are read.
+
+    CouchDB writes the header, each row and the footer of a listing on
+    lines of their own, so only one design doc is held at a time. A row
+    split over several lines is put back together; a listing laid out any
+    other way is parsed whole instead.
+    """
+    lines = response.iter_lines(chunk_size=CHUNK_SIZE)
+    received = [0]
+
+    def counted(lines):
+        for line in lines:
+            received[0] += len(line) + 1
+            yield line
+
+    lines = counted(lines)
+    head = next(lines, '')
+    if not head.rstrip().endswith('"rows":['):
+        for row in json.loads(head + '\n'.join(lines))['rows']:
+            yield slim_row(row)
+    else:
+        pending = ''
+        for line in lines:
+            pending = pending + line
+            text = pending.strip().strip(',')
+            if text.startswith(']'):
+                break
+            if not text:
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError:
+                # the rest of the row is on the next line
+                continue
+            pending = ''
+            yield slim_row(row)
+        # drain the footer, so the connection can be reused
+        for _ in lines:
+            pass
+
+    if hasattr(response, 'report_size'):
+        response.report_size(received[0])
+
+
+def read_design_docs(response):
+    """The rows iter_design_docs yields, as a list: a listing's slimmed rows
+    are small enough to hold, so it can be read ahead of its handler (see
+    scheduler.read_with)."""
+    return list(iter_design_docs(response))
@@ -0,0 +1,320 @@
+import json
+import threading
+import time
+from array import array
+from collections import defaultdict
+from functools import partial
+from urlparse import urlparse
+
+import click
+
+from output import format_table
+from store import TopN
+
+# the part of a scan each endpoint belongs to
+PHASES = {
+    '/': 'setup',
+    '/_all_dbs': 'list dbs',
+    '/_dbs_info': 'db info',
+    '/_db_updates': 'db updates',
+    '/{db}': 'db info',
+    '/{db}/_shards': 'shards',
+    '/{db}/_all_docs': 'design docs',
+    '/{db}/_design/{ddoc}/_info': 'index info',
+    '/{db}/_design/{ddoc}/_search_info/{index}': 'index info',
+    '/{db}/_design/{ddoc}/_geo_info/{index}': 'index info',
+}
+PERCENTILES = (50, 95, 99)
+# slowest requests listed in the report
+SLOWEST = 10
+
+
+def endpoint_of(url):
+    """url's path with db, design doc and index names replaced by
+    placeholders."""
+    parts = [p for p in urlparse(url).path.split('/') if p]
+    if not parts:
+        return '/'
+    if parts[0].startswith('_'):
+        return '/' + parts[0]
+    if len(parts) == 1:
+        return '/{db}'
+    if parts[1] == '_design' and len(parts) > 4 and parts[3] in ('_search_info', '_geo_info'):
+        return '/{db}/_design/{ddoc}/' + parts[3] + '/{index}'
+    if parts[1] == '_design' and len(parts) > 2:
+        return '/{db}/_design/{ddoc}' + ''.join('/' + p for p in parts[3:])
+    return '/{db}/' + '/'.join(parts[1:])
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100.0))]
+
+
+class EndpointStats(object):
+
+    def __init__(self):
+        self.statuses = defaultdict(int)
+        self.bytes = 0
+        self.latencies = array('d')
+
+    def merge(self, other):
+        for status, count in other.statuses.items():
+            self.statuses[status] += count
+        self.bytes += other.bytes
+        self.latencies.extend(other.latencies)
+
+
+class Metrics(object):
+    """Request-level measurements of a scan.
+
+    Responses are recorded by a hook on the scan's session (see watch), so
+    every request is counted, whichever code path sent it. The scheduler
+    reports retries, failed requests and how full the request pool is.
+    """
+
+    def __init__(self, trace=False):
+        self.started = time.time()
+        self.finished = None
+        self.lock = threading.Lock()
+        # (method, endpoint) -> EndpointStats
+        self.endpoints = defaultdict(EndpointStats)
+        self.slowest = TopN(SLOWEST)
+        self.retries = 0
+        self.failures = 0
+        self.paused = 0.0
+        # pool occupancy, integrated over time
+        self.pool_since = None
+        self.pool_time = 0.0
+        self.pool_busy = 0.0
+        self.pool_limit = 0.0
+        self.pool_full = 0.0
+        self.pool_state = (0, 0)
+        # chrome trace events, (pid, name, phase, start, duration, args)
+        self.trace = [] if trace else None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['lock']
+        state['slowest'] = self.slowest.sorted()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self.slowest = TopN(SLOWEST)
+        for item in state['slowest']:
+            self.slowest.push(item[0], item)
+
+    def watch(self, session):
+        session.hooks['response'].append(self.record)
+
+    def record(self, response, **kwargs):
+        # the hook runs once the headers are in; include reading the body
+        received = time.time()
+        endpoint = endpoint_of(response.url)
+        method = response.request.method
+        if kwargs.get('stream'):
+            size = int(response.headers.get('Content-Length', 0))
+            if 'Content-Length' not in response.headers:
+                # chunked: whoever reads the body reports its size
+                response.report_size = partial(self.add_bytes, method, endpoint)
+        else:
+            size = len(response.content)
+        start = received - response.elapsed.total_seconds()
+        latency = time.time() - start
+
+        with self.lock:
+            stats = self.endpoints[(method, endpoint)]
+            stats.statuses[response.status_code] += 1
+            stats.bytes += size
+            stats.latencies.append(latency)
+            path = urlparse(response.url).path
+            self.slowest.push(latency, (latency, method, path, response.status_code))
+            if self.trace is not None:
+                self.trace.append((0, '{0} {1}'.format(method, endpoint), PHASES.get(endpoint, 'other'),
+                                   start, latency,
+                                   {'path': path, 'status': response.status_code, 'bytes': size}))
+        return response
+
+    def add_bytes(self, method, endpoint, size):
+        with self.lock:
+            self.endpoints[(method, endpoint)].bytes += size
+
+    def retry(self):
+        self.retries += 1
+
+    def failure(self):
+        self.failures += 1
+
+    def pause(self, seconds):
+        self.paused += seconds
+
+    def pool(self, in_flight, limit):
+        """Note the requests in flight and the current concurrency limit."""
+        now = time.time()
+        if self.pool_since is not None:
+            elapsed = now - self.pool_since
+            busy, current_limit = self.pool_state
+            self.pool_time += elapsed
+            self.pool_busy += elapsed * busy
+            self.pool_limit += elapsed * current_limit
+            if current_limit and busy >= current_limit:
+                self.pool_full += elapsed
+        self.pool_since = now
+        self.pool_state = (in_flight, limit)
+
+    def pool_idle(self):
+        """Stop counting pool occupancy until the next call to pool()."""
+        self.pool(0, 0)
+        self.pool_since = None
+
+    def finish(self):
+        self.finished = time.time()
+        self.pool_idle()
+
+    def merge(self, other, pid):
+        """Add the metrics of a scan run in another process, whose trace
+        events are shown as process pid."""
+        for key, stats in other.endpoints.items():
+            self.endpoints[key].merge(stats)
+        for item in other.slowest.sorted():
+            self.slowest.push(item[0], item)
+        self.retries += other.retries
+        self.failures += other.failures
+        self.paused += other.paused
+        self.pool_time += other.pool_time
+        self.pool_busy += other.pool_busy
+        self.pool_limit += other.pool_limit
+        self.pool_full += other.pool_full
+        if self.trace is not None and other.trace is not None:
+            self.trace.extend((pid,) + event[1:] for event in other.trace)
+
+    def summary(self):
+        """The metrics as a dict, for the report and json export."""
+        endpoints = []
+        phases = defaultdict(lambda: {'requests': 0, 'bytes': 0, 'seconds': 0.0})
+        for (method, endpoint), stats in sorted(self.endpoints.items(), key=lambda e: e[0][1]):
+            ordered = sorted(stats.latencies)
+            phase = PHASES.get(endpoint, 'other')
+            endpoints.append({
+                'method': method,
+                'endpoint': endpoint,
+                'phase': phase,
+                'requests': len(ordered),
+                'statuses': dict((str(k), v) for k, v in sorted(stats.statuses.items())),
+                'bytes': stats.bytes,
+                'latency': dict(('p{0}'.format(p), percentile(ordered, p)) for p in PERCENTILES),
+                'max_latency': ordered[-1] if ordered else None,
+            })
+            phases[phase]['requests'] += len(ordered)
+            phases[phase]['bytes'] += stats.bytes
+            phases[phase]['seconds'] += sum(ordered)
+
+        wall = (self.finished or time.time()) - self.started
+        requests = sum(e['requests'] for e in endpoints)
+        return {
+            'wall_seconds': wall,
+            'requests': requests,
+            'requests_per_second': requests / wall if wall > 0 else None,
+            'retries': self.retries,
+            'failures': self.failures,
+            'paused_seconds': self.paused,
+            'pool': {
+                'mean_in_flight': self.pool_busy / self.pool_time if self.pool_time else None,
+                'mean_limit': self.pool_limit / self.pool_time if self.pool_time else None,
+                'saturated_share': self.pool_full / self.pool_time if self.pool_time else None,
+            },
+            'phases': dict(phases),
+            'endpoints': endpoints,
+            'slowest': [{'latency': latency, 'method': method, 'path': path, 'status': status}
+                        for latency, method, path, status in self.slowest.sorted()],
+        }
+
+    def report(self):
+        """Print the metrics to stderr."""
+        summary = self.summary()
+        pool = summary['pool']
+
+        def ms(seconds):
+            return '' if seconds is None else '{0:.0f}'.format(seconds * 1000)
+
+        def share(value):
+            return '' if value is None else '{0:.0%}'.format(value)
+
+        rows = [[e['phase'], '{0} {1}'.format(e['method'], e['endpoint']), e['requests'],
+                 ' '.join('{0}:{1}'.format(k, v) for k, v in sorted(e['statuses'].items())),
+                 sizeof_fmt(e['bytes'])] + [ms(e['latency']['p{0}'.format(p)]) for p in PERCENTILES] +
+                [ms(e['max_latency'])] for e in summary['endpoints']]
+
+        def echo(message=''):
+            click.echo(message, err=True)
+
+        echo()
+        took = 'Scan took {0:.1f}s: {1} requests ({2:.0f}/s), {3} retries, {4} failed, {5:.1f}s paused by throttling'
+        echo(took.format(summary['wall_seconds'], summary['requests'], summary['requests_per_second'] or 0,
+                         summary['retries'], summary['failures'], summary['paused_seconds']))
+        echo('Requests in flight averaged {0} of a limit of {1}; the pool was full {2} of the time'.format(
+            '{0:.1f}'.format(pool['mean_in_flight']) if pool['mean_in_flight'] is not None else '-',
+            '{0:.1f}'.format(pool['mean_limit']) if pool['mean_limit'] is not None else '-',
+            share(pool['saturated_share']) or '-'))
+        echo()
+        echo(format_table(rows, ['phase', 'endpoint', 'requests', 'statuses', 'bytes'] +
+                          ['p{0} ms'.format(p) for p in PERCENTILES] + ['max ms']))
+        if summary['slowest']:
+            echo()
+            echo(format_table([[ms(s['latency']), s['method'], s['path'], s['status']] for s in summary['slowest']],
+                              ['slowest ms', 'method', 'path', 'status']))
+
+    def write_json(self, path):
+        with open(path, 'wb') as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_trace(self, path):
+        """Write the requests as a Chrome trace (chrome://tracing, Perfetto),
+        one row per concurrent request slot."""
+        events = []
+        # lanes per process: end time of the last request on each lane
+        lanes = defaultdict(list)
+        for pid, name, phase, start, duration, args in sorted(self.trace, key=lambda e: (e[0], e[3])):
+            pid_lanes = lanes[pid]
+            for tid, end in enumerate(pid_lanes):
+                if end <= start:
+                    break
+            else:
+                tid = len(pid_lanes)
+                pid_lanes.append(0)
+            pid_lanes[tid] = start + duration
+            events.append({'name': name, 'cat': phase, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': int((start - self.started) * 1e6), 'dur': int(duration * 1e6), 'args': args})
+
+        with open(path, 'wb') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def sizeof_fmt(num):
+    for x in ['bytes', 'KB', 'MB', 'GB', 'TB']:
+        if abs(num) < 1024.0:
+            return '%3.1f %s' % (num, x)
+        num /= 1024.0
+
+
+def open_metrics(ctx):
+    """Metrics for the scan, if any were asked for on the command line."""
+    if not (ctx['stats'] or ctx['stats_json'] or ctx['trace']):
+        return None
+    return Metrics(trace=ctx['trace'] is not None)
+
+
+def close_metrics(ctx):
+    metrics = ctx['metrics']
+    if metrics is None:
+        return
+    metrics.finish()
+    if ctx['stats']:
+        metrics.report()
+    if ctx['stats_json']:
+        metrics.write_json(ctx['stats_json'])
+    if ctx['trace']:
+        metrics.write_trace(ctx['trace'])
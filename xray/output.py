@@ -0,0 +1,53 @@
+import csv
+import json
+from collections import OrderedDict
+
+import click
+
+FORMATS = ['csv', 'ndjson']
+
+
+def format_table(rows, headers):
+    """rows as a text table. tabulate is imported here, so only table
+    output pays for it."""
+    from tabulate import tabulate
+    return tabulate(rows, headers=headers)
+
+
+class RowWriter(object):
+    """Writes report rows to output, or stdout if None, as csv or ndjson.
+
+    Every row is flushed as it is written, so rows can be read while a scan
+    is still running. ndjson rows are objects keyed by headers, unless the
+    caller passes its own record.
+    """
+
+    def __init__(self, output, format, headers):
+        if output is None:
+            self.file = click.get_binary_stream('stdout')
+        else:
+            self.file = open(output, 'wb')
+        self.output = output
+        self.format = format
+        self.headers = headers
+        self.count = 0
+
+        if format == 'csv':
+            self.writer = csv.writer(self.file, dialect='excel')
+            self.writer.writerow(headers)
+
+    def write(self, row, record=None):
+        if self.format == 'csv':
+            self.writer.writerow(row)
+        else:
+            if record is None:
+                record = OrderedDict(zip(self.headers, row))
+            self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+        self.count = self.count + 1
+
+    def close(self):
+        if self.output is not None:
+            self.file.close()
+        else:
+            self.file.flush()
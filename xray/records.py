@@ -0,0 +1,92 @@
+from cache import db_version
+
+
+class Record(object):
+    """Base for compact records. Only the fields in __slots__ are kept, and
+    fields that are not known yet are None."""
+
+    __slots__ = ()
+
+    def to_dict(self):
+        """The known fields, for the scan cache, checkpoints and json output."""
+        return dict((k, getattr(self, k)) for k in self.__slots__ if getattr(self, k) is not None)
+
+    @classmethod
+    def from_dict(cls, d):
+        record = cls.__new__(cls)
+        for k in cls.__slots__:
+            setattr(record, k, d.get(k))
+        return record
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        for k in self.__slots__:
+            setattr(self, k, state.get(k))
+
+
+class DbRecord(Record):
+    """Stats for one db: what the databases report uses, rather than its
+    whole info response."""
+
+    __slots__ = ('host', 'root_url', 'name', 'backend',
+                 'doc_count', 'doc_del_count', 'data_size', 'version',
+                 'file_size', 'active_size', 'views_file_size', 'views_active_size',
+                 'q', 'n', 'placement', 'indexes', 'q_docs', 'q_bytes', 'shard_copies', 'activity')
+
+    def __init__(self, host, root_url, name):
+        for k in self.__slots__:
+            setattr(self, k, None)
+        self.host = host
+        self.root_url = root_url
+        self.name = name
+
+    @property
+    def url(self):
+        return self.root_url + '/' + self.name
+
+    def add_info(self, info, backend):
+        self.backend = backend
+        self.doc_count = info['doc_count']
+        self.doc_del_count = info['doc_del_count']
+        # sizes is CouchDB 2+; disk_size, data_size and other are deprecated
+        sizes = info.get('sizes') or {}
+        self.data_size = sizes.get('external', info.get('other', {}).get('data_size'))
+        self.file_size = sizes.get('file', info.get('disk_size'))
+        self.active_size = sizes.get('active', info.get('data_size'))
+        self.version = db_version(info)
+        # clustered db info already carries the shard count
+        cluster = info.get('cluster', {})
+        if 'q' in cluster:
+            self.q = cluster['q']
+            self.n = cluster.get('n')
+
+
+class IndexRecord(Record):
+    """One view, search, geo or query index of a design doc. doc_count is
+    only known for search and geo indexes, active_bytes only for views, the
+    lag fields only for views compared with their db, and activity only for
+    indexes with tasks running."""
+
+    __slots__ = ('host', 'db_name', 'ddoc', 'type', 'name', 'size_bytes', 'active_bytes',
+                 'dbcopy', 'reduce', 'custom_reduce', 'doc_count',
+                 'behind', 'updater_running', 'compact_running', 'waiting_clients', 'activity')
+
+    def __init__(self, db_name, ddoc, type, name, dbcopy='', reduce=False, custom_reduce=False):
+        self.host = None
+        self.db_name = db_name
+        self.ddoc = ddoc
+        self.type = type
+        self.name = name
+        self.size_bytes = -1
+        self.active_bytes = None
+        self.dbcopy = dbcopy
+        self.reduce = reduce
+        self.custom_reduce = custom_reduce
+        self.doc_count = None
+        self.behind = None
+        self.updater_running = None
+        self.compact_running = None
+        self.waiting_clients = None
+        self.activity = None
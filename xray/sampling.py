@@ -0,0 +1,126 @@
+import hashlib
+import math
+import re
+from collections import OrderedDict, defaultdict
+
+import click
+
+from output import format_table
+
+# ids that vary within a family of dbs, e.g. userdb-6a6f686e, db00042, or a
+# name that is a uuid
+FAMILY_SUFFIX = re.compile(r'^[0-9a-f]{16,}$|(?<=[-_$/.])[0-9a-f]{8,}$|[0-9]+$', re.IGNORECASE)
+# families expected to yield fewer sampled dbs than this are scanned in full
+MIN_FAMILY_SAMPLE = 10
+# normal quantile for 95% confidence intervals
+Z_95 = 1.96
+
+
+def name_family(name):
+    """name without its trailing id: dbs created per user or per tenant
+    share a family, one-off dbs are families of their own."""
+    return FAMILY_SUFFIX.sub('', name)
+
+
+class Sample(object):
+    """Which dbs a sampled scan fetches, and how likely each was to be.
+
+    dbs in the certainty stratum are always fetched: those whose name family
+    is too rare in _all_dbs to be sampled well, and those marked as
+    outliers. Every other db is fetched with probability rate, decided by a
+    hash of its name, so a rerun picks the same dbs.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        # (root URL, family) -> dbs listed
+        self.families = defaultdict(int)
+        self.outliers = set()
+        self.listed = 0
+        self.selected = 0
+        self.certain = 0
+
+    def count(self, root_url, names):
+        """Count the families of a page of _all_dbs, ahead of sampling it."""
+        for name in names:
+            self.families[(root_url, name_family(name))] += 1
+        self.listed += len(names)
+
+    def is_certain(self, root_url, name):
+        if (root_url, name) in self.outliers:
+            return True
+        return self.families.get((root_url, name_family(name)), 0) * self.rate < MIN_FAMILY_SAMPLE
+
+    def drawn(self, name):
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+        return int(digest[:8], 16) < self.rate * 0x100000000
+
+    def include(self, root_url, name):
+        if self.is_certain(root_url, name):
+            self.certain += 1
+        elif not self.drawn(name):
+            return False
+        self.selected += 1
+        return True
+
+    def add_outlier(self, root_url, name, included=False):
+        """Fetch name as a likely outlier, with certainty. included is
+        whether include already drew it, so it is not counted twice."""
+        if self.is_certain(root_url, name):
+            return
+        self.outliers.add((root_url, name))
+        self.certain += 1
+        if not included:
+            self.selected += 1
+
+    def probability(self, root_url, name):
+        return 1.0 if self.is_certain(root_url, name) else self.rate
+
+
+class Estimate(object):
+    """Horvitz-Thompson estimates of account totals from the sampled dbs.
+
+    Each db's values count 1/p times, where p is the probability it was
+    sampled with. For Bernoulli sampling, the variance of an estimate is
+    estimated by the sum of (1 - p) / p^2 * y^2 over the sampled dbs, so
+    dbs in the certainty stratum add none.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.sampled = OrderedDict((f, 0) for f in fields)
+        self.totals = OrderedDict((f, 0.0) for f in fields)
+        self.variances = OrderedDict((f, 0.0) for f in fields)
+
+    def add(self, probability, values):
+        for f in self.fields:
+            y = values.get(f) or 0
+            self.sampled[f] += y
+            self.totals[f] += y / probability
+            self.variances[f] += (1 - probability) / probability ** 2 * y ** 2
+
+    def rows(self):
+        """[field, estimate, 95% interval half-width, sampled total]"""
+        return [[f, int(round(self.totals[f])), int(round(Z_95 * math.sqrt(self.variances[f]))), self.sampled[f]]
+                for f in self.fields]
+
+
+def start_sample(rate, resume, processes):
+    """The Sample for a --sample of rate, or None without one."""
+    if not rate:
+        return None
+    if not 0 < rate < 1:
+        raise click.UsageError('--sample needs a fraction between 0 and 1')
+    if resume:
+        raise click.UsageError('--sample cannot be combined with --resume')
+    if processes > 1:
+        raise click.UsageError('--sample cannot be combined with --processes')
+    return Sample(rate)
+
+
+def report_sample(ctx, sample, estimate):
+    """Print the estimated totals, to stderr when rows go to stdout."""
+    click.echo('\nSampled {0} of {1} listed databases at {2:g}%, {3} of them in full as rare or likely outliers. '
+               'Estimated totals:\n'.format(sample.selected, sample.listed, sample.rate * 100, sample.certain),
+               err=ctx['status_err'])
+    click.echo(format_table(estimate.rows(), ['total', 'estimate', '+/- (95%)', 'sampled']), err=ctx['status_err'])
@@ -0,0 +1,263 @@
+import click
+import heapq
+import itertools
+import time
+from collections import deque
+from Queue import Empty
+from metrics import endpoint_of
+from throttle import ConcurrencyLimit, RateLimit, parse_retry_after, retry_delay
+
+# responses that mean the server is shedding load
+THROTTLED = (429, 503)
+# responses, besides throttling, worth another attempt
+RETRIED = (500, 502, 504)
+
+
+def on_failure(request, failed):
+    """Have the scheduler call failed() if request gets no usable response:
+    a 404, a connection error, or a 5xx or throttled response once its
+    retries run out. Returns request."""
+    request.failed = failed
+    return request
+
+
+def read_with(request, parse):
+    """Have the scheduler read the body of request's 200 response with
+    parse(response) on the worker that sent it, rather than on the dispatch
+    loop, so bodies are read in parallel. The handler finds the result in
+    response.parsed. request should be sent with stream=True. Returns
+    request."""
+    request.parse = parse
+    return request
+
+
+class NullProgress(object):
+    """Stands in for click.progressbar when progress is not shown."""
+
+    def __init__(self, length):
+        self.length = length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def update(self, n):
+        pass
+
+
+class Scheduler(object):
+    """Runs requests on the request engine in ctx['engine'].
+
+    Response handlers may queue follow-up requests while the scan is
+    running. Follow-ups are dispatched ahead of the remaining initial
+    requests, so a db's later phases start as soon as its first response
+    is in and the pool never drains between phases.
+
+    The number of requests in flight adapts to the server (see
+    ConcurrencyLimit), up to ctx['connections'], and is optionally capped at
+    ctx['max_rps'] requests per second. Throttled, failed and 5xx requests
+    are retried up to ctx['retries'] times with jittered backoff, honouring
+    Retry-After; a throttled response holds back all dispatching until then.
+    Requests that fail for good call their failed callback (see on_failure)
+    instead of their handler, so whatever waits on them can move on.
+    Large bodies can be read on the workers too (see read_with).
+    """
+
+    def __init__(self, ctx):
+        self.engine = ctx['engine']
+        self.limit = ConcurrencyLimit(ctx['connections'])
+        self.rate = RateLimit(ctx['max_rps'])
+        self.max_retries = ctx['retries']
+        self.progress = ctx['progress']
+        self.status_err = ctx['status_err']
+        self.metrics = ctx['metrics']
+        self.completed = self.engine.queue()
+        self.follow_ups = deque()
+        # (ready at, order, request, handler) for requests waiting to be retried
+        self.retries = []
+        self.order = itertools.count()
+        self.paused_until = 0
+        self.exhausted = False
+        self.in_flight = 0
+        self.errors = 0
+        self.retried = 0
+        self.bar = None
+
+    def expect(self, count):
+        """Add count requests that rs will yield to the progress bar."""
+        if self.bar is not None:
+            self.bar.length += count
+
+    def follow(self, request, handler, failed=None):
+        if failed is not None:
+            on_failure(request, failed)
+        self.follow_ups.append((request, handler))
+        if self.bar is not None:
+            self.bar.length += 1
+
+    def run(self, rs, count=0):
+        """Process (request, handler) pairs from rs, plus any follow-ups.
+
+        count is the number of requests rs yields, if known up front.
+        Otherwise rs can announce them with expect() as it goes.
+        """
+        rs = iter(rs)
+        self.exhausted = False
+
+        if self.progress:
+            stream = click.get_text_stream('stderr') if self.status_err else None
+            progressbar = click.progressbar(length=count, file=stream)
+        else:
+            progressbar = NullProgress(count)
+        with progressbar as bar:
+            self.bar = bar
+            while True:
+                self.dispatch(rs)
+                if self.metrics is not None:
+                    self.metrics.pool(self.in_flight, int(self.limit))
+                if self.in_flight == 0 and not self.retries and not self.follow_ups and self.exhausted:
+                    break
+
+                try:
+                    request, handler, sent_at, latency = self.completed.get(timeout=self.next_wakeup())
+                except Empty:
+                    continue
+                self.in_flight -= 1
+                self.handle(request, handler, sent_at, latency)
+                if request.response is not None:
+                    # gives back the connection of a streamed body left unread
+                    request.response.close()
+            self.bar = None
+            if self.metrics is not None:
+                self.metrics.pool_idle()
+
+        if self.retried > 0:
+            click.echo('Retried {0} requests after throttling or server errors'.format(self.retried),
+                       err=self.status_err)
+        if self.errors > 0:
+            click.echo('Failed to get data for {0} requests due to server errors'.format(self.errors),
+                       err=self.status_err)
+
+    def next_request(self, rs):
+        if self.retries and self.retries[0][0] <= time.time():
+            ready_at, order, request, handler = heapq.heappop(self.retries)
+            return request, handler
+        if self.follow_ups:
+            return self.follow_ups.popleft()
+        if not self.exhausted:
+            request, handler = next(rs, (None, None))
+            if request is not None:
+                return request, handler
+            self.exhausted = True
+        return None, None
+
+    def dispatch(self, rs):
+        if time.time() < self.paused_until:
+            return
+
+        while self.in_flight < int(self.limit):
+            if self.rate.wait() > 0:
+                return
+            request, handler = self.next_request(rs)
+            if request is None:
+                return
+            self.rate.take()
+            self.in_flight += 1
+            self.engine.spawn(self.send, request, handler)
+
+    def next_wakeup(self):
+        """Seconds until dispatch may have something to do that no response
+        will wake it for, or None to wait for the next response."""
+        now = time.time()
+        waits = []
+        if self.paused_until > now:
+            waits.append(self.paused_until - now)
+        if self.retries:
+            waits.append(max(0, self.retries[0][0] - now))
+        if self.rate.wait() > 0:
+            waits.append(self.rate.wait())
+        if not waits:
+            return None
+        return max(min(waits), 0.001)
+
+    def send(self, request, handler):
+        sent_at = time.time()
+        # don't mistake a previous attempt's response for this one's
+        request.response = None
+        request.send()
+        latency = time.time() - sent_at
+        parse = getattr(request, 'parse', None)
+        r = request.response
+        if parse is not None and r is not None and r.status_code == 200:
+            try:
+                r.parsed = parse(r)
+            except Exception as e:
+                # a body cut short or garbled counts as a failed request
+                r.close()
+                request.response = None
+                request.exception = e
+        self.completed.put((request, handler, sent_at, latency))
+
+    def retry(self, request, handler, retry_after=None):
+        """Queue request for another attempt, returning False when it has
+        none left."""
+        request.attempts = getattr(request, 'attempts', 0) + 1
+        if request.attempts > self.max_retries:
+            return False
+
+        self.retried = self.retried + 1
+        if self.metrics is not None:
+            self.metrics.retry()
+        ready_at = time.time() + retry_delay(request.attempts, retry_after)
+        heapq.heappush(self.retries, (ready_at, next(self.order), request, handler))
+        return True
+
+    def handle(self, request, handler, sent_at, latency):
+        r = request.response
+
+        if r is not None and r.status_code in THROTTLED:
+            self.limit.decrease(sent_at)
+            retry_after = parse_retry_after(r)
+            if retry_after is not None:
+                paused_until = max(self.paused_until, time.time() + retry_after)
+                if self.metrics is not None:
+                    self.metrics.pause(paused_until - max(self.paused_until, time.time()))
+                self.paused_until = paused_until
+            if self.retry(request, handler, retry_after):
+                return
+        elif r is None or r.status_code in RETRIED:
+            if self.retry(request, handler):
+                return
+        else:
+            # errors and 404s return faster than real work, so only 200s
+            # count towards the latency baseline
+            self.limit.success(sent_at, latency if r.status_code == 200 else None, endpoint_of(request.url))
+
+        self.bar.update(1)
+
+        if self.metrics is not None and (r is None or r.status_code >= 500 or r.status_code in THROTTLED):
+            self.metrics.failure()
+
+        if r is None:
+            self.errors = self.errors + 1
+            click.echo('Error requesting {0}: {1}. Continuing...'.format(request.url, request.exception), err=True)
+            self.fail(request)
+        elif r.status_code == 200:
+            handler(r)
+        elif r.status_code == 404:
+            # indicates database was deleted before we queried it
+            self.fail(request)
+        elif r.status_code >= 500 or r.status_code in THROTTLED:
+            self.errors = self.errors + 1
+            click.echo('{0} error processing {1}. Continuing...'.format(r.status_code, r.url), err=True)
+            self.fail(request)
+        else:
+            click.echo(r.status_code, err=self.status_err)
+            r.raise_for_status()
+
+    def fail(self, request):
+        failed = getattr(request, 'failed', None)
+        if failed is not None:
+            failed()
@@ -0,0 +1,131 @@
+import os
+import time
+
+import click
+
+from accounts import host_of
+from cache import COMMIT_INTERVAL, LOCK_TIMEOUT
+
+KINDS = ['databases', 'indexes']
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS snapshots ('
+    'id INTEGER PRIMARY KEY, kind TEXT, hosts TEXT, taken_at REAL)',
+    'CREATE INDEX IF NOT EXISTS snapshots_kind ON snapshots (kind, taken_at)',
+    # one row per db or index ever seen; dbs have empty ddoc, name and type
+    'CREATE TABLE IF NOT EXISTS series ('
+    'id INTEGER PRIMARY KEY, kind TEXT, host TEXT, db TEXT, ddoc TEXT, name TEXT, type TEXT, '
+    'UNIQUE (kind, host, db, ddoc, name, type))',
+    # clustered by snapshot, so reading one snapshot touches only its rows
+    'CREATE TABLE IF NOT EXISTS samples ('
+    'snapshot INTEGER, series INTEGER, doc_count INTEGER, doc_del_count INTEGER, size INTEGER, q INTEGER, '
+    'PRIMARY KEY (snapshot, series)) WITHOUT ROWID',
+]
+
+
+def default_snapshot_path():
+    return os.path.join(click.get_app_dir('xray'), 'snapshots.sqlite')
+
+
+class SnapshotStore(object):
+    """Stats of the dbs and indexes seen by past scans, one snapshot per scan.
+
+    Each db or index is a series with an id of its own, and a snapshot holds
+    one sample per series: its doc counts, size and, for dbs, shard count.
+    """
+
+    def __init__(self, path):
+        import sqlite3
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.conn = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        for statement in SCHEMA:
+            self.conn.execute(statement)
+        self.conn.commit()
+        self.last_commit = time.time()
+        # (kind, host, db, ddoc, name, type) -> series id
+        self.series = {}
+
+    def begin(self, kind, hosts, resume=False):
+        """Start a snapshot of hosts, returning its id. With resume, the
+        latest snapshot of the same hosts is continued instead."""
+        hosts = ','.join(sorted(set(hosts)))
+        if resume:
+            row = self.conn.execute('SELECT id FROM snapshots WHERE kind = ? AND hosts = ? '
+                                    'ORDER BY taken_at DESC LIMIT 1', (kind, hosts)).fetchone()
+            if row is not None:
+                return row[0]
+
+        snapshot = self.conn.execute('INSERT INTO snapshots (kind, hosts, taken_at) VALUES (?, ?, ?)',
+                                     (kind, hosts, time.time())).lastrowid
+        self.conn.commit()
+        return snapshot
+
+    def series_id(self, kind, host, db, ddoc='', name='', type=''):
+        key = (kind, host, db, ddoc, name, type)
+        if key not in self.series:
+            self.conn.execute('INSERT OR IGNORE INTO series (kind, host, db, ddoc, name, type) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', key)
+            self.series[key] = self.conn.execute(
+                'SELECT id FROM series WHERE kind = ? AND host = ? AND db = ? AND ddoc = ? AND name = ? AND type = ?',
+                key).fetchone()[0]
+        return self.series[key]
+
+    def add(self, snapshot, series, doc_count=None, doc_del_count=None, size=None, q=None):
+        self.conn.execute('INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?)',
+                          (snapshot, series, doc_count, doc_del_count, size, q))
+        if time.time() - self.last_commit > COMMIT_INTERVAL:
+            self.conn.commit()
+            self.last_commit = time.time()
+
+    def add_db(self, snapshot, db):
+        self.add(snapshot, self.series_id('databases', db.host, db.name),
+                 db.doc_count, db.doc_del_count, db.data_size, db.q)
+
+    def add_index(self, snapshot, index):
+        self.add(snapshot, self.series_id('indexes', index.host, index.db_name, index.ddoc, index.name, index.type),
+                 doc_count=index.doc_count, size=index.size_bytes if index.size_bytes >= 0 else None)
+
+    def snapshots(self, kind):
+        """(id, hosts, taken_at) of the snapshots of kind, oldest first."""
+        return self.conn.execute('SELECT id, hosts, taken_at FROM snapshots WHERE kind = ? ORDER BY taken_at',
+                                 (kind,)).fetchall()
+
+    def compare(self, first, last):
+        """Yield (host, db, ddoc, name, type, first sample, last sample) for
+        every series in both snapshots, where a sample is (doc_count,
+        doc_del_count, size, q)."""
+        rows = self.conn.execute(
+            'SELECT s.host, s.db, s.ddoc, s.name, s.type, '
+            'a.doc_count, a.doc_del_count, a.size, a.q, b.doc_count, b.doc_del_count, b.size, b.q '
+            'FROM samples b '
+            'JOIN samples a ON a.snapshot = ? AND a.series = b.series '
+            'JOIN series s ON s.id = b.series '
+            'WHERE b.snapshot = ?', (first, last))
+        for row in rows:
+            yield row[:5] + (row[5:9], row[9:13])
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def begin_snapshot(ctx, kind):
+    """The id of the snapshot to record this scan in, or None unless
+    --snapshot was given."""
+    if not ctx['snapshot']:
+        return None
+    store = SnapshotStore(default_snapshot_path())
+    snapshot = store.begin(kind, [host_of(url) for url in ctx['URLs']], ctx['resume'])
+    store.close()
+    return snapshot
+
+
+def open_snapshots(ctx):
+    """The store to record this scan's snapshot in, or None."""
+    if ctx['snapshot_id'] is None:
+        return None
+    return SnapshotStore(default_snapshot_path())
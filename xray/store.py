@@ -0,0 +1,109 @@
+import heapq
+import itertools
+from collections import OrderedDict
+
+
+def db_key(db):
+    return (db.host, db.name)
+
+
+class DbStore(object):
+    """Per-database results, keyed by (host, db name).
+
+    Requests carry the key of the db they were made for (see keyed_hooks),
+    so each response is attached to its db with a single dict lookup.
+    """
+
+    def __init__(self, dbs=None):
+        self._dbs = OrderedDict()
+        for db in dbs or []:
+            self.add(db)
+
+    def add(self, db):
+        self._dbs[db_key(db)] = db
+        return db
+
+    def get(self, key):
+        return self._dbs.get(key)
+
+    def __getitem__(self, key):
+        return self._dbs[key]
+
+    def __contains__(self, key):
+        return key in self._dbs
+
+    def discard(self, key):
+        self._dbs.pop(key, None)
+
+    def __len__(self):
+        return len(self._dbs)
+
+    def __iter__(self):
+        return iter(self._dbs.values())
+
+
+class TopN(object):
+    """The limit highest scoring items pushed so far.
+
+    Items that cannot make the cut are dropped as they arrive, so memory
+    and sort cost scale with limit rather than with the number of items
+    pushed. On equal scores the earlier item wins. A limit of 0 keeps
+    everything.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.heap = []
+        self.counter = itertools.count()
+
+    def admits(self, score):
+        if self.limit <= 0 or len(self.heap) < self.limit:
+            return True
+        return score > self.heap[0][0]
+
+    def push(self, score, item):
+        """Add item, returning the item that dropped out, if any.
+
+        The returned item is either one evicted to make room or item
+        itself when it did not make the cut.
+        """
+        entry = (score, -next(self.counter), item)
+        if self.limit <= 0 or len(self.heap) < self.limit:
+            heapq.heappush(self.heap, entry)
+            return None
+        if entry[:2] < self.heap[0][:2]:
+            return item
+        return heapq.heapreplace(self.heap, entry)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+    def sorted(self):
+        """Items by descending score."""
+        return [item for score, order, item in sorted(self.heap, key=lambda e: e[:2], reverse=True)]
+
+
+class Passthrough(object):
+    """Stands in for TopN when results are written out as they complete:
+    admits every item and keeps none of them."""
+
+    def admits(self, score):
+        return True
+
+    def push(self, score, item):
+        return None
+
+    def __len__(self):
+        return 0
+
+    def sorted(self):
+        return []
+
+
+def keyed_hooks(key):
+    """Request hooks that stamp each response with the key of its result."""
+    def tag_response(response, **kwargs):
+        response.result_key = key
+        return response
+
+    return dict(response=tag_response)
@@ -0,0 +1,166 @@
+import re
+import urllib
+from urlparse import urlparse
+
+import click
+
+from accounts import host_of
+
+# shards/00000000-1fffffff/userdb-6a6f686e.1510253312, where the db name may
+# carry a Cloudant account prefix, e.g. shards/.../foo/userdb.1510253312
+SHARD_PATH = re.compile(r'^shards/[0-9a-f]+-[0-9a-f]+/(.+)\.[0-9]+$')
+
+
+def shard_db_name(path, host):
+    """The db a shard file path in _active_tasks belongs to, without the
+    account prefix Cloudant adds to it."""
+    match = SHARD_PATH.match(path)
+    if match is None:
+        # a node-local or unclustered db
+        return path
+    name = match.group(1)
+    account = host.split('.', 1)[0] + '/'
+    return name[len(account):] if name.startswith(account) else name
+
+
+def endpoint_db_name(endpoint, host):
+    """The db on host that a replication source or target names, or None if
+    it is on another host."""
+    if isinstance(endpoint, dict):
+        endpoint = endpoint.get('url')
+    if not endpoint:
+        return None
+    parsed = urlparse(endpoint)
+    if not parsed.scheme:
+        return endpoint
+    if host_of(endpoint) != host:
+        return None
+    return urllib.unquote(parsed.path.strip('/').split('/')[-1]) or None
+
+
+class Work(object):
+    """The background tasks running on one db or index, summed as they are
+    joined."""
+
+    __slots__ = ('tasks', 'replications', 'indexed', 'to_index', 'compacted', 'to_compact',
+                 'changes_pending', 'changes_rate')
+
+    def __init__(self):
+        for k in self.__slots__:
+            setattr(self, k, 0)
+
+    def add_task(self, task):
+        kind = task.get('type', '')
+        done = task.get('changes_done', task.get('revisions_checked', 0)) or 0
+        total = task.get('total_changes')
+        self.tasks += 1
+        if kind.endswith('indexer') and total:
+            self.indexed += done
+            self.to_index += total
+        elif kind.endswith('compaction') and total:
+            self.compacted += done
+            self.to_compact += total
+        if kind == 'replication':
+            self.changes_pending += task.get('changes_pending') or 0
+        elif total:
+            self.changes_pending += max(0, total - done)
+        elapsed = (task.get('updated_on') or 0) - (task.get('started_on') or 0)
+        if elapsed > 0:
+            self.changes_rate += float(done) / elapsed
+
+    def to_dict(self):
+        """What the reports show, as kept on db and index records."""
+        return {'tasks': self.tasks,
+                'replications': self.replications,
+                'indexing': float(self.indexed) / self.to_index if self.to_index else None,
+                'compacting': float(self.compacted) / self.to_compact if self.to_compact else None,
+                'changes_pending': self.changes_pending,
+                'changes_rate': round(self.changes_rate, 1)}
+
+
+class ActiveTasks(object):
+    """The background work running on the hosts scanned, from /_active_tasks
+    and /_scheduler/jobs, fetched once per host and hashed by db and by
+    index, so each db or index scanned is joined with a dict lookup.
+
+    Indexer and compaction tasks name the shard file they work on, and count
+    towards its db, and towards its design doc for view and search tasks.
+    Replications count towards their source and target dbs on the host.
+    """
+
+    def __init__(self):
+        self.hosts = set()
+        # (host, db name) -> Work
+        self.dbs = {}
+        # (host, db name, ddoc, index name or None for views) -> Work
+        self.indexes = {}
+
+    def fetch(self, ctx, root_url):
+        host = host_of(root_url)
+        if host in self.hosts:
+            return
+        self.hosts.add(host)
+
+        r = ctx['session'].get(root_url + '/_active_tasks')
+        if r.status_code != 200:
+            raise click.ClickException('Cannot read _active_tasks on {0} ({1}). It needs server admin rights.'.format(
+                host, r.status_code))
+        tasks = r.json()
+        # replications from the scheduler, which lists those not running too;
+        # servers before CouchDB 2.1 have no scheduler
+        r = ctx['session'].get(root_url + '/_scheduler/jobs')
+        jobs = r.json().get('jobs', []) if r.status_code == 200 else []
+
+        replications = dict((job['id'], (job, None)) for job in jobs)
+        for task in tasks:
+            if task.get('type') == 'replication':
+                key = task.get('replication_id') or id(task)
+                replications[key] = (replications.get(key, (task, None))[0], task)
+                continue
+            db = shard_db_name(task.get('database', ''), host)
+            self.work(self.dbs, (host, db)).add_task(task)
+            ddoc = task.get('design_document')
+            if ddoc is not None:
+                self.work(self.indexes, (host, db, ddoc, task.get('index'))).add_task(task)
+
+        for job, task in replications.values():
+            names = set(endpoint_db_name(job.get(k), host) for k in ('source', 'target'))
+            names.discard(None)
+            for db in names:
+                work = self.work(self.dbs, (host, db))
+                work.replications += 1
+                if task is not None:
+                    work.add_task(task)
+
+        click.echo('Found {0} background tasks and {1} replications on {2}'.format(
+            len(tasks), len(replications), host), err=ctx['status_err'])
+
+    @staticmethod
+    def work(table, key):
+        if key not in table:
+            table[key] = Work()
+        return table[key]
+
+    def for_db(self, host, name):
+        work = self.dbs.get((host, name))
+        return work.to_dict() if work is not None else None
+
+    def for_index(self, host, db_name, ddoc, name=None):
+        """The tasks on a view, by its design doc, or with name on a search
+        or geo index."""
+        work = self.indexes.get((host, db_name, ddoc, name))
+        return work.to_dict() if work is not None else None
+
+
+def open_activity(ctx):
+    if not ctx['tasks']:
+        return None
+    return ActiveTasks()
+
+
+def activity_score(activity):
+    """What --tasks ranks by: the tasks running, then the changes they get
+    through a second."""
+    if activity is None:
+        return (0, 0)
+    return (activity['tasks'], activity['changes_rate'])
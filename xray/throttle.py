@@ -0,0 +1,112 @@
+import random
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+# concurrency a scan starts at, before slow start finds the server's capacity
+INITIAL_LIMIT = 10
+# smoothed latency this many times the best seen is treated as congestion
+LATENCY_TOLERANCE = 3.0
+# weight of each new sample in the smoothed latency
+LATENCY_SMOOTHING = 0.1
+# seconds; exponential backoff between retries starts here and is capped here
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
+
+class ConcurrencyLimit(object):
+    """AIMD limit on the number of requests in flight.
+
+    Starts at INITIAL_LIMIT and doubles every round trip (slow start) until
+    the first sign of congestion, then grows by one per round trip. It is
+    halved, at most once per round trip, when the server throttles us or
+    latency climbs well above the best seen. Stays between 1 and maximum.
+
+    Latency is compared per endpoint, since a db info GET and a design doc
+    listing take very different times even on an idle server.
+    """
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.limit = float(min(maximum, INITIAL_LIMIT))
+        self.threshold = float(maximum)
+        # endpoint -> [best latency seen, smoothed latency]
+        self.latencies = {}
+        self.last_decrease = 0
+
+    def success(self, sent_at, latency=None, endpoint=None):
+        """Count a response that was not throttled. Its latency, if given,
+        is compared with the best seen for its endpoint."""
+        congested = False
+        if latency is not None:
+            if endpoint not in self.latencies:
+                self.latencies[endpoint] = [latency, latency]
+            seen = self.latencies[endpoint]
+            seen[0] = min(seen[0], latency)
+            seen[1] += LATENCY_SMOOTHING * (latency - seen[1])
+            congested = seen[1] > LATENCY_TOLERANCE * seen[0]
+
+        if congested:
+            self.decrease(sent_at)
+        elif self.limit < self.threshold:
+            self.limit = min(self.limit + 1, self.maximum)
+        else:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def decrease(self, sent_at):
+        # requests sent before the last cut saw the old limit; don't cut twice for them
+        if sent_at < self.last_decrease:
+            return
+        self.limit = max(1.0, self.limit / 2)
+        self.threshold = self.limit
+        self.last_decrease = time.time()
+        # let the smoothed latencies settle at the new limit
+        for seen in self.latencies.values():
+            seen[1] = seen[0]
+
+    def __int__(self):
+        return int(self.limit)
+
+
+class RateLimit(object):
+    """Token bucket capping requests per second. A rate of 0 is unlimited."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 1.0
+        self.updated = time.time()
+
+    def wait(self):
+        """Seconds until the next request may be sent."""
+        if self.rate <= 0:
+            return 0
+        now = time.time()
+        self.tokens = min(1.0, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+
+def parse_retry_after(response):
+    """Seconds the server asked us to wait, from its Retry-After header."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0.0, mktime_tz(date) - time.time())
+
+
+def retry_delay(attempts, retry_after=None):
+    """Jittered delay before retry number attempts."""
+    if retry_after is not None:
+        return retry_after + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempts))